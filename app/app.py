@@ -1,11 +1,13 @@
 from flask import abort, Flask, url_for, session, request, current_app
-from flask import render_template, redirect
+from flask import render_template, redirect, jsonify
+import hmac
 import os
 import requests
 import sys 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../"))
 from app.auth import setup_auth
 from app.pipeline import create_rag_chain_with_source
+from core.result_cache import get_result_cache
 
 app = Flask(__name__)
 app.secret_key = 'secret'
@@ -60,7 +62,8 @@ def auth():
     token = getattr(oauth, oidc_server).authorize_access_token()
     session['user'] = token['userinfo']
     print(f"rag_app /auth: userinfo={session['user']}")
-    rag_chain_with_source = create_rag_chain_with_source(session['user'])
+    # interactive users get answers from the departments that are ready rather than waiting for the rest to warm up
+    rag_chain_with_source = create_rag_chain_with_source(session['user'], ready_only=True, cache_results=current_app.config['CACHE_RESULTS'])
     return redirect('/success')
 
 
@@ -92,4 +95,23 @@ def handle_query():
             response = rag_chain_with_source.invoke(query)
             chat_history.append((query, response["answer"], response["documents"]))
 
-    return render_template("chat.html", chat_history=chat_history, chat_len=len(chat_history))
\ No newline at end of file
+    return render_template("chat.html", chat_history=chat_history, chat_len=len(chat_history))
+
+def admin_authorized():
+    admin_token = current_app.config.get('ADMIN_TOKEN')
+    return bool(admin_token) and hmac.compare_digest(request.headers.get('X-Admin-Token', ''), admin_token)
+
+@app.route('/api/result_cache', methods=['GET'])
+def result_cache_stats():
+    if session.get('user') is None and not admin_authorized():
+        abort(401)
+    return jsonify(get_result_cache().stats())
+
+# invalidation hook, e.g. for a hospital that re-indexed: drops its cached results (all of them without a hospital).
+# Admins only, flushing the cache forces a full fan-out for every user
+@app.route('/api/result_cache/invalidate', methods=['POST'])
+def invalidate_result_cache():
+    if not admin_authorized():
+        abort(403)
+    hospital_uri = request.form.get('hospital') or (request.get_json(silent=True) or {}).get('hospital')
+    return jsonify(invalidated=get_result_cache().invalidate(hospital_uri))
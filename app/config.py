@@ -10,6 +10,14 @@ HOSPITALB_CLIENT_SECRET = "TODO"
 HOSPITALC_CLIENT_ID = "TODO"
 HOSPITALC_CLIENT_SECRET = "TODO"
 
+# shared token for the root's admin routes (e.g. POST /api/result_cache/invalidate), sent as the X-Admin-Token header;
+# those routes are disabled while it is empty
+ADMIN_TOKEN = ""
+
+# answer repeated queries from the root's result cache (see core/result_cache.py) instead of the hospitals;
+# off by default: results may be up to RESULT_CACHE_TTL seconds stale for changes hospitals don't report
+CACHE_RESULTS = False
+
 
 # TODO we might use urllib actual URI objects instead of strings
 TRUSTED_OPENID_SERVERS = {
@@ -21,4 +29,8 @@ TRUSTED_OPENID_SERVERS = {
                                                   "server_metadata_url": 'http://127.0.0.1:5003/.well-known/openid-configuration'}
                     }
 
-REGISTERED_HOSPITAL_ENDPOINTS = {"http://127.0.0.1:5001/api/retrieve", "http://127.0.0.1:5002/api/retrieve", "http://127.0.0.1:5003/api/retrieve"}
\ No newline at end of file
+REGISTERED_HOSPITAL_ENDPOINTS = {"http://127.0.0.1:5001/api/retrieve", "http://127.0.0.1:5002/api/retrieve", "http://127.0.0.1:5003/api/retrieve"}
+
+# Replicas of the hospital endpoints above that the root may hedge slow requests to, e.g.
+# {"http://127.0.0.1:5001/api/retrieve": ["http://127.0.0.1:5011/api/retrieve"]}
+HOSPITAL_ENDPOINT_REPLICAS = {}
\ No newline at end of file
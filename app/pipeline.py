@@ -1,5 +1,5 @@
 from langchain.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnableParallel, RunnablePassthrough
+from langchain_core.runnables import RunnableLambda, RunnableParallel
 from langchain_openai import ChatOpenAI
 from langchain.schema.output_parser import StrOutputParser
 from operator import itemgetter
@@ -7,7 +7,7 @@ from operator import itemgetter
 import os
 import sys 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../"))
-from app.config import REGISTERED_HOSPITAL_ENDPOINTS
+from app.config import CACHE_RESULTS, REGISTERED_HOSPITAL_ENDPOINTS, HOSPITAL_ENDPOINT_REPLICAS
 from app.secret import OPENAI_KEY
 from core.federated_retriever import RootRetriever
 
@@ -20,17 +20,32 @@ TEMPLATE = """You are an assistant for clinical question answering. Read the fol
 PROMPT = ChatPromptTemplate.from_template(TEMPLATE)
 SEARCH_KWARGS = {"k": 10, "fetch_k": 20}
 # SEARCH_KWARGS = {"k": 4, "fetch_k": 20}
+RETRIEVAL_SLO = 30.0  # seconds; answer with whichever hospitals have responded by then (None waits for all)
+HEDGE_AFTER = 5.0  # seconds before re-issuing a hospital's request to its replicas, if it has any
+SEND_QUERY_VECTOR = False  # embed the query once at the root and send the vector to hospitals using the same embedding model
+STREAM_RESULTS = False  # hospitals stream docs leaf by leaf, the root stops reading once no later doc can make the top k (replaces hedging)
+SEMANTIC_CACHE_THRESHOLD = None  # experimental, uncalibrated: with CACHE_RESULTS (app/config.py), also answer paraphrases this cosine-similar to a cached query (pick one with eval/benchmarks/bench_semantic_cache.py)
 
 GPT_LLM = ChatOpenAI(model="gpt-3.5-turbo-0125", openai_api_key=OPENAI_KEY, temperature=0)
 
 def format_docs(docs):
     return "\n\n".join(doc["kwargs"]["page_content"] for doc in docs)
     
-def create_rag_chain_with_source(userinfo, hospital_retrieve_uris=REGISTERED_HOSPITAL_ENDPOINTS, llm=GPT_LLM, secure=True): 
-    root_retriever = RootRetriever(hospital_retrieve_uris=hospital_retrieve_uris,
-                                   userinfo=userinfo,
-                                   search_kwargs=(SEARCH_KWARGS | {"secure": secure}))
+def create_root_retriever(userinfo, hospital_retrieve_uris=REGISTERED_HOSPITAL_ENDPOINTS, secure=True, slo=RETRIEVAL_SLO, ready_only=False, cache_results=CACHE_RESULTS):
+    return RootRetriever(hospital_retrieve_uris=hospital_retrieve_uris,
+                         userinfo=userinfo,
+                         search_kwargs=(SEARCH_KWARGS | {"secure": secure}),
+                         timeout=slo,
+                         deadline=slo,
+                         hospital_replicas=HOSPITAL_ENDPOINT_REPLICAS,
+                         hedge_after=HEDGE_AFTER,
+                         send_query_vector=SEND_QUERY_VECTOR,
+                         stream_results=STREAM_RESULTS,
+                         cache_results=cache_results,
+                         semantic_cache_threshold=SEMANTIC_CACHE_THRESHOLD,
+                         ready_only=ready_only)
 
+def _answer_steps(llm):
     rag_chain_from_docs = (
         {
             "context": lambda input: format_docs(input["documents"]),
@@ -41,12 +56,25 @@ def create_rag_chain_with_source(userinfo, hospital_retrieve_uris=REGISTERED_HOS
         | StrOutputParser()
     )
 
-    rag_chain_with_source = RunnableParallel(
-        {"documents": root_retriever, "question": RunnablePassthrough()}
-    ) | {
+    return {
         "answer": rag_chain_from_docs,
         "documents": lambda input: [doc for doc in input["documents"]],
         "prompt": lambda input: PROMPT.format(context=format_docs(input["documents"]), question=input["question"]),
     }
 
+def create_answer_chain(llm=GPT_LLM):
+    # {"question", "documents"} -> {"answer", "documents", "prompt"}, for documents retrieved beforehand (e.g. with RootRetriever.retrieve_batch)
+    return RunnableParallel(_answer_steps(llm))
+
+def create_rag_chain_with_source(userinfo, hospital_retrieve_uris=REGISTERED_HOSPITAL_ENDPOINTS, llm=GPT_LLM, secure=True, slo=RETRIEVAL_SLO, ready_only=False, cache_results=CACHE_RESULTS): 
+    root_retriever = create_root_retriever(userinfo, hospital_retrieve_uris=hospital_retrieve_uris, secure=secure, slo=slo, ready_only=ready_only, cache_results=cache_results)
+
+    # the missing sites travel with each call's documents, so concurrent invokes of the chain don't mix them up
+    rag_chain_with_source = RunnableLambda(
+        lambda question: {**root_retriever.retrieve(question), "question": question}
+    ) | {
+        **_answer_steps(llm),
+        "missing_sites": itemgetter("missing_sites"),  # hospitals that missed the SLO, i.e. partial answer
+    }
+
     return rag_chain_with_source
@@ -0,0 +1,199 @@
+import json
+import re
+from collections import OrderedDict
+from py_abac import PDP, AccessRequest, EvaluationAlgorithm
+from py_abac.storage.memory import MemoryStorage
+from core.abac_filter import PolicyFilter, compile_resource_filter
+from threading import Lock
+
+from typing import Any, Iterable, Iterator, Optional, Set, Tuple
+
+ABAC_CACHE_SIZE = 4096  # decisions kept per pdp
+POLICY_PAGE_SIZE = 100  # policies read at a time from storage when finding referenced attributes
+
+ACCESS_ELEMENTS = ("subject", "resource", "action", "context")
+_SIMPLE_PATH = re.compile(r"^\$\.([A-Za-z_][A-Za-z0-9_]*)")  # e.g. "$.dept_id" or "$.affiliations[0]" -> top-level attribute name
+
+"""
+Memoized ABAC decisions.
+A decision only depends on the request attributes that the policies reference (e.g. org, role, dept,
+affiliations and dept_id for the hospital policies), so CachedPDP keys decisions on that projection of the
+subject/resource/action/context attributes: per-document checks in a leaf whose documents share those
+attributes cost one policy evaluation, then a dictionary lookup. Cached decisions are dropped whenever the
+policy storage changes, which VersionedMemoryStorage tracks with a version counter.
+"""
+
+class VersionedMemoryStorage(MemoryStorage):
+    """ MemoryStorage that counts policy changes, so caches built on it know when to invalidate """
+
+    def __init__(self):
+        super().__init__()
+        self.version = 0
+
+    def add(self, policy):
+        super().add(policy)
+        self.version += 1
+
+    def update(self, policy):
+        super().update(policy)
+        self.version += 1
+
+    def delete(self, uid: str):
+        super().delete(uid)
+        self.version += 1
+
+
+def _attribute_paths(rules: Any) -> Iterator[str]:
+    """ Every attribute path ("$. ...") appearing in policy rules, as a condition key or a value """
+    if isinstance(rules, dict):
+        for key, value in rules.items():
+            if isinstance(key, str) and key.startswith("$"):
+                yield key
+            yield from _attribute_paths(value)
+    elif isinstance(rules, (list, tuple)):
+        for value in rules:
+            yield from _attribute_paths(value)
+    elif isinstance(rules, str) and rules.startswith("$"):
+        yield rules
+
+
+class CachedPDP(PDP):
+    def __init__(
+            self,
+            storage: MemoryStorage,
+            algorithm: EvaluationAlgorithm = EvaluationAlgorithm.DENY_OVERRIDES,
+            providers: Optional[list] = None,
+            cache_size: int = ABAC_CACHE_SIZE,
+        ):
+        super().__init__(storage, algorithm, providers)
+        self.cache_size = cache_size
+        self._cache: OrderedDict[tuple, bool | PolicyFilter] = OrderedDict()  # decisions and compiled resource filters
+        self._lock = Lock()
+        self._version = None  # storage version the cache and referenced attributes were computed for
+        self._attrs: Optional[Set[str]] = None  # top-level attribute names referenced by any policy, None if unknown
+        self._uses_targets = True  # whether any policy has targets, i.e. decisions also depend on element ids
+
+    def _policies(self):
+        offset = 0
+        while True:
+            page = list(self._storage.get_all(POLICY_PAGE_SIZE, offset))
+            yield from page
+            if len(page) < POLICY_PAGE_SIZE:
+                return
+            offset += POLICY_PAGE_SIZE
+
+    def _refresh(self) -> None:
+        """ Re-derive referenced attributes and drop cached decisions if the policy storage changed. Call with the lock held. """
+        version = getattr(self._storage, "version", 0)  # storages without a version are only refreshed by clear_cache()
+        if version == self._version:
+            return
+        attrs, uses_targets = set(), False
+        for policy in self._policies():
+            policy_json = policy.to_json()
+            uses_targets = uses_targets or any(target != "*" for target in (policy_json.get("targets") or {}).values())
+            for path in _attribute_paths(policy_json.get("rules", {})):
+                match = _SIMPLE_PATH.match(path)
+                if match is None:  # e.g. "$..dept" or "$.*": can't tell which attributes matter
+                    attrs = None
+                    break
+                attrs.add(match.group(1))
+            if attrs is None:
+                break
+        self._attrs, self._uses_targets = attrs, uses_targets
+        self._cache.clear()
+        self._version = version
+
+    def _key(self, req_json: dict) -> tuple:
+        key = []
+        for element in ACCESS_ELEMENTS:
+            element_json = req_json.get(element) or {}
+            attributes = (element_json.get("attributes") or {}) if element != "context" else element_json
+            if self._attrs is None:
+                projection = json.dumps(attributes, sort_keys=True, default=str)
+            else:
+                # (name, present, value): a missing attribute is distinct from an attribute set to None
+                projection = tuple(
+                    (name, name in attributes, json.dumps(attributes.get(name), sort_keys=True, default=str))
+                    for name in sorted(self._attrs)
+                )
+            key.append((element_json.get("id") if self._uses_targets and element != "context" else None, projection))
+        return tuple(key)
+
+    def is_allowed_json(self, req_json: dict) -> bool:
+        """ Same decision as is_allowed(AccessRequest.from_json(req_json)), memoized on the referenced attributes """
+        if self._providers:  # attribute providers can look up attributes outside the request, so never cache
+            return self.is_allowed(AccessRequest.from_json(req_json))
+        with self._lock:
+            self._refresh()
+            version, key = self._version, self._key(req_json)
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        allowed = self.is_allowed(AccessRequest.from_json(req_json))
+        with self._lock:
+            if self._version != version:  # policies changed during evaluation, don't cache a possibly stale decision
+                return allowed
+            self._cache[key] = allowed
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return allowed
+
+    def resource_filter(self, req_json: dict, key_prefix: str = "metadata.") -> PolicyFilter:
+        """ compile_resource_filter for the subject/action/context of `req_json`, memoized like decisions """
+        if self._providers:
+            return compile_resource_filter(self, req_json, key_prefix)
+        with self._lock:
+            self._refresh()
+            version, key = self._version, ("resource_filter", key_prefix, self._key(req_json))
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        policy_filter = compile_resource_filter(self, req_json, key_prefix)
+        with self._lock:
+            if self._version != version:
+                return policy_filter
+            self._cache[key] = policy_filter
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return policy_filter
+
+    def referenced_attributes(self) -> Tuple[Optional[Set[str]], bool]:
+        """ (top-level attribute names referenced by any policy, None if unknown; whether any policy has targets) """
+        with self._lock:
+            self._refresh()
+            return self._attrs, self._uses_targets
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self._version = None
+
+
+def pdp_allows(pdp: PDP, req_json: dict) -> bool:
+    """ Decision for an access request json, through the decision cache if `pdp` has one """
+    if isinstance(pdp, CachedPDP):
+        return pdp.is_allowed_json(req_json)
+    return pdp.is_allowed(AccessRequest.from_json(req_json))
+
+def pdp_resource_filter(pdp: PDP, req_json: dict, key_prefix: str = "metadata.") -> PolicyFilter:
+    """ Qdrant pre-filter of the resources `pdp` may allow, through the cache if `pdp` has one """
+    if isinstance(pdp, CachedPDP):
+        return pdp.resource_filter(req_json, key_prefix)
+    return compile_resource_filter(pdp, req_json, key_prefix)
+
+def userinfo_attributes(pdps: Iterable[PDP]) -> Optional[Set[str]]:
+    """ userinfo attributes the decisions of `pdps` can depend on, None if that can't be told (i.e. all of them).
+        Includes "sub" if any policy has targets, since it is the subject id of gate requests.
+        Users whose userinfo agrees on these attributes get the same results (see core/result_cache.py).
+    """
+    names = set()
+    for pdp in pdps:
+        if not isinstance(pdp, CachedPDP) or pdp._providers:
+            return None
+        attrs, uses_targets = pdp.referenced_attributes()
+        if attrs is None:
+            return None
+        names |= attrs | ({"sub"} if uses_targets else set())
+    return names
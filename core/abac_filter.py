@@ -0,0 +1,85 @@
+import re
+from py_abac import PDP, AccessRequest, EvaluationAlgorithm, Policy
+from py_abac.context import EvaluationContext
+from qdrant_client.http import models as rest
+
+from typing import Any, List, NamedTuple, Optional
+
+_SIMPLE_PATH = re.compile(r"^\$\.([A-Za-z_][A-Za-z0-9_]*)$")  # e.g. "$.dept_id"
+
+"""
+Compiles the resource-side conditions of py_abac policies into a Qdrant filter, so a leaf only searches
+points the requesting user may retrieve (instead of fetching fetch_k candidates and discarding the denied ones).
+Subject, action, context and target conditions are evaluated up front for the requesting user; the resource
+conditions of every policy that could still allow the request are translated into payload conditions.
+The filter is allowed to be broader than the policies (conditions with no Qdrant equivalent, negations and
+deny policies are left out), never narrower, so the post-hoc PDP check on each document stays the final word.
+"""
+
+class PolicyFilter(NamedTuple):
+    permits_any: bool  # False if no policy can allow this user any resource, i.e. no need to search at all
+    filter: Optional[rest.Filter]  # None if no resource condition applies, i.e. search everything
+
+
+def _match_values(values: List[Any]) -> Optional[List[Any]]:
+    """ values usable in a qdrant MatchAny (all strings or all ints), else None """
+    if all(isinstance(v, str) for v in values) or all(isinstance(v, int) and not isinstance(v, bool) for v in values):
+        return values
+    return None
+
+def _compile_condition(key: str, cond: dict) -> Optional[rest.Condition]:
+    """ Qdrant condition matching (at least) the payload values satisfying `cond`, None if it can't be expressed """
+    name = cond.get("condition")
+    if name == "Equals" and not cond.get("case_insensitive"):
+        return rest.FieldCondition(key=key, match=rest.MatchValue(value=cond["value"]))
+    if name in ("IsIn", "AnyIn") and _match_values(cond["values"]):  # qdrant matches arrays if any element matches
+        return rest.FieldCondition(key=key, match=rest.MatchAny(any=cond["values"]))
+    if name in ("Eq", "Gt", "Gte", "Lt", "Lte"):
+        bounds = {"Eq": {"gte": cond["value"], "lte": cond["value"]}}.get(name, {name.lower(): cond["value"]})
+        return rest.FieldCondition(key=key, range=rest.Range(**bounds))
+    if name == "AllOf":
+        conditions = [c for c in (_compile_condition(key, sub) for sub in cond["values"]) if c is not None]
+        return rest.Filter(must=conditions) if conditions else None
+    if name == "AnyOf":
+        conditions = [_compile_condition(key, sub) for sub in cond["values"]]
+        return None if any(c is None for c in conditions) else rest.Filter(should=conditions)
+    return None  # e.g. negations, regexes, attribute comparisons: left to the post-hoc pdp check
+
+def _compile_rules(resource_rules: dict | list, key_prefix: str) -> Optional[rest.Condition]:
+    if isinstance(resource_rules, list):  # implicit OR
+        conditions = [_compile_rules(rules, key_prefix) for rules in resource_rules]
+        return None if not conditions or any(c is None for c in conditions) else rest.Filter(should=conditions)
+
+    conditions = []  # implicit AND
+    for path, cond in resource_rules.items():
+        match = _SIMPLE_PATH.match(path)
+        condition = _compile_condition(f"{key_prefix}{match.group(1)}", cond) if match else None
+        if condition is not None:
+            conditions.append(condition)
+    return rest.Filter(must=conditions) if conditions else None
+
+def compile_resource_filter(pdp: PDP, req_json: dict, key_prefix: str = "metadata.") -> PolicyFilter:
+    """ Qdrant filter of the resources `pdp` may allow for the subject/action/context of `req_json`
+        (its resource attributes are ignored). `key_prefix` locates resource attributes in the point payload.
+    """
+    request = AccessRequest.from_json(req_json)
+    ctx = EvaluationContext(request, pdp._providers)
+    policies = pdp._storage.get_for_target(request.subject_id, request.resource_id, request.action_id)
+
+    resource_conditions = []
+    for policy in policies:
+        # with allow-overrides only allow policies can permit a resource; otherwise any fitting policy is a candidate
+        policy_json = policy.to_json()
+        if pdp._algorithm == EvaluationAlgorithm.ALLOW_OVERRIDES.value and policy_json["effect"] != "allow":
+            continue
+        non_resource_policy = Policy.from_json(policy_json | {"rules": policy_json["rules"] | {"resource": {}}})
+        if not non_resource_policy.fits(ctx):
+            continue
+        condition = _compile_rules(policy_json["rules"]["resource"], key_prefix)
+        if condition is None:  # this policy may allow any resource
+            return PolicyFilter(permits_any=True, filter=None)
+        resource_conditions.append(condition)
+
+    if not resource_conditions:
+        return PolicyFilter(permits_any=False, filter=None)
+    return PolicyFilter(permits_any=True, filter=rest.Filter(should=resource_conditions))
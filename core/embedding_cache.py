@@ -0,0 +1,178 @@
+import hashlib
+import numpy as np
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from langchain_core.embeddings import Embeddings
+
+from typing import Dict, List, Optional
+
+import logging
+logger = logging.getLogger("log")
+
+EMBEDDING_CACHE_DIR = os.path.join(os.path.dirname(__file__), "../embedding_cache/")
+EMBEDDING_CACHE_MAX_ENTRIES = 100_000  # ~300MB of float32 vectors at ClinicalBERT's 768 dimensions
+QUERY_CACHE_MAX_ENTRIES = 1024  # recent query vectors kept in memory, per process
+
+"""
+Persistent, cross-process embedding cache.
+Vectors live in a fixed-capacity memory-mapped .npy file (one row per slot) and a small sqlite
+index maps sha256(model id + text) -> (slot, last used time). Cache hits are served straight from
+the memmap without running the model; when the cache is full, the least recently used slots are reused.
+Hospital servers and the eval scripts share one cache directory, so text embedded by any of them
+(e.g. the same chunks in a federated leaf and in the centralized baseline) is only embedded once.
+Queries don't go through it: a lookup takes the cache's cross-process write lock, which has no place on the
+search latency path, and one-off queries would push document vectors out. Recent query vectors are kept in a
+small in-memory LRU instead.
+"""
+
+class CachedEmbeddings(Embeddings):
+    def __init__(
+            self,
+            embedding: Embeddings,
+            model_id: str,
+            cache_dir: str = EMBEDDING_CACHE_DIR,
+            max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES,
+            max_query_entries: int = QUERY_CACHE_MAX_ENTRIES,
+        ):
+        self.embedding = embedding
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.cache_path = os.path.join(cache_dir, hashlib.sha256(model_id.encode("utf-8")).hexdigest()[:16])
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_pid: Optional[int] = None  # sqlite connections must not be shared across os.fork()
+        self._vectors: Optional[np.memmap] = None
+        self._lock = threading.Lock()
+        self.max_query_entries = max_query_entries
+        self._queries: OrderedDict[str, List[float]] = OrderedDict()  # text -> vector, least recently used first
+        self._queries_lock = threading.Lock()
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_id}\0{text}".encode("utf-8")).hexdigest()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None or self._db_pid != os.getpid():
+            self._db_pid = os.getpid()
+            os.makedirs(self.cache_path, exist_ok=True)
+            # isolation_level=None: transactions are managed explicitly with BEGIN IMMEDIATE,
+            # which serializes slot reads/writes across all processes sharing the cache
+            self._db = sqlite3.connect(os.path.join(self.cache_path, "index.sqlite"), timeout=60, isolation_level=None, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, slot INTEGER UNIQUE, last_used REAL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+        return self._db
+
+    def _open_vectors(self, dim: Optional[int] = None) -> Optional[np.memmap]:
+        """ Opens the vector memmap, creating it with `dim` columns if it doesn't exist yet. Call inside a transaction. """
+        if self._vectors is None:
+            row = self.db.execute("SELECT value FROM meta WHERE name = 'capacity'").fetchone()
+            vectors_path = os.path.join(self.cache_path, "vectors.npy")
+            if row is not None and os.path.exists(vectors_path):
+                self._vectors = np.lib.format.open_memmap(vectors_path, mode="r+")
+            elif dim is not None:
+                self._vectors = np.lib.format.open_memmap(vectors_path, mode="w+", dtype=np.float32, shape=(self.max_entries, dim))
+                self.db.execute("DELETE FROM entries")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('capacity', ?)", (self.max_entries,))
+        return self._vectors
+
+    def _lookup(self, keys: List[str]) -> Dict[str, List[float]]:
+        hits = {}
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                vectors = self._open_vectors()
+                if vectors is not None:
+                    unique_keys = list(dict.fromkeys(keys))
+                    for start in range(0, len(unique_keys), 500):  # stay under sqlite's bound parameter limit
+                        batch = unique_keys[start:start + 500]
+                        rows = self.db.execute(
+                            f"SELECT key, slot FROM entries WHERE key IN ({','.join('?' * len(batch))})", batch
+                        ).fetchall()
+                        for key, slot in rows:
+                            hits[key] = vectors[slot].tolist()
+                    now = time.time()
+                    self.db.executemany("UPDATE entries SET last_used = ? WHERE key = ?", [(now, key) for key in hits])
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return hits
+
+    def _store(self, new_vectors: Dict[str, List[float]]) -> None:
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                vectors = self._open_vectors(dim=len(next(iter(new_vectors.values()))))
+                capacity = vectors.shape[0]
+                new_keys = [
+                    key for key in new_vectors
+                    if self.db.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is None  # stored by another process meanwhile
+                ][:capacity]
+                n_used = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+                used_slots = {slot for (slot,) in self.db.execute("SELECT slot FROM entries")} if n_used < capacity else None
+
+                # free slots first, then evict least recently used entries
+                slots = []
+                if used_slots is not None:
+                    slots = [slot for slot in range(capacity) if slot not in used_slots][:len(new_keys)]
+                n_evict = len(new_keys) - len(slots)
+                if n_evict > 0:
+                    evicted = self.db.execute("SELECT key, slot FROM entries ORDER BY last_used LIMIT ?", (n_evict,)).fetchall()
+                    self.db.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in evicted])
+                    slots.extend(slot for _, slot in evicted)
+                    logger.debug(f"Embedding cache evicted {len(evicted)} entries")
+
+                for key, slot in zip(new_keys, slots):
+                    vectors[slot] = new_vectors[key]
+                vectors.flush()  # vectors must be on disk before the index points at them
+                now = time.time()
+                self.db.executemany("INSERT INTO entries VALUES (?, ?, ?)", [(key, slot, now) for key, slot in zip(new_keys, slots)])
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        cached = self._lookup(keys)
+        miss_texts = {key: text for key, text in zip(keys, texts) if key not in cached}
+        if miss_texts:
+            computed = dict(zip(miss_texts, self.embedding.embed_documents(list(miss_texts.values()))))
+            self._store(computed)
+            cached.update(computed)
+        logger.debug(f"Embedding cache: {len(texts) - len(miss_texts)} hits, {len(miss_texts)} misses")
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """ Query vectors, from the in-memory query cache or (for the misses) one batched forward pass """
+        with self._queries_lock:
+            cached = {text: self._queries[text] for text in texts if text in self._queries}
+            for text in cached:
+                self._queries.move_to_end(text)
+        misses = [text for text in dict.fromkeys(texts) if text not in cached]
+        if misses:
+            computed = [self.embedding.embed_query(misses[0])] if len(misses) == 1 else self.embedding.embed_documents(misses)
+            cached.update(zip(misses, computed))
+            with self._queries_lock:
+                self._queries.update(zip(misses, computed))
+                while len(self._queries) > self.max_query_entries:
+                    self._queries.popitem(last=False)
+        return [list(cached[text]) for text in texts]
+
+    def evict(self, n: Optional[int] = None) -> None:
+        """ Drops the `n` least recently used entries, or every entry if n is None """
+        with self._lock:
+            if n is None:
+                self.db.execute("DELETE FROM entries")
+            else:
+                self.db.execute("DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY last_used LIMIT ?)", (n,))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
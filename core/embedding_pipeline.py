@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from langchain_community.vectorstores import Qdrant
+from langchain_core.embeddings import Embeddings
+from langchain.schema import Document
+from qdrant_client import QdrantClient
+from qdrant_client.http import models as rest
+
+from typing import Callable, List, Optional, Tuple
+
+import logging
+logger = logging.getLogger("log")
+
+EMBED_BATCH_SIZE = 64  # documents per forward pass / upsert
+EMBED_WORKERS = min(4, os.cpu_count() or 1)  # concurrent embedding batches, across all builds of the process; torch releases the GIL while encoding
+EMBED_MAX_IN_FLIGHT = 2  # embedded batches allowed to wait for upsert, per worker (bounds memory)
+
+"""
+Embedding stage for building leaf/baseline Qdrant collections.
+Documents are sorted by length so each batch holds similarly sized texts (less padding per forward pass),
+batches are embedded by a pool of workers (producers), and the calling thread upserts each embedded
+batch into Qdrant as soon as it is ready (consumer), so embedding and upserting overlap.
+The pool is shared by every build of the process (e.g. the concurrent leaf builds of core/warmup.py), and
+torch's intra-op pool, which defaults to every core for each forward pass, is set once to split the cores
+between its workers. However many indexes are built at once, the forward passes then use about one thread per core.
+How much the pool gains over a single embed_documents call depends on the host, measure it with
+eval/benchmarks/bench_embedding_pipeline.py before changing EMBED_WORKERS.
+"""
+
+def torch_threads_per_worker(n_workers: int) -> int:
+    return max(1, (os.cpu_count() or 1) // max(1, n_workers))
+
+def _set_torch_threads(n_threads: int) -> None:
+    try:
+        import torch
+    except ImportError:  # embeddings that don't run on torch, nothing to limit
+        return
+    torch.set_num_threads(n_threads)
+
+
+class EmbedExecutor(ThreadPoolExecutor):
+    """ Embedding workers with a torch thread budget of cpu_count // n_workers each.
+        Creating one sets torch's (process-wide) thread count, use get_embed_executor() outside benchmarks
+    """
+    def __init__(self, n_workers: int = EMBED_WORKERS):
+        self.n_workers = n_workers
+        self.torch_threads = torch_threads_per_worker(n_workers)
+        _set_torch_threads(self.torch_threads)
+        # and again in each worker, openmp builds of torch keep the count per thread
+        super().__init__(max_workers=n_workers, thread_name_prefix="embed", initializer=_set_torch_threads, initargs=(self.torch_threads,))
+
+
+_EMBED_EXECUTOR: EmbedExecutor | None = None
+_EMBED_EXECUTOR_LOCK = threading.Lock()
+
+def get_embed_executor() -> EmbedExecutor:
+    """ The process-wide embedding pool, shared by all index builds """
+    global _EMBED_EXECUTOR
+    if _EMBED_EXECUTOR is None:
+        with _EMBED_EXECUTOR_LOCK:
+            if _EMBED_EXECUTOR is None:
+                _EMBED_EXECUTOR = EmbedExecutor()
+    return _EMBED_EXECUTOR
+
+def _reset_embed_executor_after_fork():
+    # worker threads do not survive os.fork() (e.g. eval/scalability), so children start a fresh pool
+    global _EMBED_EXECUTOR
+    _EMBED_EXECUTOR = None
+
+os.register_at_fork(after_in_child=_reset_embed_executor_after_fork)
+
+def _embed_batch(embedding: Embeddings, batch: List[Tuple[str, Document]]):
+    texts = [doc.page_content for _, doc in batch]
+    return batch, embedding.embed_documents(texts)
+
+def embed_and_upsert(
+        client: QdrantClient,
+        collection_name: str,
+        docs: List[Tuple[str, Document]],  # (point id, document)
+        embedding: Embeddings,
+        batch_size: int = EMBED_BATCH_SIZE,
+        executor: Optional[EmbedExecutor] = None,  # get_embed_executor() by default
+        on_upsert: Optional[Callable[[List[List[float]]], None]] = None,  # called with the vectors of each upserted batch
+    ) -> None:
+    t1 = time.perf_counter()
+    executor = executor or get_embed_executor()
+    docs = sorted(docs, key=lambda id_doc: len(id_doc[1].page_content))
+    batches = [docs[start:start + batch_size] for start in range(0, len(docs), batch_size)]
+    max_in_flight = max(1, executor.n_workers * EMBED_MAX_IN_FLIGHT)
+
+    def upsert(batch, vectors):
+        client.upsert(
+            collection_name=collection_name,
+            points=rest.Batch(
+                ids=[point_id for point_id, _ in batch],
+                vectors=vectors,
+                payloads=[{Qdrant.CONTENT_KEY: doc.page_content, Qdrant.METADATA_KEY: doc.metadata} for _, doc in batch],
+            ),
+        )
+        if on_upsert is not None:
+            on_upsert(vectors)
+
+    in_flight = set()
+    try:
+        for batch in batches:
+            if len(in_flight) >= max_in_flight:  # backpressure: upsert before embedding more
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    upsert(*fut.result())
+            in_flight.add(executor.submit(_embed_batch, embedding, batch))
+        for fut in in_flight:
+            upsert(*fut.result())
+    except BaseException:
+        for fut in in_flight:  # the pool is shared, don't keep it busy with a failed build
+            fut.cancel()
+        raise
+
+    logger.debug(f"Embedded and upserted {len(docs)} docs into {collection_name} in {time.perf_counter() - t1:.2f}s "
+                 f"(batch_size={batch_size}, n_workers={executor.n_workers}, torch threads per worker={executor.torch_threads})")
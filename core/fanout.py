@@ -0,0 +1,245 @@
+import aiohttp
+import asyncio
+import math
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from core.wire import NDJSON, accept_header, decode_response, decode_stream_line, encode_query_params, encode_request
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import logging
+logger = logging.getLogger("log")
+
+FANOUT_TIMEOUT = 30.0  # seconds allowed for a single hospital's /api/retrieve
+FANOUT_DEADLINE = 60.0  # seconds allowed for the whole fan-out across all hospitals
+FANOUT_POOL_SIZE = 8  # keep-alive connections kept open per hospital endpoint
+FANOUT_KEEPALIVE = 75.0  # seconds an idle keep-alive connection stays open
+FANOUT_POST = True  # send requests as a POST body (see core/wire.py), False for GET query strings
+
+"""
+Async fan-out of /api/retrieve calls to hospital servers.
+A single event loop runs on a daemon thread for the lifetime of the process, and each
+hospital endpoint gets its own aiohttp session (i.e. its own pool of keep-alive connections),
+so a query costs one HTTP round trip per hospital instead of a process spawn + TCP handshake.
+Requests and responses use the compact wire format negotiated in core/wire.py.
+A hospital that still only serves GET (answers a POST with 405) is retried with a GET query string and remembered,
+so hospitals can be upgraded after the root.
+"""
+
+class HospitalFanout:
+    def __init__(
+            self,
+            pool_size: int = FANOUT_POOL_SIZE,
+            keepalive: float = FANOUT_KEEPALIVE,
+            post: bool = FANOUT_POST,
+        ):
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        self.post = post
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}  # only touched from the loop thread
+        self._get_only: Set[str] = set()  # uris that answered a POST with 405, only touched from the loop thread
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="hospital-fanout", daemon=True)
+        self._thread.start()
+
+    def _session(self, uri: str) -> aiohttp.ClientSession:
+        session = self._sessions.get(uri)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.pool_size, keepalive_timeout=self.keepalive)
+            session = aiohttp.ClientSession(connector=connector)
+            self._sessions[uri] = session
+        return session
+
+    def _request(self, uri: str, params: Dict[str, Any], timeout: Optional[float], accept: Optional[str] = None):
+        headers = {"Accept": accept or accept_header(), "Accept-Encoding": "gzip"}
+        client_timeout = aiohttp.ClientTimeout(total=timeout)
+        if self.post and uri not in self._get_only:
+            body, content_type = encode_request(params)
+            return self._session(uri).post(uri, data=body, headers=headers | {"Content-Type": content_type}, timeout=client_timeout)
+        return self._session(uri).get(uri, params=encode_query_params(params), headers=headers, timeout=client_timeout)
+
+    def _falls_back_to_get(self, uri: str, resp: aiohttp.ClientResponse) -> bool:
+        # whether `resp` is a legacy server refusing a POST, then later requests to `uri` are sent as GET
+        if resp.status != 405 or resp.method != "POST":
+            return False
+        logger.debug(f"{uri} doesn't accept POST, falling back to GET query strings")
+        self._get_only.add(uri)
+        return True
+
+    async def _fetch(self, uri: str, params: Dict[str, Any], timeout: Optional[float]) -> dict:
+        logger.debug(f"FANOUT RETRIEVE: {uri}")
+        while True:
+            async with self._request(uri, params, timeout) as resp:
+                if self._falls_back_to_get(uri, resp):
+                    continue
+                resp.raise_for_status()
+                resp_json = decode_response(await resp.read(), resp.content_type)  # aiohttp has already undone the gzip
+                if resp_json.get("warming"):
+                    logger.debug(f"{uri} answered without leaves still warming up: {resp_json['warming']}")
+                return resp_json
+
+    async def _fetch_lines(self, uri: str, params: Dict[str, Any], timeout: Optional[float], out: queue.SimpleQueue) -> None:
+        # puts (uri, line fields) for every streamed line, then (uri, None) once the stream has ended or failed
+        logger.debug(f"FANOUT STREAM: {uri}")
+        try:
+            while True:
+                async with self._request(uri, params | {"stream": True}, timeout, accept=NDJSON) as resp:
+                    if self._falls_back_to_get(uri, resp):
+                        continue
+                    resp.raise_for_status()
+                    if resp.content_type != NDJSON:  # a legacy server answers with all its docs at once, i.e. a single last line
+                        out.put((uri, decode_response(await resp.read(), resp.content_type) | {"bound": -math.inf}))
+                        break
+                    async for line in resp.content:
+                        if line.strip():
+                            out.put((uri, decode_stream_line(line)))
+                    break
+        except Exception as e:
+            logger.debug(f"Error occurred retrieve_uri={uri}: {e!r}")
+        finally:
+            out.put((uri, None))
+
+    def submit(self, uri: str, params: Dict[str, Any], timeout: Optional[float] = FANOUT_TIMEOUT):
+        """ Schedule a retrieve on the fan-out loop, returns a concurrent.futures.Future of the response fields.
+            timeout=None waits indefinitely
+        """
+        return asyncio.run_coroutine_threadsafe(self._fetch(uri, params, timeout), self._loop)
+
+    def stream(
+            self,
+            uris: Iterable[str],
+            params: Dict[str, Any],
+            timeout: Optional[float] = FANOUT_TIMEOUT,
+            deadline: Optional[float] = FANOUT_DEADLINE,
+            replicas: Optional[Dict[str, List[str]]] = None,
+            hedge_after: Optional[float] = None,
+            field: Optional[str] = "docs",
+        ) -> Iterator[Tuple[str, Any]]:
+        """ Yields (uri, docs) as each hospital responds to the /api/retrieve fields `params`,
+            until all have responded or `deadline` seconds pass. `field` is the response field yielded
+            as the docs, e.g. "results" for /api/retrieve_batch, or None to yield all response fields.
+
+            If `hedge_after` is set, hospitals that have not responded after `hedge_after` seconds (or that
+            failed) have the same request re-issued to their `replicas`; the first response per hospital wins.
+            Hospitals that never respond are logged and simply not yielded, so callers get partial results.
+        """
+        uris = list(uris)
+        replicas = replicas or {}
+        start = time.monotonic()
+        futs = {self.submit(uri, params, timeout): uri for uri in uris}  # future -> hospital it answers for
+        pending = set(futs)
+        answered, hedged = set(), set()
+        hedge_due = hedge_after is not None and any(replicas.get(uri) for uri in uris)
+
+        def hedge(uri):
+            hedged.add(uri)
+            for replica_uri in replicas.get(uri, []):
+                logger.debug(f"HEDGE {uri} -> {replica_uri}")
+                fut = self.submit(replica_uri, params, timeout)
+                futs[fut] = uri
+                pending.add(fut)
+
+        try:
+            while pending and len(answered) < len(uris):
+                elapsed = time.monotonic() - start
+                if deadline is not None and elapsed >= deadline:
+                    break
+                wake = deadline
+                if hedge_due:
+                    wake = hedge_after if wake is None else min(wake, hedge_after)
+
+                done, _ = wait(pending, timeout=(None if wake is None else max(wake - elapsed, 0)), return_when=FIRST_COMPLETED)
+                for fut in done:
+                    pending.discard(fut)
+                    uri = futs[fut]
+                    if uri in answered:
+                        continue
+                    try:
+                        resp_fields = fut.result()
+                        docs = resp_fields if field is None else resp_fields.get(field, [])
+                    except Exception as e:
+                        logger.debug(f"Error occurred retrieve_uri={uri}: {e!r}")
+                        if hedge_after is not None and uri not in hedged:
+                            hedge(uri)
+                        continue
+                    answered.add(uri)
+                    yield uri, docs
+
+                if hedge_due and time.monotonic() - start >= hedge_after:
+                    hedge_due = False
+                    for uri in uris:
+                        if uri not in answered and uri not in hedged:
+                            hedge(uri)
+
+            missing = [uri for uri in uris if uri not in answered]
+            if missing:
+                logger.debug(f"Fan-out returned partial results after {time.monotonic() - start:.2f}s, missing={missing}")
+        finally:
+            for fut in futs:
+                fut.cancel()
+
+    def stream_lines(
+            self,
+            uris: Iterable[str],
+            params: Dict[str, Any],
+            timeout: Optional[float] = FANOUT_TIMEOUT,
+            deadline: Optional[float] = FANOUT_DEADLINE,
+        ) -> Iterator[Tuple[str, dict]]:
+        """ Streaming counterpart of stream(): requests streamed responses (see core/wire.py) and yields (uri, line fields)
+            for every line as it arrives from any hospital, until all streams have ended or `deadline` seconds pass.
+            Closing the generator closes the streams still open, e.g. once later docs can no longer enter the top k.
+        """
+        uris = list(uris)
+        start = time.monotonic()
+        out = queue.SimpleQueue()
+        futs = [asyncio.run_coroutine_threadsafe(self._fetch_lines(uri, params, timeout, out), self._loop) for uri in uris]
+        open_uris = set(uris)
+        try:
+            while open_uris:
+                remaining = None if deadline is None else deadline - (time.monotonic() - start)
+                if remaining is not None and remaining <= 0:
+                    break
+                try:
+                    uri, line = out.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if line is None:
+                    open_uris.discard(uri)
+                    continue
+                yield uri, line
+
+            if open_uris:
+                logger.debug(f"Streamed fan-out returned partial results after {time.monotonic() - start:.2f}s, still open={sorted(open_uris)}")
+        finally:
+            for fut in futs:
+                fut.cancel()
+
+    def close(self) -> None:
+        async def _close_sessions():
+            for session in self._sessions.values():
+                await session.close()
+            self._sessions.clear()
+
+        asyncio.run_coroutine_threadsafe(_close_sessions(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+_FANOUT: HospitalFanout | None = None
+_FANOUT_LOCK = threading.Lock()
+
+def get_fanout() -> HospitalFanout:
+    global _FANOUT
+    if _FANOUT is None:
+        with _FANOUT_LOCK:
+            if _FANOUT is None:
+                _FANOUT = HospitalFanout()
+    return _FANOUT
+
+def _reset_fanout_after_fork():
+    # the fan-out loop thread does not survive os.fork() (e.g. eval/scalability), so children start fresh
+    global _FANOUT
+    _FANOUT = None
+
+os.register_at_fork(after_in_child=_reset_fanout_after_fork)
@@ -1,45 +1,160 @@
+import base64
+import math
+import numpy as np
 import pandas as pd
-import json
-import requests
+import os
+import queue
 import time
-import spacy
+from concurrent.futures import ThreadPoolExecutor
 from functools import cached_property
+from threading import Lock
 from langchain_community.document_loaders import DataFrameLoader
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_core.pydantic_v1 import BaseModel
+from langchain_core.pydantic_v1 import BaseModel, PrivateAttr
 from langchain_core.vectorstores import VectorStoreRetriever
 from langchain.schema import BaseRetriever, Document
-from langchain_community.vectorstores import Qdrant
-from py_abac import PDP, AccessRequest
+from py_abac import PDP
 from qdrant_client import QdrantClient
 from qdrant_client.http import models as rest
+from core.abac_cache import pdp_allows, pdp_resource_filter
+from core.embedding_cache import CachedEmbeddings
+from core.fanout import FANOUT_DEADLINE, FANOUT_TIMEOUT, get_fanout
 from core.full_df_loader import AllColumnsDataFrameLoader
+from core.models import LazyEmbeddings, register_model
+from core.ner import get_name_extractor
+from core.qdrant_index import ScoreCone, load_score_cone, sync_qdrant_collection
+from core.result_cache import ResultCache, get_result_cache
+from core.topk import SCORE_UPPER_BOUND, RunningTopK, merge_top_k, top_k
 from core.util import chunk_df, prefix_metadata
 from core.vectorstore_retriever_with_scores import VectorStoreRetrieverWithScores
-from requests.exceptions import HTTPError
 
-from concurrent.futures import ProcessPoolExecutor, as_completed, wait
-
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 import logging
 logger = logging.getLogger("log")
 
 
-CLINICAL_BERT = HuggingFaceEmbeddings(
-    model_name="emilyalsentzer/Bio_ClinicalBERT",
-    model_kwargs={},
-    encode_kwargs={"normalize_embeddings": True},
+CLINICAL_BERT_MODEL = "emilyalsentzer/Bio_ClinicalBERT"
+# backend used to embed queries at search time: "torch" (full-precision ClinicalBERT)
+# or "onnx-int8" (int8-quantized ClinicalBERT on ONNX Runtime, see core/onnx_embeddings.py)
+QUERY_EMBEDDING_BACKEND = "torch"
+
+def _load_clinical_bert():
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(
+        model_name=CLINICAL_BERT_MODEL,
+        model_kwargs={},
+        encode_kwargs={"normalize_embeddings": True},
+    )
+
+def _load_clinical_bert_onnx():
+    from core.onnx_embeddings import OnnxEmbeddings
+    return OnnxEmbeddings(CLINICAL_BERT_MODEL)
+
+# models load on first use (see core/models.py), so importing this module loads no weights
+register_model("clinical_bert", _load_clinical_bert)
+register_model("clinical_bert_onnx_int8", _load_clinical_bert_onnx)
+
+# vectors are cached on disk by text hash, shared by all leaves, hospitals, and the baseline (see core/embedding_cache.py)
+# NOTE: cache hits never load the model
+CLINICAL_BERT = CachedEmbeddings(
+    LazyEmbeddings("clinical_bert"),
+    model_id=f"{CLINICAL_BERT_MODEL}:normalized",
 )
+if QUERY_EMBEDDING_BACKEND == "onnx-int8":
+    from core.onnx_embeddings import QueryBackendEmbeddings
+    CLINICAL_BERT = QueryBackendEmbeddings(document_embedding=CLINICAL_BERT, query_embedding=LazyEmbeddings("clinical_bert_onnx_int8"))
+# identifies the query vectors produced above; a site only reuses a query vector sent by the root if its id matches
+QUERY_EMBEDDING_ID = f"{CLINICAL_BERT_MODEL}:normalized:{QUERY_EMBEDDING_BACKEND}"
 
 # NOTE: very good results, but expensive
 # from langchain_openai import OpenAIEmbeddings
 # CLINICAL_BERT = OpenAIEmbeddings(model='text-embedding-3-small', openai_api_key=OPENAI_KEY)
 
-# NOTE: recreate variables for debug only
-QDRANT_RECREATE = True
+# NOTE: recreate variables for debug only; collections are otherwise updated incrementally (see core/qdrant_index.py)
+QDRANT_RECREATE = False
 QDRANT_BASE_RECREATE = False
 
+ROUTER_MAX_WORKERS = 8  # children of a router searched concurrently (at most one worker per child), 1 to search them sequentially
+# not tied to the cpu count: the workers mostly wait on i/o and on torch, which releases the GIL
+
+
+def gate_allows(
+        gate: Optional[PDP],
+        resource_id: str,
+        resource_metadata: Optional[dict],
+        userinfo: Optional[dict],
+        gate_decisions: Optional[Dict[int, bool]] = None,
+        node_key: Optional[int] = None,
+    ) -> bool:
+    """ "Right to search" check of a retriever's deny-based gate pdp, True if there is no gate.
+        If given, `gate_decisions` (the user's session decisions, see core/gate_cache.py) is consulted
+        and filled in under `node_key`.
+    """
+    if gate is None:
+        return True
+    if gate_decisions is not None and node_key in gate_decisions:
+        return gate_decisions[node_key]
+    gate_req_json = {
+        "subject": {
+            "id": userinfo.get('sub') if userinfo else None,
+            "attributes": userinfo or {},
+        },
+        "resource": {
+            "id": resource_id,
+            "attributes": resource_metadata or None,
+        },
+        "action": {
+            "id": "",
+            "attributes": {"method": "read"}
+        },
+        "context": {}
+    }
+    allowed = pdp_allows(gate, gate_req_json)
+    if gate_decisions is not None:
+        gate_decisions[node_key] = allowed
+    return allowed
+
+def score_bound(retriever: BaseRetriever, query_vector: Optional[List[float]]) -> float:
+    """ Upper bound on the score of any doc `retriever` can return, SCORE_UPPER_BOUND if it can't tell """
+    if hasattr(retriever, "score_bound"):
+        return retriever.score_bound(query_vector)
+    return SCORE_UPPER_BOUND
+
+def tree_pdps(retriever: BaseRetriever) -> Iterator[PDP]:
+    """ Every gate and document pdp in the retriever tree under `retriever` """
+    for pdp in (getattr(retriever, "abac_gate", None), getattr(retriever, "abac_pdp", None)):
+        if pdp is not None:
+            yield pdp
+    for child in getattr(retriever, "children", []):
+        yield from tree_pdps(child)
+
+def encode_query_vector(query_vector: List[float]) -> Dict[str, str]:
+    """ /api/retrieve params carrying a query vector, as base64 float32 (~4KB for ClinicalBERT, vs ~15KB of json) """
+    return {
+        "query_vector": base64.b64encode(np.asarray(query_vector, dtype=np.float32).tobytes()).decode("ascii"),
+        "query_embedding": QUERY_EMBEDDING_ID,
+    }
+
+def embed_queries(queries: List[str]) -> List[List[float]]:
+    """ Vectors of many queries from one batched forward pass, the same vectors CLINICAL_BERT.embed_query returns """
+    if not queries:
+        return []
+    # with a separate query backend (see QueryBackendEmbeddings), queries are embedded by that model
+    embedding = getattr(CLINICAL_BERT, "query_embedding", CLINICAL_BERT)
+    if isinstance(embedding, CachedEmbeddings):  # its query cache, queries stay out of the persistent document cache
+        return embedding.embed_queries(queries)
+    return embedding.embed_documents(queries)
+
+def decode_query_vector(params: Dict[str, str]) -> Optional[List[float]]:
+    """ Query vector sent along with an /api/retrieve request, or None if absent or embedded by a different model """
+    if "query_vector" not in params or params.get("query_embedding") != QUERY_EMBEDDING_ID:
+        return None
+    raw = params["query_vector"]
+    if isinstance(raw, str):  # base64 in json / query strings, raw bytes in msgpack bodies (see core/wire.py)
+        raw = base64.b64decode(raw)
+    return np.frombuffer(raw, dtype=np.float32).tolist()
+
+
 class LeafRetriever(BaseRetriever, BaseModel):
     id: str  # unique identifier
     abac_gate: Optional[PDP] = None  # "right to search": access policies for the entire leaf retriever
@@ -47,9 +162,34 @@ class LeafRetriever(BaseRetriever, BaseModel):
     db_path: str  # where (on the client side) the vector database will be persisted
     df: pd.DataFrame  # data stored by this leaf
     text_col: str | None = None  # if None, this leaf assumed to contain unstructured data, else the column in df containing longform text
+    _build_lock: Lock = PrivateAttr(default_factory=Lock)  # a leaf may be searched from several threads before its index exists
+    _vectorstore_retriever: Optional[VectorStoreRetriever] = PrivateAttr(default=None)  # set once the index is built
+    _score_cone: Optional[ScoreCone] = PrivateAttr(default=None)  # bounds the scores this leaf can return, set when the index is built
 
-    @cached_property
+    def gate_allows(self, userinfo: Optional[dict], gate_decisions: Optional[Dict[int, bool]] = None) -> bool:
+        # keyed on the node object, since ids need not be unique across a tree
+        return gate_allows(self.abac_gate, self.id, self.metadata, userinfo, gate_decisions, node_key=id(self))
+
+    @property
     def vectorstore_retriever(self) -> VectorStoreRetriever:
+        # not a cached_property: before python 3.12 its lock is shared by all instances, which would build leaves one at a time
+        if self._vectorstore_retriever is None:
+            with self._build_lock:
+                if self._vectorstore_retriever is None:  # else built by another thread while we waited
+                    self._vectorstore_retriever = self._build_vectorstore_retriever()
+        return self._vectorstore_retriever
+
+    def index_ready(self) -> bool:
+        """ True once this leaf's index has been built (e.g. by core/warmup.py), i.e. queries won't trigger a build """
+        return self._vectorstore_retriever is not None
+
+    def score_bound(self, query_vector: Optional[List[float]]) -> float:
+        """ Upper bound on the score of any doc this leaf can return for `query_vector` (see ScoreCone) """
+        if query_vector is None or self._score_cone is None:
+            return SCORE_UPPER_BOUND
+        return min(SCORE_UPPER_BOUND, self._score_cone.score_bound(query_vector))
+
+    def _build_vectorstore_retriever(self) -> VectorStoreRetriever:
         if self.text_col:  # split into chunks if this leaf contains unstructured data
             self.df = chunk_df(df=self.df, chunk_col=self.text_col)
             prefix_metadata(df=self.df, chunk_col=self.text_col, metadata_cols=["name"])
@@ -59,16 +199,17 @@ class LeafRetriever(BaseRetriever, BaseModel):
 
         # logger.debug(f"DataFrameLoader returned {len(docs)} docs, first one is:\n{docs[0]}")
         t1 = time.perf_counter(), time.process_time()
-        vs = (
-            Qdrant.from_documents(
-                documents=docs,
-                embedding=CLINICAL_BERT,
-                path=self.db_path,
-                collection_name=f"leaf_{self.id}",
-            )
-            if QDRANT_RECREATE
-            else Qdrant(client=QdrantClient(path=self.db_path), collection_name=f"leaf_{self.id}", embeddings=CLINICAL_BERT)
+        collection_name = f"leaf_{self.id}"
+        score_cone_path = os.path.join(self.db_path, f"{collection_name}.cone.json")
+        vs = sync_qdrant_collection(
+            client=QdrantClient(path=self.db_path),
+            collection_name=collection_name,
+            docs=docs,
+            embedding=CLINICAL_BERT,
+            recreate=QDRANT_RECREATE,
+            score_cone_path=score_cone_path,
         )
+        self._score_cone = load_score_cone(score_cone_path)
         t2 = time.perf_counter(), time.process_time()
 
         with open("qdrant_report.txt", "a") as report:
@@ -79,39 +220,83 @@ class LeafRetriever(BaseRetriever, BaseModel):
             report.write("****************************\n")
 
         return VectorStoreRetrieverWithScores(vectorstore=vs)
-    
-    class Config:
-        keep_untouched = (cached_property,)  # needed to make BaseModel work with cached_property
 
     def _get_relevant_documents(
         self, query: str, search_kwargs: Dict[str, Any], userinfo: dict = None, **kwargs
     ) -> List[Document]:
         logger.debug(f"LEAF RETRIEVER REACHED id={self.id}")
+        searchable, flt = self._search_filter(
+            search_kwargs,
+            userinfo,
+            gate_checked=kwargs.pop("gate_checked", False),
+            gate_decisions=kwargs.pop("gate_decisions", None),
+            ready_only=kwargs.pop("ready_only", False),
+        )
+        if not searchable:
+            return []
 
+        relevant_docs = self.vectorstore_retriever.get_relevant_documents(query=query, filter=flt, k=search_kwargs.get("fetch_k"), **kwargs)
+        # logger.debug(f"\n\nRELEVANT DOCS:\n{relevant_docs}")
+        return self._accessible_top_k(relevant_docs, search_kwargs, userinfo)
+
+    def batch_relevant_documents(self, requests: List[Dict[str, Any]]) -> List[List[Document]]:
+        """ Ranked docs for each of `requests` (the keyword arguments of a get_relevant_documents call each),
+            with the requests that pass the gate searched in one batched vector search
+        """
+        results = [[] for _ in requests]
+        searches = []  # (request index, qdrant filter)
+        for i, request in enumerate(requests):
+            searchable, flt = self._search_filter(
+                request["search_kwargs"],
+                request.get("userinfo"),
+                gate_checked=request.get("gate_checked", False),
+                gate_decisions=request.get("gate_decisions"),
+                ready_only=request.get("ready_only", False),
+            )
+            if searchable:
+                searches.append((i, flt))
+        if not searches:
+            return results
+
+        query_vectors = [requests[i].get("query_vector") for i, _ in searches]
+        missing = [j for j, vector in enumerate(query_vectors) if vector is None]
+        for j, vector in zip(missing, embed_queries([requests[searches[j][0]]["query"] for j in missing])):
+            query_vectors[j] = vector
+
+        doc_lists = self.vectorstore_retriever.get_relevant_documents_batch(
+            query_vectors,
+            filters=[flt for _, flt in searches],
+            ks=[requests[i]["search_kwargs"].get("fetch_k") or 4 for i, _ in searches],
+        )
+        # requests of the same user share their pdp decisions through the CachedPDPs, so each doc is only checked once per user
+        for (i, _), relevant_docs in zip(searches, doc_lists):
+            results[i] = self._accessible_top_k(relevant_docs, requests[i]["search_kwargs"], requests[i].get("userinfo"))
+        return results
+
+    def _search_filter(
+        self,
+        search_kwargs: Dict[str, Any],
+        userinfo: Optional[dict],
+        gate_checked: bool = False,
+        gate_decisions: Optional[Dict[int, bool]] = None,
+        ready_only: bool = False,
+    ) -> Tuple[bool, Optional[rest.Filter]]:
+        """ (whether to search at all, qdrant filter of the search) for a request """
         # NOTE: for evaluation only, do not use abac if search_kwargs["secure"] == False
         secure = search_kwargs.get("secure", True)
 
         # deny-based pdp at the start here too, to avoid searching relevant docs in leaf retrievers we can't access
-        router_req_json = {
-            "subject": {
-                "id": userinfo.get('sub') if userinfo else None,
-                "attributes": userinfo or {},
-            },
-            "resource": {
-                "id": self.id,
-                "attributes": self.metadata or None,
-            },
-            "action": {
-                "id": "",
-                "attributes": {"method": "read"}
-            },
-            "context": {}
-        }
-        if secure and self.abac_gate and not self.abac_gate.is_allowed(AccessRequest.from_json(router_req_json)):
+        # (skipped if the parent router already checked this leaf's gate before dispatching to it)
+        if secure and not gate_checked and not self.gate_allows(userinfo, gate_decisions):
             logger.debug(f"DENIED @ {self.id}! userinfo: {userinfo}")
-            return []
+            return False, None
         logger.debug(f"ALLOWED @ {self.id}! userinfo: {userinfo}")
 
+        # with ready_only, a leaf still warming up answers with nothing instead of building its index inside the query
+        if ready_only and not self.index_ready():
+            logger.debug(f"WARMING @ {self.id}, skipped")
+            return False, None
+
         # passed gate; perform retrieval
         flt = (
             rest.Filter(
@@ -127,129 +312,392 @@ class LeafRetriever(BaseRetriever, BaseModel):
             else None
         )
 
-        relevant_docs = self.vectorstore_retriever.get_relevant_documents(query=query, filter=flt, k=search_kwargs.get("fetch_k"), **kwargs)
-        # logger.debug(f"\n\nRELEVANT DOCS:\n{relevant_docs}")
-        if not secure or not self.abac_pdp:
-            return sorted(relevant_docs, key = lambda d : d.metadata["score"], reverse=True)[:search_kwargs["k"]]
-
-        accessible_relevant_docs = []
-        for doc in relevant_docs:
-            req_json = {
+        # only search points the user may retrieve, with the resource conditions of abac_pdp compiled into a qdrant filter
+        # (the per-document pdp check in _accessible_top_k stays as a safety net, since the compiled filter may be broader)
+        if secure and self.abac_pdp:
+            policy_filter = pdp_resource_filter(self.abac_pdp, {
                 "subject": {
                     "id": "",
                     "attributes": userinfo or {},
                 },
                 "resource": {
                     "id": "",
-                    "attributes": doc.metadata,
+                    "attributes": {},
                 },
                 "action": {
                     "id": "",
                     "attributes": {"method": "read"}
                 },
                 "context": {}
-            }
-            request = AccessRequest.from_json(req_json)
-            if self.abac_pdp.is_allowed(request):
-                # logger.debug(f"ALLOW_DOC: {doc.metadata}")
-                doc.metadata.update(self.metadata or {})  # add leaf retriever's metadata to document metadata
-                accessible_relevant_docs.append(doc)
-            # else:
-                # logger.debug(f"DENY_DOC: {doc.metadata}")
-
-        return sorted(accessible_relevant_docs, key = lambda d : d.metadata["score"], reverse=True)[:search_kwargs["k"]]
+            })
+            if not policy_filter.permits_any:
+                logger.debug(f"NO PERMITTED DOCS @ {self.id}! userinfo: {userinfo}")
+                return False, None
+            if policy_filter.filter is not None:
+                flt = policy_filter.filter if flt is None else rest.Filter(must=[flt, policy_filter.filter])
+        return True, flt
+
+    def _accessible_top_k(self, relevant_docs: List[Document], search_kwargs: Dict[str, Any], userinfo: Optional[dict]) -> List[Document]:
+        if not search_kwargs.get("secure", True) or not self.abac_pdp:
+            return top_k(relevant_docs, search_kwargs["k"])
+
+        def accessible_relevant_docs():
+            for doc in relevant_docs:
+                req_json = {
+                    "subject": {
+                        "id": "",
+                        "attributes": userinfo or {},
+                    },
+                    "resource": {
+                        "id": "",
+                        "attributes": doc.metadata,
+                    },
+                    "action": {
+                        "id": "",
+                        "attributes": {"method": "read"}
+                    },
+                    "context": {}
+                }
+                if pdp_allows(self.abac_pdp, req_json):  # memoized if abac_pdp is a CachedPDP
+                    # logger.debug(f"ALLOW_DOC: {doc.metadata}")
+                    doc.metadata.update(self.metadata or {})  # add leaf retriever's metadata to document metadata
+                    yield doc
+                # else:
+                    # logger.debug(f"DENY_DOC: {doc.metadata}")
+
+        # vector search returns docs in descending score order, so per-document ABAC checks stop once k docs are accessible
+        return merge_top_k([accessible_relevant_docs()], search_kwargs["k"])
 
 
 class RouterRetriever(BaseRetriever, BaseModel):
     id: str
     children: List[BaseRetriever]  # contains LeafRetrievers or RouterRetrievers, depending on level
     abac_gate: Optional[PDP] = None  # each retriever manages its own deny-based pdp and should return docs=[] if denied (rather than managing access for its children)
+    max_workers: int = ROUTER_MAX_WORKERS  # children searched concurrently, 1 to search them sequentially
+
+    def gate_allows(self, userinfo: Optional[dict], gate_decisions: Optional[Dict[int, bool]] = None) -> bool:
+        # keyed on the node object, since ids need not be unique across a tree
+        return gate_allows(self.abac_gate, self.id, self.metadata, userinfo, gate_decisions, node_key=id(self))
+
+    def score_bound(self, query_vector: Optional[List[float]]) -> float:
+        """ Upper bound on the score of any doc this subtree can return for `query_vector` """
+        return max((score_bound(child, query_vector) for child in self.children), default=-math.inf)
 
     def _get_relevant_documents(
         self, query: str, search_kwargs: Dict[str, Any], userinfo: dict = None, **kwargs
     ) -> List[Document]:
+        # Merge to top K documents by similarity score across all leaves
+        # NOTE: we assume that cross-retriever similarity scores can be compared
+        # as long as we use the same embedding scheme (ClinicalBERT) for all
+        leaf_docs = (docs for docs, _ in self.stream_relevant_documents(query=query, search_kwargs=search_kwargs, userinfo=userinfo, **kwargs))
+        return merge_top_k(leaf_docs, search_kwargs["k"])
+
+    def stream_relevant_documents(
+        self, query: str, search_kwargs: Dict[str, Any], userinfo: dict = None, **kwargs
+    ) -> Iterator[Tuple[List[Document], float]]:
+        """ Yields (ranked docs, bound) as each leaf of this subtree finishes its search, where `bound` is an upper bound
+            on the score of any doc yielded after it. The last item has bound -inf (an item is always yielded).
+            Closing the generator early abandons the searches still running.
+        """
         # NOTE: for evaluation only, do not use abac if search_kwargs["secure"] == False
         secure = search_kwargs.get("secure", True)
 
-        # create request json based on requesting user's info, match against abac_pdp
-        router_req_json = {
-            "subject": {
-                "id": userinfo.get('sub') if userinfo else None,
-                "attributes": userinfo or {},
-            },
-            "resource": {
-                "id": self.id,
-                "attributes": self.metadata or None,
-            },
-            "action": {
-                "id": "",
-                "attributes": {"method": "read"}
-            },
-            "context": {}
-        }
-        if secure and self.abac_gate and not self.abac_gate.is_allowed(AccessRequest.from_json(router_req_json)):
+        # match requesting user's info against the gate pdp (skipped if the parent router already checked it)
+        gate_checked = kwargs.pop("gate_checked", False)
+        gate_decisions = kwargs.get("gate_decisions")  # the user's cached gate decisions, passed on to children
+        if secure and not gate_checked and not self.gate_allows(userinfo, gate_decisions):
             logger.debug(f"DENIED @ {self.id}! userinfo: {userinfo}")
-            return []
+            yield [], -math.inf
+            return
 
         logger.debug(f"ALLOWED @ {self.id}! userinfo: {userinfo}")
-        docs = []
-        for child in self.children:
-            docs.extend(child.get_relevant_documents(query=query, userinfo=userinfo, search_kwargs=search_kwargs, **kwargs))
 
-        # Truncate to top K documents by similarity score across all children retrievers
-        # NOTE: we assume that cross-retriever similarity scores can be compared
-        # as long as we use the same embedding scheme (ClinicalBERT) for all
-        return sorted(docs, key = lambda d : d.to_json()["kwargs"]["metadata"]["score"], reverse=True)[:search_kwargs["k"]]
+        # check children's gates here, so denied children short-circuit without taking a worker or embedding the query
+        children = [
+            child for child in self.children
+            if not secure or not hasattr(child, "gate_allows") or child.gate_allows(userinfo, gate_decisions)
+        ]
+        if not children:
+            yield [], -math.inf
+            return
+
+        # embed the query once for the whole subtree; leaves (and nested routers) search with this vector
+        # instead of each re-embedding the query. A vector may already come from a parent router or the root.
+        if kwargs.get("query_vector") is None:
+            kwargs["query_vector"] = CLINICAL_BERT.embed_query(query)
+        bounds = [score_bound(child, kwargs["query_vector"]) for child in children]  # per child, lowered as it reports
+
+        def search(child) -> Iterator[Tuple[List[Document], float]]:
+            child_kwargs = dict(query=query, userinfo=userinfo, search_kwargs=search_kwargs, gate_checked=secure, **kwargs)
+            if isinstance(child, RouterRetriever):
+                yield from child.stream_relevant_documents(**child_kwargs)
+            else:
+                yield child.get_relevant_documents(**child_kwargs), -math.inf
+
+        n_workers = min(self.max_workers, len(children))
+        if n_workers <= 1:
+            for i, child in enumerate(children):
+                for docs, bound in search(child):
+                    bounds[i] = bound
+                    yield docs, max(bounds)
+            return
+
+        # each router gets its own short-lived pool, so nested routers never wait on workers held by their parent
+        results = queue.SimpleQueue()  # (child index, docs or the exception raised, child's bound)
+
+        def run(i, child):
+            try:
+                for docs, bound in search(child):
+                    results.put((i, docs, bound))
+            except Exception as e:
+                results.put((i, e, -math.inf))
+
+        executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix=f"router-{self.id}")
+        try:
+            for i, child in enumerate(children):
+                executor.submit(run, i, child)
+            n_done = 0
+            while n_done < len(children):
+                i, docs, bound = results.get()
+                if isinstance(docs, Exception):
+                    raise docs
+                bounds[i] = bound
+                n_done += bound == -math.inf
+                yield docs, max(bounds)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def batch_relevant_documents(self, requests: List[Dict[str, Any]]) -> List[List[Document]]:
+        """ Ranked docs for each of `requests` (the keyword arguments of a get_relevant_documents call each),
+            with the queries embedded in one batch and each child searched once for all the requests it may serve
+        """
+        # drop requests denied by this router's gate, and embed the remaining queries that come without a vector
+        requests = list(requests)
+        allowed = [
+            i for i, request in enumerate(requests)
+            if not request["search_kwargs"].get("secure", True) or request.get("gate_checked", False)
+            or self.gate_allows(request.get("userinfo"), request.get("gate_decisions"))
+        ]
+        missing = [i for i in allowed if requests[i].get("query_vector") is None]
+        for i, query_vector in zip(missing, embed_queries([requests[i]["query"] for i in missing])):
+            requests[i] = requests[i] | {"query_vector": query_vector}
+
+        # check children's gates here, so each child only gets the requests it may serve
+        child_requests = [[] for _ in self.children]  # per child, [(request index, request)]
+        for i in allowed:
+            request = requests[i]
+            secure = request["search_kwargs"].get("secure", True)
+            for child, batch in zip(self.children, child_requests):
+                if not secure or not hasattr(child, "gate_allows") or child.gate_allows(request.get("userinfo"), request.get("gate_decisions")):
+                    batch.append((i, request | {"gate_checked": secure}))
+
+        def search(child, batch):
+            if hasattr(child, "batch_relevant_documents"):
+                return child.batch_relevant_documents([request for _, request in batch])
+            return [child.get_relevant_documents(**request) for _, request in batch]
+
+        searches = [(child, batch) for child, batch in zip(self.children, child_requests) if batch]
+        n_workers = min(self.max_workers, len(searches))
+        if n_workers <= 1:
+            child_results = [search(child, batch) for child, batch in searches]
+        else:
+            with ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix=f"router-{self.id}") as executor:
+                child_results = list(executor.map(lambda child_batch: search(*child_batch), searches))
+
+        doc_lists = [[] for _ in requests]  # per request, one ranked list per child that served it
+        for (_, batch), results in zip(searches, child_results):
+            for (i, _), docs in zip(batch, results):
+                doc_lists[i].append(docs)
+        return [merge_top_k(lists, request["search_kwargs"]["k"]) for lists, request in zip(doc_lists, requests)]
+
+
+def batch_retrieve_uri(retrieve_uri: str) -> str:
+    """ The /api/retrieve_batch endpoint next to a hospital's /api/retrieve """
+    return retrieve_uri.rsplit("/", 1)[0] + "/retrieve_batch"
 
 
 class RootRetriever(BaseRetriever, BaseModel):
     hospital_retrieve_uris: List[str]
     userinfo: dict
     search_kwargs: Dict[str, Any]
-
-    def _retrieve(self, retrieve_uri, params):
-        print(f"PARALLEL RETRIEVE: {retrieve_uri}")
-        try:
-            resp = requests.get(retrieve_uri, params=params)
-            resp.raise_for_status()
-            resp_json = resp.json()
-            return resp_json.get("docs", [])
-        except HTTPError as e:
-            logger.debug(f"HTTPError retrieve_uri={retrieve_uri}: {e}")
-        except:
-            logger.debug(f"Error occurred retrieve_uri={retrieve_uri}")
-
+    timeout: Optional[float] = FANOUT_TIMEOUT  # per-hospital timeout (seconds), None to wait indefinitely
+    deadline: Optional[float] = FANOUT_DEADLINE  # latency SLO (seconds): answer with whichever hospitals responded by then
+    hospital_replicas: Dict[str, List[str]] = {}  # { retrieve uri : [replica retrieve uris] } for hedged requests
+    hedge_after: Optional[float] = None  # re-issue requests to replicas of hospitals that haven't responded after this many seconds
+    send_query_vector: bool = False  # embed the query here and send the vector, so sites using the same embedding skip re-encoding
+    metadata_keys: Optional[List[str]] = None  # doc metadata hospitals send back (the score always is), None for all of it
+    stream_results: bool = False  # merge docs as each hospital leaf finishes, and stop once no later doc can enter the top k (no hedging)
+    cache_results: bool = False  # answer repeated queries from the process-wide result cache when users' access is the same
+    semantic_cache_threshold: Optional[float] = None  # with cache_results, also answer queries this cosine-similar to a cached one
+    ready_only: bool = False  # hospitals skip leaves still warming up instead of waiting for their indexes (partial, faster answers)
 
     def _get_relevant_documents(
         self, query: str, **kwargs
     ) -> List[Document]:
-        t1 = time.perf_counter(), time.process_time()
-        docs = []
-        self.search_kwargs["filters"] = {}  # for qdrant filtering, { doc attribute : [list of possible values]} e.g. { "name" : ["Edward Fisher", "Janet Aguilar"]}
+        return self.retrieve(query)["documents"]
 
+    def retrieve(self, query: str) -> Dict[str, Any]:
+        """ {"documents": top k docs, "missing_sites": hospitals that did not respond (i.e. a partial answer)} for `query`.
+            Everything is per call, so concurrent queries on one retriever each get their own missing sites
+        """
+        t1 = time.perf_counter(), time.process_time()
+        # for qdrant filtering, { doc attribute : [list of possible values]} e.g. { "name" : ["Edward Fisher", "Janet Aguilar"]}
         # use spacy's ner to detect queries about specific people
-        ner = spacy.load("en_core_web_sm")
-        names = [(ent.text[:ent.text.rfind("'")] if "'" in ent.text else ent.text) for ent in ner(query).ents if ent.label_ == "PERSON"]
-        if names:
-            # logger.debug(f"names detected in query: {names}")
-            self.search_kwargs["filters"]["name"] = names
+        names = get_name_extractor().extract(query)
+        search_kwargs = self.search_kwargs | {"filters": ({"name": names} if names else {})}
+
+        # repeats of a query by users with the same access skip the fan-out, see core/result_cache.py
+        cache = get_result_cache() if self.cache_results else None
+        query_vector = None
+        if cache is not None and self.semantic_cache_threshold is not None:  # paraphrases are found by the query embedding
+            query_vector = CLINICAL_BERT.embed_query(query)
+        final_k = None
+        if cache is not None:
+            key = cache.key(query, self.userinfo, search_kwargs, self.hospital_retrieve_uris, self.metadata_keys)
+            final_k = cache.get(key, query_vector, self.semantic_cache_threshold)
+        if final_k is not None:
+            logger.debug(f"Result cache hit: {query!r}")
+            missing_sites = []
+        else:
+            # fan out to all hospitals over pooled keep-alive connections, collecting docs as each one responds
+            params = {'query': query, 'userinfo': self.userinfo, 'search_kwargs': search_kwargs, 'ready_only': self.ready_only}
+            if self.metadata_keys is not None:
+                params['metadata_keys'] = self.metadata_keys
+            if self.send_query_vector:
+                params.update(encode_query_vector(query_vector if query_vector is not None else CLINICAL_BERT.embed_query(query)))
+            if self.stream_results:
+                final_k, hosp_fields, missing_sites = self._stream_top_k(params)
+            else:
+                final_k, hosp_fields, missing_sites = self._fanout_top_k(params)
+            if cache is not None:
+                self._cache_result(cache, query, self.userinfo, search_kwargs, final_k, hosp_fields, missing_sites, query_vector)
+        t2 = time.perf_counter(), time.process_time()
+
+        with open("retrieval_report.txt", "a") as report:
+            report.write("****************************\n")
+            report.write(f"N_URIS={len(self.hospital_retrieve_uris)}\n")
+            report.write(f"Real time: {t2[0] - t1[0]:.2f} seconds\n")
+            report.write(f"CPU time: {t2[1] - t1[1]:.2f} seconds\n")
+            report.write("****************************\n")
 
-        retrieve_futs = []
-        with ProcessPoolExecutor() as executor:
-            params = {'query': query, 'userinfo': json.dumps(self.userinfo), 'search_kwargs': json.dumps(self.search_kwargs)}
-            for retrieve_uri in self.hospital_retrieve_uris:
-                retrieve_futs.append(executor.submit(self._retrieve, retrieve_uri, params))
-            # for fut in as_completed(retrieve_futs):
-            done, not_done = wait(retrieve_futs)
-            while len(done) > 0:
-                fut = done.pop()
-                docs.extend(fut.result())
-            # executor.shutdown()
-
-        # Truncate to top K documents by similarity score across all children retrievers
+        logger.debug(f"\n\nFINAL K DOCS:\n{final_k}")
+        return {"documents": final_k, "missing_sites": missing_sites}
+
+    def _fanout_top_k(self, params: Dict[str, Any]) -> Tuple[List[dict], Dict[str, dict], List[str]]:
+        # returns the merged top k, the other response fields of each hospital that responded, and the hospitals that didn't
+        hosp_doc_lists = []  # one ranked list per hospital
+        hosp_fields = {}
+        for retrieve_uri, resp_fields in get_fanout().stream(
+                self.hospital_retrieve_uris,
+                params,
+                timeout=self.timeout,
+                deadline=self.deadline,
+                replicas=self.hospital_replicas,
+                hedge_after=self.hedge_after,
+                field=None,
+            ):
+            hosp_docs = resp_fields.pop("docs", [])
+            logger.debug(f"{retrieve_uri} returned {len(hosp_docs)} docs")
+            hosp_fields[retrieve_uri] = resp_fields
+            hosp_doc_lists.append(hosp_docs)
+        missing_sites = [uri for uri in self.hospital_retrieve_uris if uri not in hosp_fields]
+        if missing_sites:
+            logger.debug(f"Answering with partial results, missing hospitals: {missing_sites}")
+
+        # Merge to top K documents by similarity score across all hospitals
         # NOTE: we assume that cross-retriever similarity scores can be compared
         # as long as we use the same embedding scheme (ClinicalBERT) for all
-        final_k = sorted(docs, key = lambda d : d["kwargs"]["metadata"]["score"], reverse=True)[:self.search_kwargs["k"]]
+        return merge_top_k(hosp_doc_lists, self.search_kwargs["k"]), hosp_fields, missing_sites
+
+    def _stream_top_k(self, params: Dict[str, Any]) -> Tuple[List[dict], Dict[str, dict], List[str]]:
+        top = RunningTopK(self.search_kwargs["k"])
+        bounds = {uri: SCORE_UPPER_BOUND for uri in self.hospital_retrieve_uris}  # best score each hospital may still send
+        hosp_fields = {}  # fields of each hospital's first line, besides docs and bound
+        lines = get_fanout().stream_lines(self.hospital_retrieve_uris, params, timeout=self.timeout, deadline=self.deadline)
+        try:
+            for retrieve_uri, line in lines:
+                top.add(line["docs"])
+                bounds[retrieve_uri] = line["bound"]
+                hosp_fields.setdefault(retrieve_uri, {name: value for name, value in line.items() if name not in ("docs", "bound")})
+                if line.get("warming"):
+                    logger.debug(f"{retrieve_uri} answered without leaves still warming up: {line['warming']}")
+                if top.beats(max(bounds.values())):
+                    break
+        finally:
+            lines.close()  # closes the streams still open
+
+        cut_off = [uri for uri, bound in bounds.items() if bound != -math.inf and top.beats(bound)]
+        if cut_off:
+            logger.debug(f"Closed streams early, no later doc could enter the top k: {cut_off}")
+        missing_sites = [uri for uri, bound in bounds.items() if bound != -math.inf and not top.beats(bound)]
+        if missing_sites:
+            logger.debug(f"Answering with partial results, missing hospitals: {missing_sites}")
+        return top.result(), hosp_fields, missing_sites
+
+    def _cache_result(
+            self,
+            cache: ResultCache,
+            query: str,
+            userinfo: dict,
+            search_kwargs: Dict[str, Any],
+            docs: List[dict],
+            hosp_fields: Dict[str, dict],
+            missing_sites: List[str],
+            query_vector: Optional[List[float]] = None,
+        ) -> None:
+        for retrieve_uri, fields in hosp_fields.items():
+            cache.observe(retrieve_uri, fields.get("cache"))
+        # only complete results are cached: every hospital answered, without leaves still warming up
+        if missing_sites or len(hosp_fields) < len(self.hospital_retrieve_uris) or any(fields.get("warming") for fields in hosp_fields.values()):
+            return
+        versions = {retrieve_uri: (fields.get("cache") or {}).get("version") for retrieve_uri, fields in hosp_fields.items()}
+        if None in versions.values():  # hospitals that don't report a version could never invalidate the entry
+            return
+        # keyed again, the hospitals may have just reported which userinfo attributes their results depend on
+        cache.put(cache.key(query, userinfo, search_kwargs, self.hospital_retrieve_uris, self.metadata_keys), docs, versions, query_vector)
+
+    def retrieve_batch(self, queries: List[str], userinfos: Optional[List[dict]] = None) -> List[Dict[str, Any]]:
+        """ retrieve() for each of `queries`, for the matching user in `userinfos` (this retriever's userinfo by default).
+            Queries the result cache answers are served from it, the others go out in one /api/retrieve_batch request per hospital
+            instead of one /api/retrieve request per query
+        """
+        t1 = time.perf_counter(), time.process_time()
+        queries = list(queries)
+        userinfos = userinfos if userinfos is not None else [self.userinfo] * len(queries)
+        search_kwargs_list = [
+            self.search_kwargs | {"filters": ({"name": names} if names else {})}
+            for names in get_name_extractor().extract_names(queries)
+        ]
+        cache = get_result_cache() if self.cache_results else None
+        semantic = cache is not None and self.semantic_cache_threshold is not None
+        query_vectors = embed_queries(queries) if self.send_query_vector or semantic else [None] * len(queries)
+        cache_vectors = query_vectors if semantic else [None] * len(queries)
+
+        results: List[Optional[Dict[str, Any]]] = [None] * len(queries)
+        if cache is not None:
+            for i, (query, userinfo, search_kwargs) in enumerate(zip(queries, userinfos, search_kwargs_list)):
+                key = cache.key(query, userinfo, search_kwargs, self.hospital_retrieve_uris, self.metadata_keys)
+                docs = cache.get(key, cache_vectors[i], self.semantic_cache_threshold)
+                if docs is not None:
+                    results[i] = {"documents": docs, "missing_sites": []}
+        pending = [i for i, result in enumerate(results) if result is None]
+        logger.debug(f"Batch of {len(queries)} queries, {len(queries) - len(pending)} answered by the result cache")
+
+        if pending:
+            requests = []
+            for i in pending:
+                request = {'query': queries[i], 'userinfo': userinfos[i], 'search_kwargs': search_kwargs_list[i]}
+                if self.send_query_vector:
+                    request.update(encode_query_vector(query_vectors[i]))
+                requests.append(request)
+            params = {'requests': requests, 'ready_only': self.ready_only}
+            if self.metadata_keys is not None:
+                params['metadata_keys'] = self.metadata_keys
+            doc_lists, hosp_fields, missing_sites = self._fanout_batch(params)
+            for i, docs in zip(pending, doc_lists):
+                results[i] = {"documents": docs, "missing_sites": missing_sites}
+                if cache is not None:
+                    self._cache_result(cache, queries[i], userinfos[i], search_kwargs_list[i], docs, hosp_fields, missing_sites, cache_vectors[i])
         t2 = time.perf_counter(), time.process_time()
 
         with open("retrieval_report.txt", "a") as report:
@@ -257,10 +705,39 @@ class RootRetriever(BaseRetriever, BaseModel):
             report.write(f"N_URIS={len(self.hospital_retrieve_uris)}\n")
             report.write(f"Real time: {t2[0] - t1[0]:.2f} seconds\n")
             report.write(f"CPU time: {t2[1] - t1[1]:.2f} seconds\n")
+            report.write(f"N_QUERIES={len(queries)} (batch, {len(pending)} fanned out)\n")
             report.write("****************************\n")
-
-        logger.debug(f"\n\nFINAL K DOCS:\n{final_k}")
-        return final_k
+        return results
+
+    def _fanout_batch(self, params: Dict[str, Any]) -> Tuple[List[List[dict]], Dict[str, dict], List[str]]:
+        # like _fanout_top_k for /api/retrieve_batch: merged top k per request, response fields per hospital, missing hospitals
+        batch_uris = {uri: batch_retrieve_uri(uri) for uri in self.hospital_retrieve_uris}
+        batch_replicas = {
+            batch_uris[uri]: [batch_retrieve_uri(replica) for replica in replicas]
+            for uri, replicas in self.hospital_replicas.items() if uri in batch_uris
+        }
+        retrieve_uris = {batch_uri: uri for uri, batch_uri in batch_uris.items()}
+        hosp_results = []  # per hospital, one ranked list per request
+        hosp_fields = {}  # keyed by retrieve uri, like the result cache
+        for batch_uri, resp_fields in get_fanout().stream(
+                batch_uris.values(),
+                params,
+                timeout=self.timeout,
+                deadline=self.deadline,
+                replicas=batch_replicas,
+                hedge_after=self.hedge_after,
+                field=None,
+            ):
+            results = resp_fields.pop("results", [])
+            logger.debug(f"{batch_uri} returned docs for {len(results)} queries")
+            hosp_fields[retrieve_uris[batch_uri]] = resp_fields
+            hosp_results.append(results)
+        missing_sites = [uri for uri in self.hospital_retrieve_uris if uri not in hosp_fields]
+        if missing_sites:
+            logger.debug(f"Answering with partial results, missing hospitals: {missing_sites}")
+
+        n_requests = len(params['requests'])
+        return [merge_top_k([results[i] for results in hosp_results], self.search_kwargs["k"]) for i in range(n_requests)], hosp_fields, missing_sites
 
 
 """
@@ -277,15 +754,12 @@ class BaselineRetriever(BaseRetriever, BaseModel):
 
     @cached_property
     def vectorstore_retriever(self) -> VectorStoreRetriever:
-        vs = (
-            Qdrant.from_documents(
-                documents=self.docs,
-                embedding=CLINICAL_BERT,
-                path=self.db_path,
-                collection_name=f"baseline",
-            )
-            if QDRANT_BASE_RECREATE
-            else Qdrant(client=QdrantClient(path=self.db_path), collection_name="baseline", embeddings=CLINICAL_BERT)
+        vs = sync_qdrant_collection(
+            client=QdrantClient(path=self.db_path),
+            collection_name="baseline",
+            docs=self.docs,
+            embedding=CLINICAL_BERT,
+            recreate=QDRANT_BASE_RECREATE,
         )
 
         return VectorStoreRetrieverWithScores(vectorstore=vs)
@@ -298,29 +772,13 @@ class BaselineRetriever(BaseRetriever, BaseModel):
     ) -> List[Document]:
         # should be the same method as leaf retriever
         # deny-based pdp at the start here too, to avoid searching relevant docs in leaf retrievers we can't access
-        router_req_json = {
-            "subject": {
-                "id": userinfo.get('sub') if userinfo else None,
-                "attributes": userinfo or {},
-            },
-            "resource": {
-                "id": "baseline",
-                "attributes": self.metadata or None,
-            },
-            "action": {
-                "id": "",
-                "attributes": {"method": "read"}
-            },
-            "context": {}
-        }
-        if self.abac_gate and not self.abac_gate.is_allowed(AccessRequest.from_json(router_req_json)):
+        if not gate_allows(self.abac_gate, "baseline", self.metadata, userinfo):
             logger.debug(f"DENIED! userinfo: {userinfo}")
             return []
-        
+
         self.search_kwargs["filters"] = {}  # for qdrant filtering, { doc attribute : [list of possible values]} e.g. { "name" : ["Edward Fisher", "Janet Aguilar"]}
         # use spacy's ner to detect queries about specific people
-        ner = spacy.load("en_core_web_sm")
-        names = [(ent.text[:ent.text.rfind("'")] if "'" in ent.text else ent.text) for ent in ner(query).ents if ent.label_ == "PERSON"]
+        names = get_name_extractor().extract(query)
         if names:
             logger.debug(f"names detected in query: {names}")
             self.search_kwargs["filters"]["name"] = names
@@ -343,32 +801,30 @@ class BaselineRetriever(BaseRetriever, BaseModel):
         relevant_docs = self.vectorstore_retriever.get_relevant_documents(query=query, filter=flt, k=self.search_kwargs.get("fetch_k"), **kwargs)
         # logger.debug(f"\n\nRELEVANT DOCS:\n{relevant_docs}")
         if not self.abac_pdp:
-             relevant_docs = sorted(relevant_docs, key = lambda d : d.metadata["score"], reverse=True)
-             return [d.to_json() for d in relevant_docs][:self.search_kwargs["k"]]
-
-        accessible_relevant_docs = []
-        for doc in relevant_docs:
-            req_json = {
-                "subject": {
-                    "id": "",
-                    "attributes": userinfo or {},
-                },
-                "resource": {
-                    "id": "",
-                    "attributes": doc.metadata,
-                },
-                "action": {
-                    "id": "",
-                    "attributes": {"method": "read"}
-                },
-                "context": {}
-            }
-            request = AccessRequest.from_json(req_json)
-            if self.abac_pdp.is_allowed(request):
-                doc.metadata.update(self.metadata or {})  # add leaf retriever's metadata to document metadata
-                accessible_relevant_docs.append(doc)
-
-        accessible_relevant_docs = sorted(accessible_relevant_docs, key = lambda d : d.metadata["score"], reverse=True)
-        final_k = [d.to_json() for d in accessible_relevant_docs][:self.search_kwargs["k"]]
+            return [d.to_json() for d in top_k(relevant_docs, self.search_kwargs["k"])]
+
+        def accessible_relevant_docs():
+            for doc in relevant_docs:
+                req_json = {
+                    "subject": {
+                        "id": "",
+                        "attributes": userinfo or {},
+                    },
+                    "resource": {
+                        "id": "",
+                        "attributes": doc.metadata,
+                    },
+                    "action": {
+                        "id": "",
+                        "attributes": {"method": "read"}
+                    },
+                    "context": {}
+                }
+                if pdp_allows(self.abac_pdp, req_json):  # memoized if abac_pdp is a CachedPDP
+                    doc.metadata.update(self.metadata or {})  # add leaf retriever's metadata to document metadata
+                    yield doc
+
+        # vector search returns docs in descending score order, so per-document ABAC checks stop once k docs are accessible
+        final_k = [d.to_json() for d in merge_top_k([accessible_relevant_docs()], self.search_kwargs["k"])]
         logger.debug(f"\n\nFINAL K DOCS:\n{final_k}")
         return final_k
\ No newline at end of file
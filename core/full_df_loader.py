@@ -3,6 +3,8 @@ from typing import Iterator, List, Optional, Sequence
 from langchain_community.document_loaders.base import BaseLoader
 from langchain_core.documents import Document
 
+LOADER_BATCH_SIZE = 10000  # rows formatted and turned into Documents at a time
+
 """
 Example format for page_content:
 'note_id: 10000935-DS-21\nsubject_id: 10000935\nhadm_id: 25849114\ntext: above.\n(11) Depression: She appeared depressed...\ntext_index: 46'
@@ -18,6 +20,7 @@ class AllColumnsDataFrameLoader(BaseLoader):
         data_frame: pd.DataFrame,
         source_column: Optional[str] = None,
         metadata_columns: Sequence[str] = (),
+        batch_size: int = LOADER_BATCH_SIZE,
     ):
         """Initialize with dataframe object.
 
@@ -26,39 +29,46 @@ class AllColumnsDataFrameLoader(BaseLoader):
             source_column: The name of the column in the CSV file to use as the source.
               Optional. Defaults to None.
             metadata_columns: A sequence of column names to use as metadata. Optional.
+            batch_size: Number of rows formatted at a time while lazy loading. Optional.
         """
         self.data_frame = data_frame
         self.source_column = source_column
         self.metadata_columns = metadata_columns
+        self.batch_size = batch_size
 
     def lazy_load(self) -> Iterator[Document]:
-        """Lazy load records from dataframe."""
+        """Lazy load records from dataframe, formatting `batch_size` rows at a time column-wise."""
+        if self.source_column is not None and self.source_column not in self.data_frame.columns:
+            raise ValueError(
+                f"Source column '{self.source_column}' not found in CSV file."
+            )
+        for col in self.metadata_columns:
+            if col not in self.data_frame.columns:
+                raise ValueError(f"Metadata column '{col}' not found in CSV file.")
+
+        # one "{column}: {value}" line per non-metadata column, filled per row with str.format
+        content_columns = [col for col in self.data_frame.columns if col not in self.metadata_columns]
+        content_format = "\n".join(
+            str(col).replace("{", "{{").replace("}", "}}") + ": {}" for col in content_columns
+        )
 
-        for i, row in self.data_frame.iterrows():  # TODO itertuples for perf?
-            try:
-                source = (
-                    row[self.source_column]
-                    if self.source_column is not None
-                    else "DataFrame"
-                )
-            except KeyError:
-                raise ValueError(
-                    f"Source column '{self.source_column}' not found in CSV file."
-                )
-            text = "\n".join(
-                f"{k}: {v}"
-                for k, v in zip(row.index, row.values.tolist())
-                if k not in self.metadata_columns
+        for start in range(0, len(self.data_frame), self.batch_size):
+            batch = self.data_frame.iloc[start:start + self.batch_size]
+            texts = [content_format.format(*values) for values in zip(*(batch[col].tolist() for col in content_columns))]
+            sources = (
+                batch[self.source_column].tolist()
+                if self.source_column is not None
+                else ["DataFrame"] * len(batch)
             )
+            metadata_values = {col: batch[col].tolist() for col in self.metadata_columns}
 
-            metadata = {"source": source, "row": i}
-            for col in self.metadata_columns:
-                try:
-                    metadata[col] = row[col]
-                except KeyError:
-                    raise ValueError(f"Metadata column '{col}' not found in CSV file.")
-                
-            yield Document(page_content=text, metadata=metadata)
+            docs = []
+            for j, (i, text, source) in enumerate(zip(batch.index, texts, sources)):
+                metadata = {"source": source, "row": i}
+                for col, values in metadata_values.items():
+                    metadata[col] = values[j]
+                docs.append(Document(page_content=text, metadata=metadata))
+            yield from docs
 
     def load(self) -> List[Document]:
         """Load full dataframe."""
@@ -0,0 +1,50 @@
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from typing import Dict
+
+GATE_CACHE_TTL = 300.0  # seconds a user's gate decisions are reused, bounds staleness after policy or claim changes
+GATE_CACHE_MAX_USERS = 1024  # users whose decisions are kept, least recently seen dropped first
+
+"""
+Session-level cache of "right to search" gate decisions.
+Gate decisions only depend on the user's claims and static retriever node metadata, so each hospital
+blueprint keeps the decisions of recently seen users (keyed by a hash of their userinfo claims) for
+GATE_CACHE_TTL seconds. The per-user dict is passed down the retriever tree as `gate_decisions`,
+where every node records its decision the first time and denied subtrees are pruned by a lookup afterwards.
+"""
+
+def userinfo_key(userinfo: dict | None) -> str:
+    return hashlib.sha256(json.dumps(userinfo or {}, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class GateDecisionCache:
+    def __init__(self, ttl: float = GATE_CACHE_TTL, max_users: int = GATE_CACHE_MAX_USERS):
+        self.ttl = ttl
+        self.max_users = max_users
+        self._users: OrderedDict[str, tuple[float, Dict[int, bool]]] = OrderedDict()  # userinfo hash -> (expiry, decisions)
+        self._lock = Lock()
+
+    def decisions(self, userinfo: dict | None) -> Dict[int, bool]:
+        """ The user's gate decisions, { id(retriever node) : allowed }, filled in by the retrievers as they are evaluated """
+        key = userinfo_key(userinfo)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._users.get(key)
+            if entry is not None and entry[0] > now:
+                self._users.move_to_end(key)
+                return entry[1]
+
+            decisions: Dict[int, bool] = {}
+            self._users[key] = (now + self.ttl, decisions)
+            self._users.move_to_end(key)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+            return decisions
+
+    def clear(self) -> None:
+        with self._lock:
+            self._users.clear()
@@ -3,30 +3,52 @@ from langchain.chat_models.base import BaseChatModel
 from langchain.llms.base import LLM
 from langchain.schema.messages import BaseMessage, ChatMessage
 from langchain.schema import ChatGeneration, ChatResult
-from langchain_community.llms import HuggingFaceEndpoint
-from transformers import T5Tokenizer, T5ForConditionalGeneration
-from transformers import pipeline, set_seed
 from typing import Any, List, Mapping, Optional
-from app.secret import HUGGINGFACEHUB_API_TOKEN, MEDITRON_ENDPOINT
-
-MEDITRON_LLM = HuggingFaceEndpoint(
-    endpoint_url=MEDITRON_ENDPOINT,
-    max_new_tokens=512,
-    top_k=10,
-    top_p=0.95,
-    typical_p=0.95,
-    temperature=0.01,
-    repetition_penalty=1.03,
-    huggingfacehub_api_token=HUGGINGFACEHUB_API_TOKEN
-)
+from core.models import get_model, register_model
+
+# models load on first use and are shared per process (see core/models.py),
+# e.g. using the Dummy LLM never loads flan-t5 or gpt2
+def _load_meditron():
+  from langchain_community.llms import HuggingFaceEndpoint
+  from app.secret import HUGGINGFACEHUB_API_TOKEN, MEDITRON_ENDPOINT
+  return HuggingFaceEndpoint(
+      endpoint_url=MEDITRON_ENDPOINT,
+      max_new_tokens=512,
+      top_k=10,
+      top_p=0.95,
+      typical_p=0.95,
+      temperature=0.01,
+      repetition_penalty=1.03,
+      huggingfacehub_api_token=HUGGINGFACEHUB_API_TOKEN
+  )
+
+def _load_flan_t5():
+  from transformers import T5Tokenizer, T5ForConditionalGeneration
+  return T5Tokenizer.from_pretrained("google/flan-t5-large"), T5ForConditionalGeneration.from_pretrained("google/flan-t5-large")
+
+def _load_gpt2_medium():
+  from transformers import pipeline
+  return pipeline('text-generation', model='gpt2-medium')
+
+register_model("meditron", _load_meditron)
+register_model("flan_t5_large", _load_flan_t5)
+register_model("gpt2_medium", _load_gpt2_medium)
+
+def get_meditron_llm():
+  return get_model("meditron")
 
 class FlanT5(BaseChatModel, LLM):
-  tokenizer = T5Tokenizer.from_pretrained("google/flan-t5-large")
-  model = T5ForConditionalGeneration.from_pretrained("google/flan-t5-large")
-
   def __init__(self):
     super().__init__()
 
+  @property
+  def tokenizer(self):
+    return get_model("flan_t5_large")[0]
+
+  @property
+  def model(self):
+    return get_model("flan_t5_large")[1]
+
   @property
   def _llm_type(self) -> str:
     return "custom"
@@ -71,12 +93,16 @@ class GPT2Medium(BaseChatModel, LLM):  # pydantic base class
   seed = 24
   max_length = 50
   num_return_sequences = 1
-  generator = pipeline('text-generation', model='gpt2-medium')
 
   def __init__(self):
     super().__init__()
+    from transformers import set_seed
     set_seed(self.seed)
 
+  @property
+  def generator(self):
+    return get_model("gpt2_medium")
+
   @property
   def _llm_type(self) -> str:
     return "custom"
@@ -0,0 +1,80 @@
+import gc
+import threading
+import time
+from langchain_core.embeddings import Embeddings
+
+from typing import Any, Callable, Dict, Iterable, List
+
+import logging
+logger = logging.getLogger("log")
+
+"""
+Lazy, process-wide model registry.
+Modules register a factory per model name at import time (cheap), and the model is only loaded
+the first time get_model() is called, then shared by everything in the process. Importing
+core.federated_retriever or core.llm therefore loads no weights; a server that only ever hits the
+embedding cache, or an eval run that only uses the Dummy LLM, never loads the models it doesn't use.
+"""
+
+_FACTORIES: Dict[str, Callable[[], Any]] = {}
+_MODELS: Dict[str, Any] = {}
+_LOCKS: Dict[str, threading.Lock] = {}
+_REGISTRY_LOCK = threading.Lock()
+
+def register_model(name: str, factory: Callable[[], Any]) -> None:
+    with _REGISTRY_LOCK:
+        _FACTORIES[name] = factory
+        _LOCKS.setdefault(name, threading.Lock())
+
+def get_model(name: str) -> Any:
+    model = _MODELS.get(name)
+    if model is None:
+        with _LOCKS[name]:  # one load per model, other threads wait for it instead of loading their own copy
+            model = _MODELS.get(name)
+            if model is None:
+                t1 = time.perf_counter()
+                model = _FACTORIES[name]()
+                _MODELS[name] = model
+                logger.debug(f"Loaded model {name} in {time.perf_counter() - t1:.2f}s")
+    return model
+
+def is_loaded(name: str) -> bool:
+    return name in _MODELS
+
+def loaded_models() -> List[str]:
+    return list(_MODELS)
+
+def _torch_module(model: Any):
+    """ The torch module holding a model's weights, e.g. the SentenceTransformer inside HuggingFaceEmbeddings """
+    for module in (getattr(model, "client", None), model):
+        if hasattr(module, "share_memory") and hasattr(module, "eval"):
+            return module
+    return None
+
+def preload_for_fork(names: Iterable[str], share_memory: bool = True) -> None:
+    """ Load models in the parent before os.fork(), so forked children (e.g. the scalability servers) use
+        the parent's weights copy-on-write instead of each loading its own copy.
+        NOTE: don't run inference in the parent before forking, torch's thread pool does not survive fork.
+    """
+    for name in names:
+        module = _torch_module(get_model(name))
+        if module is not None:
+            module.eval()
+            if share_memory:  # weights move to shared memory, so even a write in one child is seen by all instead of copied
+                module.share_memory()
+    # the cyclic gc would otherwise write to the preloaded objects' headers in every child, copying their pages
+    gc.collect()
+    gc.freeze()
+
+
+class LazyEmbeddings(Embeddings):
+    """ Embeddings backed by a registered model, loaded on the first embed call """
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return get_model(self.name).embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return get_model(self.name).embed_query(text)
@@ -0,0 +1,78 @@
+import spacy
+from collections import OrderedDict
+from functools import cached_property
+from threading import Lock
+from typing import Iterable, List
+
+SPACY_MODEL = "en_core_web_sm"
+NER_PIPES = ("tok2vec", "ner")  # only components needed for PERSON entities, everything else is disabled
+NER_CACHE_SIZE = 1024  # number of recent query -> names results kept in memory
+NER_BATCH_SIZE = 64
+
+"""
+Process-wide name extraction service used to detect queries about specific people.
+The spaCy model is loaded lazily on first use (instead of once per query) and shared
+by every retriever in the process, and recent query -> names results are kept in an LRU cache.
+"""
+
+class NameExtractor:
+    def __init__(self, model_name: str = SPACY_MODEL, cache_size: int = NER_CACHE_SIZE):
+        self.model_name = model_name
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, tuple[str, ...]] = OrderedDict()
+        self._lock = Lock()  # guards both the LRU cache and the (non thread-safe) spaCy pipeline
+
+    @cached_property
+    def nlp(self) -> spacy.language.Language:
+        nlp = spacy.load(self.model_name)
+        nlp.select_pipes(disable=[name for name in nlp.pipe_names if name not in NER_PIPES])
+        return nlp
+
+    @staticmethod
+    def _names_from_doc(doc) -> tuple[str, ...]:
+        # strip possessives, e.g. "Edward Fisher's" -> "Edward Fisher"
+        return tuple(
+            (ent.text[:ent.text.rfind("'")] if "'" in ent.text else ent.text)
+            for ent in doc.ents if ent.label_ == "PERSON"
+        )
+
+    def extract_names(self, queries: Iterable[str], batch_size: int = NER_BATCH_SIZE) -> List[List[str]]:
+        """ Batched PERSON extraction; only queries missing from the cache go through nlp.pipe """
+        queries = list(queries)
+        results: dict[str, tuple[str, ...]] = {}
+        with self._lock:
+            for query in queries:
+                if query in self._cache:
+                    self._cache.move_to_end(query)
+                    results[query] = self._cache[query]
+
+            misses = list(dict.fromkeys(q for q in queries if q not in results))  # dedupe, keep order
+            for query, doc in zip(misses, self.nlp.pipe(misses, batch_size=batch_size)):
+                results[query] = self._names_from_doc(doc)
+                self._cache[query] = results[query]
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        return [list(results[query]) for query in queries]
+
+    def extract(self, query: str) -> List[str]:
+        return self.extract_names([query])[0]
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+
+_NAME_EXTRACTOR: NameExtractor | None = None
+_NAME_EXTRACTOR_LOCK = Lock()
+
+def get_name_extractor() -> NameExtractor:
+    global _NAME_EXTRACTOR
+    if _NAME_EXTRACTOR is None:
+        with _NAME_EXTRACTOR_LOCK:
+            if _NAME_EXTRACTOR is None:
+                _NAME_EXTRACTOR = NameExtractor()
+    return _NAME_EXTRACTOR
+
+def extract_names(queries: Iterable[str]) -> List[List[str]]:
+    return get_name_extractor().extract_names(queries)
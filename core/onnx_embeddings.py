@@ -0,0 +1,100 @@
+import numpy as np
+import os
+from langchain_core.embeddings import Embeddings
+
+from typing import List, Optional
+
+ONNX_MODEL_DIR = os.path.join(os.path.dirname(__file__), "../onnx/")
+ONNX_MODEL_FILE = "model_quantized.onnx"
+ONNX_MAX_LENGTH = 512  # BERT position limit, same truncation as the sentence-transformers model
+ONNX_BATCH_SIZE = 32
+
+"""
+CPU-optimised embedding backend: the HuggingFace model exported to ONNX, dynamically quantized
+to int8 weights, and run with ONNX Runtime. Pooling (mean over tokens) and normalization match
+HuggingFaceEmbeddings(encode_kwargs={"normalize_embeddings": True}), so vectors stay comparable
+with an index built by the full-precision model. See eval/benchmarks/bench_onnx_embeddings.py for
+the parity check and latency comparison.
+"""
+
+def export_quantized_model(model_name: str, output_dir: str) -> str:
+    """ One-off export + int8 dynamic quantization, requires optimum[onnxruntime] """
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+    model.save_pretrained(output_dir)
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(output_dir)
+    quantizer = ORTQuantizer.from_pretrained(model)
+    quantizer.quantize(save_dir=output_dir, quantization_config=AutoQuantizationConfig.avx2(is_static=False, per_channel=False))
+    return os.path.join(output_dir, ONNX_MODEL_FILE)
+
+
+class OnnxEmbeddings(Embeddings):
+    def __init__(
+            self,
+            model_name: str,
+            model_dir: Optional[str] = None,
+            normalize: bool = True,
+            batch_size: int = ONNX_BATCH_SIZE,
+            n_threads: int = 0,  # 0 lets onnxruntime pick (all physical cores)
+        ):
+        import onnxruntime as ort  # deferred, so importing this module (e.g. for QueryBackendEmbeddings) stays cheap
+        from transformers import AutoTokenizer
+
+        self.model_dir = model_dir or os.path.join(ONNX_MODEL_DIR, model_name.replace("/", "--"))
+        self.normalize = normalize
+        self.batch_size = batch_size
+
+        model_path = os.path.join(self.model_dir, ONNX_MODEL_FILE)
+        if not os.path.exists(model_path):
+            model_path = export_quantized_model(model_name, self.model_dir)
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_dir)
+
+        sess_options = ort.SessionOptions()
+        sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        sess_options.intra_op_num_threads = n_threads
+        self.session = ort.InferenceSession(model_path, sess_options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        embeddings = []
+        for start in range(0, len(texts), self.batch_size):
+            encoded = self.tokenizer(
+                texts[start:start + self.batch_size],
+                padding=True,
+                truncation=True,
+                max_length=ONNX_MAX_LENGTH,
+                return_tensors="np",
+            )
+            feeds = {name: values.astype(np.int64) for name, values in encoded.items() if name in self.input_names}
+            hidden = self.session.run(["last_hidden_state"], feeds)[0]  # (batch, tokens, dim)
+
+            # mean pooling over non-padding tokens
+            mask = encoded["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if self.normalize:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            embeddings.extend(pooled.tolist())
+        return embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._encode(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text])[0]
+
+
+class QueryBackendEmbeddings(Embeddings):
+    """ Embeds documents (i.e. index builds) with `document_embedding` and queries with `query_embedding` """
+
+    def __init__(self, document_embedding: Embeddings, query_embedding: Embeddings):
+        self.document_embedding = document_embedding
+        self.query_embedding = query_embedding
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.document_embedding.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.query_embedding.embed_query(text)
@@ -0,0 +1,217 @@
+import hashlib
+import json
+import numpy as np
+import os
+import time
+import uuid
+from langchain_community.vectorstores import Qdrant
+from langchain_core.embeddings import Embeddings
+from langchain.schema import Document
+from core.embedding_pipeline import EMBED_BATCH_SIZE, embed_and_upsert
+from qdrant_client import QdrantClient
+from qdrant_client.http import models as rest
+
+from typing import Dict, List, NamedTuple, Optional, Set
+
+import logging
+logger = logging.getLogger("log")
+
+SCROLL_LIMIT = 10000  # point ids fetched per scroll page when diffing a collection
+
+"""
+Incremental (content-hash based) Qdrant collection builds.
+Every document gets a stable point id derived from a hash of its page_content and metadata,
+so re-indexing a leaf only embeds documents that are new or changed, deletes points whose
+document no longer exists, and an unchanged dataset opens its existing collection without embedding anything.
+A collection's ScoreCone can be kept in a file next to it, updated from the vectors each sync upserts, so reopening
+it doesn't read every vector back: only a missing (or, after a crash mid-sync, removed) file costs a full scroll.
+"""
+
+def doc_point_id(doc: Document) -> str:
+    content = json.dumps([doc.page_content, doc.metadata], sort_keys=True, default=str)
+    return str(uuid.UUID(hashlib.sha256(content.encode("utf-8")).hexdigest()[:32]))
+
+def collection_point_ids(client: QdrantClient, collection_name: str) -> Set[str]:
+    point_ids, offset = set(), None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection_name,
+            limit=SCROLL_LIMIT,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False,
+        )
+        point_ids.update(str(point.id) for point in points)
+        if offset is None:
+            return point_ids
+
+def sync_qdrant_collection(
+        client: QdrantClient,
+        collection_name: str,
+        docs: List[Document],
+        embedding: Embeddings,
+        recreate: bool = False,
+        batch_size: int = EMBED_BATCH_SIZE,
+        score_cone_path: Optional[str] = None,  # where to keep the collection's ScoreCone (see load_score_cone), None for no cone
+    ) -> Qdrant:
+    t1 = time.perf_counter()
+    existing_collections = {c.name for c in client.get_collections().collections}
+    if recreate and collection_name in existing_collections:
+        client.delete_collection(collection_name=collection_name)
+        existing_collections.remove(collection_name)
+
+    if collection_name not in existing_collections:
+        if score_cone_path is not None:  # left over from a deleted collection
+            _remove_score_cone(score_cone_path)
+        client.create_collection(
+            collection_name=collection_name,
+            vectors_config=rest.VectorParams(
+                size=len(embedding.embed_query("dimension probe")),
+                distance=rest.Distance.COSINE,  # same as Qdrant.from_documents default
+            ),
+        )
+
+    docs_by_id: Dict[str, Document] = {doc_point_id(doc): doc for doc in docs}
+    existing_ids = collection_point_ids(client, collection_name)
+    new_ids = [point_id for point_id in docs_by_id if point_id not in existing_ids]
+    stale_ids = [point_id for point_id in existing_ids if point_id not in docs_by_id]
+
+    if stale_ids:
+        client.delete(collection_name=collection_name, points_selector=rest.PointIdsList(points=stale_ids))
+
+    # deleting points keeps a cone valid (if looser), upserted vectors widen it
+    cone = None if score_cone_path is None else load_score_cone(score_cone_path)
+
+    def widen_cone(vectors):
+        nonlocal cone
+        cone = cone.extend(vectors)
+
+    if new_ids:
+        if cone is not None:  # stale until the upserts are done, a crash in between makes the next sync recompute it
+            _remove_score_cone(score_cone_path)
+        embed_and_upsert(
+            client=client,
+            collection_name=collection_name,
+            docs=[(point_id, docs_by_id[point_id]) for point_id in new_ids],
+            embedding=embedding,
+            batch_size=batch_size,
+            on_upsert=(None if cone is None else widen_cone),
+        )
+    if score_cone_path is not None and (new_ids or cone is None):
+        if cone is None:
+            logger.debug(f"No saved score cone for {collection_name}, computing it from the whole collection")
+            cone = collection_score_cone(client, collection_name)
+        if cone is not None:
+            save_score_cone(score_cone_path, cone)
+
+    logger.debug(
+        f"Synced qdrant collection {collection_name} in {time.perf_counter() - t1:.2f}s: "
+        f"{len(new_ids)} upserted, {len(stale_ids)} deleted, {len(docs_by_id) - len(new_ids)} unchanged"
+    )
+    return Qdrant(client=client, collection_name=collection_name, embeddings=embedding)
+
+
+def search_batch(
+        client: QdrantClient,
+        collection_name: str,
+        query_vectors: List[List[float]],
+        filters: List[Optional[rest.Filter]],
+        limits: List[int],
+    ) -> List[List[rest.ScoredPoint]]:
+    """ Several vector searches of a collection in one call (with payloads), one list of scored points per query vector """
+    if hasattr(client, "search_batch"):
+        return client.search_batch(
+            collection_name=collection_name,
+            requests=[
+                rest.SearchRequest(vector=vector, filter=flt, limit=limit, with_payload=True)
+                for vector, flt, limit in zip(query_vectors, filters, limits)
+            ],
+        )
+    # qdrant-client >= 1.13 removed search_batch in favour of the query api
+    responses = client.query_batch_points(
+        collection_name=collection_name,
+        requests=[
+            rest.QueryRequest(query=vector, filter=flt, limit=limit, with_payload=True)
+            for vector, flt, limit in zip(query_vectors, filters, limits)
+        ],
+    )
+    return [response.points for response in responses]
+
+
+class ScoreCone(NamedTuple):
+    """ A cone around a collection's (normalized) vectors: its axis and the max angle of any vector to it.
+        Computed around the mean direction (the smallest such cone for a fixed axis); extend() widens it for new vectors
+    """
+    centroid: np.ndarray  # unit vector
+    radius: float  # max angle (radians) between the centroid and any vector in the collection
+
+    def score_bound(self, query_vector: List[float]) -> float:
+        """ Upper bound on the cosine similarity of `query_vector` to any vector in the cone:
+            on the unit sphere, angle(q, v) >= angle(q, centroid) - angle(centroid, v) >= angle(q, centroid) - radius
+        """
+        q = np.asarray(query_vector, dtype=np.float32)
+        q_angle = np.arccos(np.clip(q @ self.centroid / (np.linalg.norm(q) or 1.0), -1.0, 1.0))
+        return float(np.cos(max(0.0, q_angle - self.radius)))
+
+    @classmethod
+    def of(cls, vectors: np.ndarray) -> "ScoreCone":
+        vectors = _normalized(vectors)
+        centroid = vectors.sum(axis=0)
+        centroid /= np.linalg.norm(centroid) or 1.0
+        return cls(centroid=centroid, radius=_max_angle(vectors, centroid))
+
+    def extend(self, vectors: List[List[float]]) -> "ScoreCone":
+        """ A cone with the same axis that also contains `vectors` """
+        if not len(vectors):
+            return self
+        return self._replace(radius=max(self.radius, _max_angle(_normalized(vectors), self.centroid)))
+
+def _normalized(vectors) -> np.ndarray:
+    vectors = np.array(vectors, dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True).clip(min=1e-12)
+
+def _max_angle(unit_vectors: np.ndarray, centroid: np.ndarray) -> float:
+    # NOTE: a tiny margin absorbs float32 rounding, so the bound never falls below a real score
+    return float(np.arccos(np.clip((unit_vectors @ centroid).min(), -1.0, 1.0))) + 1e-4
+
+def collection_score_cone(client: QdrantClient, collection_name: str) -> Optional[ScoreCone]:
+    """ ScoreCone of all vectors in a (cosine distance) collection, None if it is empty. Reads every vector,
+        prefer the cone sync_qdrant_collection keeps (see load_score_cone)
+    """
+    pages, offset = [], None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection_name,
+            limit=SCROLL_LIMIT,
+            offset=offset,
+            with_payload=False,
+            with_vectors=True,
+        )
+        if points:
+            pages.append(np.asarray([point.vector for point in points], dtype=np.float32))
+        if offset is None:
+            break
+    if not pages:
+        return None
+    return ScoreCone.of(np.concatenate(pages))
+
+def load_score_cone(path: str) -> Optional[ScoreCone]:
+    """ The ScoreCone saved at `path` by sync_qdrant_collection, None if there is none """
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    return ScoreCone(centroid=np.asarray(saved["centroid"], dtype=np.float32), radius=float(saved["radius"]))
+
+def save_score_cone(path: str, cone: ScoreCone) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"centroid": cone.centroid.tolist(), "radius": cone.radius}, f)
+    os.replace(tmp_path, path)  # atomic, a reader never sees half a cone
+
+def _remove_score_cone(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
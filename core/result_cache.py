@@ -0,0 +1,242 @@
+import hashlib
+import json
+import numpy as np
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from py_abac import PDP
+from core.abac_cache import userinfo_attributes
+
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+import logging
+logger = logging.getLogger("log")
+
+RESULT_CACHE_TTL = 600.0  # seconds a result is reused, bounds staleness for changes hospitals don't report
+RESULT_CACHE_MAX_ENTRIES = 4096
+RESULT_CACHE_MAX_BYTES = 64 * 1024 * 1024  # json size of the cached docs, least recently used dropped first
+
+"""
+Root-side cache of federated retrieval results.
+Many users with the same attributes ask the same questions, so the root keeps the merged top k docs of recent
+queries and answers repeats without fanning out. Results may only be shared by users who are guaranteed the
+same access: every hospital reports, with its results, the userinfo attributes its policies reference (see
+userinfo_attributes in core/abac_cache.py) and a version of its policies and indexes. Entries are keyed on the
+normalized query, search_kwargs and the userinfo projected onto the union of the attributes reported by the
+queried hospitals, or the full userinfo while any of them hasn't reported (or can't tell). A hospital reporting
+a new version, e.g. after re-indexing, invalidates its entries; invalidate() is the explicit hook for the same.
+Only complete results are cached: every hospital answered, none with leaves still warming up.
+
+Optionally (experimental, no threshold is calibrated yet), entries also keep their query's embedding, and a query missing the exact cache is answered with the
+results of the most similar cached query under the same key group (userinfo projection, search_kwargs, hospitals;
+so also the same names detected in the query) if their cosine similarity reaches a threshold. This serves
+paraphrases of a question without sharing results across users any more than exact hits do.
+"""
+
+def normalize_query(query: str) -> str:
+    """ Unicode-normalized with whitespace collapsed. Case is kept, ClinicalBERT is a cased model """
+    return " ".join(unicodedata.normalize("NFKC", query).split())
+
+def project_userinfo(userinfo: Optional[dict], attributes: Optional[Set[str]]) -> dict:
+    """ `userinfo` restricted to `attributes`, all of it if None """
+    userinfo = userinfo or {}
+    if attributes is None:
+        return dict(userinfo)
+    return {name: userinfo[name] for name in attributes if name in userinfo}
+
+def cache_info(pdps: Iterable[PDP], index_version: Optional[str]) -> Dict[str, Any]:
+    """ What a hospital reports with its results (the "cache" response field): the userinfo attributes its decisions
+        depend on (None for all), and a version of its policies and indexes (None if it can't tell, then nothing is cached)
+    """
+    pdps = list(pdps)
+    attrs = userinfo_attributes(pdps)
+    policy_versions = [getattr(getattr(pdp, "_storage", None), "version", None) for pdp in pdps]
+    version = None
+    if index_version is not None and None not in policy_versions:
+        version = f"{index_version}:{','.join(map(str, policy_versions))}"
+    return {"userinfo_attributes": (None if attrs is None else sorted(attrs)), "version": version}
+
+
+CacheKey = Tuple[str, str]  # (hash of the userinfo projection, search_kwargs, hospitals and metadata_keys; normalized query)
+
+class _Entry(NamedTuple):
+    expiry: float
+    docs: List[dict]
+    size: int
+    versions: Dict[str, str]  # hospital uri -> version the docs were retrieved at
+    vector: Optional[np.ndarray]  # unit query embedding, for semantic lookups
+
+
+class ResultCache:
+    def __init__(self, ttl: float = RESULT_CACHE_TTL, max_entries: int = RESULT_CACHE_MAX_ENTRIES, max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[CacheKey, _Entry] = OrderedDict()
+        self._hospitals: Dict[str, Dict[str, Any]] = {}  # uri -> cache_info() it last reported
+        self._groups: Dict[str, Dict[CacheKey, np.ndarray]] = {}  # key group -> { key : unit query embedding } of its entries that have one
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = self.semantic_hits = self.misses = self.evictions = self.invalidations = 0
+
+    def attributes(self, hospital_uris: Iterable[str]) -> Optional[Set[str]]:
+        """ Union of the userinfo attributes reported by `hospital_uris`, None if any hasn't reported them """
+        attrs = set()
+        with self._lock:
+            for uri in hospital_uris:
+                reported = (self._hospitals.get(uri) or {}).get("userinfo_attributes")
+                if reported is None:
+                    return None
+                attrs.update(reported)
+        return attrs
+
+    def key(
+            self,
+            query: str,
+            userinfo: Optional[dict],
+            search_kwargs: Dict[str, Any],
+            hospital_uris: Iterable[str],
+            metadata_keys: Optional[List[str]] = None,
+        ) -> CacheKey:
+        uris = sorted(hospital_uris)
+        group = [project_userinfo(userinfo, self.attributes(uris)), search_kwargs, uris, metadata_keys]
+        return hashlib.sha256(json.dumps(group, sort_keys=True, default=str).encode("utf-8")).hexdigest(), normalize_query(query)
+
+    def get(self, key: CacheKey, query_vector: Optional[List[float]] = None, threshold: Optional[float] = None) -> Optional[List[dict]]:
+        """ Cached docs for `key`. With `query_vector` and `threshold`, an exact miss falls back to the entry of the
+            key's group whose query embedding is the most similar to `query_vector`, if their cosine similarity is >= `threshold`
+        """
+        with self._lock:
+            if self._live(key):
+                self.hits += 1
+                return self._touch(key)
+            if query_vector is not None and threshold is not None:
+                similar_key = self._most_similar(key[0], _unit(query_vector), threshold)
+                if similar_key is not None:
+                    logger.debug(f"Semantic cache hit: {key[1]!r} ~ {similar_key[1]!r}")
+                    self.semantic_hits += 1
+                    return self._touch(similar_key)
+            self.misses += 1
+            return None
+
+    def _live(self, key: CacheKey) -> bool:
+        # whether `key` has an unexpired entry, dropping it if expired. Call with the lock held
+        entry = self._entries.get(key)
+        if entry is not None and entry.expiry <= time.monotonic():
+            self._drop(key)
+            return False
+        return entry is not None
+
+    def _touch(self, key: CacheKey) -> List[dict]:
+        self._entries.move_to_end(key)
+        return list(self._entries[key].docs)
+
+    def _most_similar(self, group: str, unit_vector: np.ndarray, threshold: float) -> Optional[CacheKey]:
+        # call with the lock held
+        vectors = self._groups.get(group)
+        if not vectors:
+            return None
+        keys = list(vectors)
+        similarities = np.stack([vectors[key] for key in keys]) @ unit_vector
+        for i in np.argsort(-similarities):
+            if similarities[i] < threshold:
+                return None
+            if self._live(keys[i]):
+                return keys[i]
+        return None
+
+    def put(self, key: CacheKey, docs: List[dict], versions: Dict[str, str], query_vector: Optional[List[float]] = None) -> None:
+        """ Cache `docs`, retrieved from hospitals at `versions` ({ uri : version }). Skipped if a hospital
+            has since reported another version, i.e. the docs may already be stale.
+            `query_vector` makes the entry available to semantic lookups (see get())
+        """
+        size = len(json.dumps(docs, default=str))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if any((self._hospitals.get(uri) or {}).get("version") != version for uri, version in versions.items()):
+                return
+            if key in self._entries:
+                self._drop(key)
+            vector = None if query_vector is None else _unit(query_vector)
+            self._entries[key] = _Entry(time.monotonic() + self.ttl, list(docs), size, dict(versions), vector)
+            self.size_bytes += size
+            if vector is not None:
+                self._groups.setdefault(key[0], {})[key] = vector
+            while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def observe(self, hospital_uri: str, info: Optional[Dict[str, Any]]) -> None:
+        """ Record the cache_info() a hospital sent with its results, invalidating its entries if it changed """
+        info = dict(info or {"userinfo_attributes": None, "version": None})
+        with self._lock:
+            previous = self._hospitals.get(hospital_uri)
+            self._hospitals[hospital_uri] = info
+        if previous is not None and previous != info:
+            logger.debug(f"{hospital_uri} reported {info}, was {previous}: invalidating its cached results")
+            self.invalidate(hospital_uri, forget=False)
+
+    def invalidate(self, hospital_uri: Optional[str] = None, forget: bool = True) -> int:
+        """ Drop the entries with results from `hospital_uri` (all entries if None), e.g. when it re-indexes.
+            With `forget`, also what it reported, so results are keyed on the full userinfo until it reports again.
+            Returns the number of entries dropped.
+        """
+        with self._lock:
+            keys = [key for key, entry in self._entries.items() if hospital_uri is None or hospital_uri in entry.versions]
+            for key in keys:
+                self._drop(key)
+            self.invalidations += len(keys)
+            if forget:
+                if hospital_uri is None:
+                    self._hospitals.clear()
+                else:
+                    self._hospitals.pop(hospital_uri, None)
+        return len(keys)
+
+    def _drop(self, key: CacheKey) -> None:
+        # call with the lock held
+        entry = self._entries.pop(key)
+        self.size_bytes -= entry.size
+        if entry.vector is not None:
+            vectors = self._groups[key[0]]
+            del vectors[key]
+            if not vectors:
+                del self._groups[key[0]]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.semantic_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.size_bytes,
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": ((self.hits + self.semantic_hits) / lookups if lookups else 0.0),
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def clear(self) -> None:
+        self.invalidate()
+
+
+def _unit(vector: List[float]) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+_RESULT_CACHE: ResultCache | None = None
+_RESULT_CACHE_LOCK = threading.Lock()
+
+def get_result_cache() -> ResultCache:
+    """ The process-wide result cache, shared by the RootRetrievers of all user sessions """
+    global _RESULT_CACHE
+    if _RESULT_CACHE is None:
+        with _RESULT_CACHE_LOCK:
+            if _RESULT_CACHE is None:
+                _RESULT_CACHE = ResultCache()
+    return _RESULT_CACHE
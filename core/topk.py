@@ -0,0 +1,56 @@
+import heapq
+from itertools import count, islice
+from langchain.schema import Document
+
+from typing import Iterable, List, TypeVar
+
+SCORE_UPPER_BOUND = 1.0  # scores are cosine similarities, so no doc can score higher
+
+"""
+Top-k selection shared by every retriever in the tree.
+Scores are read straight from document metadata (no serialization), for both Document objects
+and the serialized documents (doc.to_json()) returned by hospital servers.
+"""
+
+DocT = TypeVar("DocT", Document, dict)
+
+def doc_score(doc: Document | dict) -> float:
+    if isinstance(doc, Document):
+        return doc.metadata["score"]
+    return doc["kwargs"]["metadata"]["score"]  # serialized langchain Document
+
+def top_k(docs: Iterable[DocT], k: int) -> List[DocT]:
+    """ The k highest scoring docs in descending score order, from docs in any order """
+    return heapq.nlargest(k, docs, key=doc_score)
+
+def merge_top_k(ranked_lists: Iterable[Iterable[DocT]], k: int) -> List[DocT]:
+    """ k-way merge of ranked lists (each already in descending score order, as every retriever returns them)
+        into the overall top k. Lists are consumed lazily through a heap of their current heads,
+        so a list stops being read once its next doc can no longer enter the top k.
+    """
+    return list(islice(heapq.merge(*ranked_lists, key=doc_score, reverse=True), k))
+
+
+class RunningTopK:
+    """ Top k of docs arriving in any order, e.g. ranked lists streamed by several hospitals at once """
+
+    def __init__(self, k: int):
+        self.k = k
+        self._heap = []  # min-heap of (score, arrival, doc), the worst of the current top k at the root
+        self._arrival = count()  # tie-breaker, so docs are never compared
+
+    def add(self, docs: Iterable[DocT]) -> None:
+        for doc in docs:
+            item = (doc_score(doc), next(self._arrival), doc)
+            if len(self._heap) < self.k:
+                heapq.heappush(self._heap, item)
+            elif item[0] > self._heap[0][0]:
+                heapq.heapreplace(self._heap, item)
+
+    def beats(self, bound: float) -> bool:
+        """ True once no doc scoring at most `bound` can enter the top k anymore """
+        return self.k <= 0 or (len(self._heap) >= self.k and self._heap[0][0] >= bound)
+
+    def result(self) -> List[DocT]:
+        """ The top k in descending score order """
+        return [doc for _, _, doc in sorted(self._heap, key=lambda item: (-item[0], item[1]))]
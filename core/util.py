@@ -1,47 +1,92 @@
+import numpy as np
 import os
 import re
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from langchain.text_splitter import CharacterTextSplitter
 from pathlib import Path
 
 from typing import Optional
 
 MAX_DOC_CHUNK_SIZE = 800
+CHUNK_PARALLEL_MIN_ROWS = 1000  # below this many rows, process pool startup costs more than it saves
+CSV_BATCH_ROWS = 10000  # rows read at a time when streaming large CSVs (e.g. the full MIMIC-IV discharge.csv)
 # MAX_DOC_CHUNK_SIZE = 400
 # DOC_CHUNK_OVERLAP = 150
 
-""" Chunk csv's with a longform text column, e.g. discharge.csv """
+""" Chunk csv's with a longform text column, e.g. discharge.csv
+    Streams the csv `batch_rows` rows at a time, appending each chunked batch to the output,
+    so peak memory is bounded by the batch size rather than the size of the csv.
+    `out_format` is "csv" or "parquet" (requires pyarrow).
+"""
 
-def chunk_csv(csv_path: str, chunk_col: str = "text") -> None:
-    df = pd.read_csv(csv_path)
-    chunked_df = chunk_df(df, chunk_col)
+def chunk_csv(
+        csv_path: str,
+        chunk_col: str = "text",
+        n_workers: int = 1,
+        batch_rows: int = CSV_BATCH_ROWS,
+        out_format: str = "csv",
+    ) -> None:
     # saves to the same folder but with _chunked appended to csv name
-    chunked_df.to_csv(f"{Path(csv_path).parent}/{Path(csv_path).stem}_chunked.csv", index=False)
-
-def chunk_df(df: pd.DataFrame, chunk_col: str = "text") -> pd.DataFrame:
-    chunked_df = pd.DataFrame(columns=list(df.columns) + ['text_index'])
-    # text_splitter = CharacterTextSplitter(separator="\n", chunk_size=DOC_CHUNK_SIZE, chunk_overlap=DOC_CHUNK_OVERLAP) 
-
-    for _, row in df.iterrows():
-        # chunk one column, keep the rest. if there are e.g. multiple text cols then call this again?
-        # row_chunks = text_splitter.split_text(row[chunk_col])
-        row_sentences = split_mimic_discharge(row[chunk_col])
-        # condense sentences in row up to chunk size
-        row_chunks = []
-        current_chunk = []
-        for sentence in row_sentences:
-            if sum(len(c) for c in current_chunk) + len(sentence) > MAX_DOC_CHUNK_SIZE:
-                row_chunks.append(" ".join(current_chunk))
-                current_chunk = [sentence]
+    out_path = f"{Path(csv_path).parent}/{Path(csv_path).stem}_chunked.{out_format}"
+    if out_format not in ("csv", "parquet"):
+        raise ValueError(f"out_format of {out_format} not allowed.")
+
+    parquet_writer = None
+    try:
+        for batch_i, batch_df in enumerate(pd.read_csv(csv_path, chunksize=batch_rows)):
+            chunked_df = chunk_df(batch_df, chunk_col, n_workers=n_workers)
+            if out_format == "csv":
+                chunked_df.to_csv(out_path, mode=("w" if batch_i == 0 else "a"), header=(batch_i == 0), index=False)
             else:
-                current_chunk.append(sentence)
-        if len(current_chunk) > 0:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                if parquet_writer is None:
+                    table = pa.Table.from_pandas(chunked_df, preserve_index=False)
+                    parquet_writer = pq.ParquetWriter(out_path, table.schema)
+                else:
+                    table = pa.Table.from_pandas(chunked_df, schema=parquet_writer.schema, preserve_index=False)
+                parquet_writer.write_table(table)
+    finally:
+        if parquet_writer is not None:
+            parquet_writer.close()
+
+""" Split one longform text into chunks of whole sentences, each up to MAX_DOC_CHUNK_SIZE characters """
+def chunk_text(text: str) -> list[str]:
+    row_chunks = []
+    current_chunk = []
+    current_len = 0  # running sum of len() over current_chunk
+    for sentence in split_mimic_discharge(text):
+        if current_len + len(sentence) > MAX_DOC_CHUNK_SIZE:
             row_chunks.append(" ".join(current_chunk))
+            current_chunk = [sentence]
+            current_len = len(sentence)
+        else:
+            current_chunk.append(sentence)
+            current_len += len(sentence)
+    if len(current_chunk) > 0:
+        row_chunks.append(" ".join(current_chunk))
+
+    return row_chunks
+
+""" Chunk one column of `df`, keeping the rest: each row becomes one row per chunk, numbered by text_index.
+    With n_workers > 1, large frames are chunked across a process pool.
+"""
+def chunk_df(df: pd.DataFrame, chunk_col: str = "text", n_workers: int = 1) -> pd.DataFrame:
+    texts = df[chunk_col].tolist()
+    if n_workers > 1 and len(texts) >= CHUNK_PARALLEL_MIN_ROWS:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            row_chunks = list(executor.map(chunk_text, texts, chunksize=max(1, len(texts) // (4 * n_workers))))
+    else:
+        row_chunks = [chunk_text(text) for text in texts]
+
+    # build columnar output in one shot: repeat each source row once per chunk
+    counts = np.fromiter((len(chunks) for chunks in row_chunks), dtype=np.int64, count=len(row_chunks))
+    row_starts = np.cumsum(counts) - counts
+    chunked_df = df.iloc[np.repeat(np.arange(len(df)), counts)].reset_index(drop=True)
+    chunked_df[chunk_col] = [chunk for chunks in row_chunks for chunk in chunks]
+    chunked_df["text_index"] = np.arange(counts.sum()) - np.repeat(row_starts, counts)
 
-        for text_index, chunk in enumerate(row_chunks):
-            new_row = [v if k != chunk_col else chunk for k, v in row.items()] + [text_index]
-            chunked_df.loc[len(chunked_df)] = new_row
-    
     return chunked_df
 
 
@@ -61,27 +106,39 @@ def split_mimic_discharge(text: str) -> list[str]:
     return sentences
 
 
-""" Split the MIMIC-IV /note/discharge.csv """
-def split_by_service(discharge_path: str, output_folder: str, num_subjects: int = 50):
-    notes_df = pd.read_csv(discharge_path).drop(['note_type', 'note_seq', 'charttime', 'storetime'], axis=1)
-    hospA_notes = notes_df[:][notes_df.subject_id.isin(notes_df.subject_id.unique()[:num_subjects])]  
-    hospA_notes["service"] = "" # init new col
-
-    for i, row in hospA_notes.iterrows():
-        text_lines = row.text.splitlines()
-        service_line = text_lines[7].split()
-        if service_line[0].strip() != "Service:":
+""" Split the MIMIC-IV /note/discharge.csv
+    Notes of the first `num_subjects` subjects are written to one csv per service in `output_folder`.
+    The csv is streamed `batch_rows` rows at a time and the per-service csvs are appended to incrementally.
+"""
+def split_by_service(discharge_path: str, output_folder: str, num_subjects: int = 50, batch_rows: int = CSV_BATCH_ROWS):
+    subject_ids = {}  # first num_subjects subject ids in file order (dict as an ordered set)
+    depts = {}  # services in order of first appearance -> output csv path
+
+    for notes_df in pd.read_csv(discharge_path, chunksize=batch_rows):
+        notes_df = notes_df.drop(['note_type', 'note_seq', 'charttime', 'storetime'], axis=1)
+        for subject_id in notes_df.subject_id.unique():
+            if len(subject_ids) >= num_subjects:
+                break
+            subject_ids[subject_id] = None
+
+        hospA_notes = notes_df[notes_df.subject_id.isin(list(subject_ids))].copy()
+        if len(hospA_notes) == 0:
+            continue
+
+        # line 8 of each note is e.g. "Service: MEDICINE"
+        service_lines = hospA_notes.text.map(lambda text: text.splitlines()[7].split())
+        if not service_lines.str[0].str.strip().eq("Service:").all():
             raise ValueError("Split incorrect!")
-            
-        hospA_notes.loc[i, "service"] = service_line[1].strip()
+        hospA_notes["service"] = service_lines.str[1].str.strip()
 
-    depts = hospA_notes.service.unique()
-    for dept in depts:
-        fname = os.path.join(output_folder, f"{dept.lower().replace('/', '-')}.csv")
-        dept_notes = hospA_notes[:][hospA_notes.service == dept]
-        dept_notes.to_csv(fname, index=False)
+        for dept in hospA_notes.service.unique():
+            is_new_dept = dept not in depts
+            if is_new_dept:
+                depts[dept] = os.path.join(output_folder, f"{dept.lower().replace('/', '-')}.csv")
+            dept_notes = hospA_notes[hospA_notes.service == dept]
+            dept_notes.to_csv(depts[dept], mode=("w" if is_new_dept else "a"), header=is_new_dept, index=False)
 
-    return depts
+    return list(depts)
 
 """ Adds metadata in columns `metadata_cols` to the front of each text chunk
     If `metadata_cols` is None, then adds all metadata columns as prefix
@@ -99,10 +156,8 @@ def prefix_metadata(
         skip_cols = skip_cols if skip_cols is not None else []
         metadata_cols = [col for col in df.columns if col not in (skip_cols + [chunk_col])]
 
-    for i, row in df.iterrows():
-        prefix = "For patient with "
-        for mc in metadata_cols:
-            prefix += f"{mc} of {row[mc]}, "
-        prefix = prefix[:-2] + ": "
-        row[chunk_col] = prefix + row[chunk_col]
-        df.loc[i] = row
\ No newline at end of file
+    # built column-wise, e.g. "For patient with name of Edward Fisher, subject_id of 10000935: <chunk>"
+    prefix = pd.Series("For patient with ", index=df.index, dtype=object)
+    for mc in metadata_cols:
+        prefix = prefix + f"{mc} of " + df[mc].astype(str) + ", "
+    df[chunk_col] = prefix.str[:-2] + ": " + df[chunk_col]
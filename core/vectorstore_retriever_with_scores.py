@@ -1,22 +1,48 @@
 from langchain_core.vectorstores import VectorStoreRetriever
 from langchain.docstore.document import Document
-from typing import Any, Dict, List
+from core.qdrant_index import search_batch
+from typing import Any, Dict, List, Optional
 
 
 class VectorStoreRetrieverWithScores(VectorStoreRetriever):
     def _get_relevant_documents(
-        self, query: str, k: int = 4, **kwargs
+        self, query: str, k: int = 4, query_vector: Optional[List[float]] = None, **kwargs
     ) -> List[Document]:
         if self.search_type == "similarity" or self.search_type == "similarity_score_threshold":
-            docs_and_similarities = (
-                self.vectorstore.similarity_search_with_relevance_scores(
-                    query, k=k, **kwargs
+            if query_vector is not None:
+                # query already embedded upstream (e.g. by a RouterRetriever), search the vector directly
+                # NOTE: for Qdrant with cosine distance, these scores are the same as the relevance scores below
+                docs_and_similarities = self.vectorstore.similarity_search_with_score_by_vector(
+                    query_vector, k=k, **kwargs
+                )
+            else:
+                docs_and_similarities = (
+                    self.vectorstore.similarity_search_with_relevance_scores(
+                        query, k=k, **kwargs
+                    )
                 )
-            )
             docs = []
             for doc, sim in docs_and_similarities:
                 doc.metadata["score"] = sim
                 docs.append(doc)
         else:
             raise ValueError(f"search_type of {self.search_type} not allowed.")
-        return docs
\ No newline at end of file
+        return docs
+
+    def get_relevant_documents_batch(
+        self, query_vectors: List[List[float]], filters: List[Optional[Any]], ks: List[int]
+    ) -> List[List[Document]]:
+        """ One batched search for several (already embedded) queries, each with its own filter and k.
+            Docs are scored like _get_relevant_documents with a query_vector.
+        """
+        vs = self.vectorstore
+        results = search_batch(vs.client, vs.collection_name, query_vectors, filters, ks)
+        doc_lists = []
+        for points in results:
+            docs = []
+            for point in points:
+                doc = vs._document_from_scored_point(point, vs.collection_name, vs.content_payload_key, vs.metadata_payload_key)
+                doc.metadata["score"] = point.score
+                docs.append(doc)
+            doc_lists.append(docs)
+        return doc_lists
@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Dict, List, Optional
+
+import logging
+logger = logging.getLogger("log")
+
+WARMUP_WORKERS = min(4, os.cpu_count() or 1)  # leaf indexes built concurrently, all embedding on the shared pool of core/embedding_pipeline.py
+WARMUP_RETRY_AFTER = 30.0  # seconds after a failed warm-up before the next query triggers a rebuild of the leaf
+
+PENDING, WARMING, READY, FAILED = "pending", "warming", "ready", "failed"
+
+"""
+Background warm-up of leaf indexes at hospital startup.
+Instead of the first query building every leaf's Qdrant collection serially (through the
+vectorstore_retriever property), LeafWarmup builds them concurrently on a small thread pool
+as soon as the server starts. The builds share one embedding pool and torch thread budget (see
+core/embedding_pipeline.py), so building several at once overlaps their chunking and upserts without
+running more forward-pass threads than there are cores. Queries are served by the leaves that are ready
+(see `ready_only` in LeafRetriever), and status() reports per-leaf readiness for the health endpoints.
+A leaf whose build failed is reported as failed (with the error) and rebuilt in the background once
+retry_failed() is called, which the hospitals do on every query, at most every WARMUP_RETRY_AFTER seconds.
+"""
+
+class LeafWarmup:
+    def __init__(self, leaves: List, n_workers: int = WARMUP_WORKERS, retry_after: float = WARMUP_RETRY_AFTER):
+        self.leaves = {leaf.id: leaf for leaf in leaves}
+        self.n_workers = n_workers
+        self.retry_after = retry_after
+        self._status: Dict[str, dict] = {leaf_id: {"status": PENDING} for leaf_id in self.leaves}
+        self._lock = threading.Lock()
+        self._started = False
+        self._epoch = uuid.uuid4().hex[:12]  # this process's indexes, so a restarted (possibly re-indexed) server reports a new version
+        self._builds = 0
+        self._attempts: Dict[str, int] = {leaf_id: 0 for leaf_id in self.leaves}
+        self._failed_at: Dict[str, float] = {}  # leaf id -> time.monotonic() of its last failed build
+
+    def _warm(self, leaf_id: str) -> None:
+        with self._lock:
+            self._status[leaf_id] = {"status": WARMING}
+            self._attempts[leaf_id] += 1
+        t1 = time.perf_counter()
+        try:
+            self.leaves[leaf_id].vectorstore_retriever  # builds (or opens) the leaf's index
+        except Exception as e:
+            logger.debug(f"Warm-up of leaf {leaf_id} failed: {e!r}")
+            with self._lock:
+                self._status[leaf_id] = {"status": FAILED, "error": repr(e), "attempts": self._attempts[leaf_id]}
+                self._failed_at[leaf_id] = time.monotonic()
+            return
+        seconds = time.perf_counter() - t1
+        logger.debug(f"Leaf {leaf_id} warmed up in {seconds:.2f}s")
+        with self._lock:
+            if self._status[leaf_id]["status"] != READY:  # else already counted by _sync_ready()
+                self._builds += 1
+            self._status[leaf_id] = {"status": READY, "seconds": round(seconds, 2)}
+
+    def _submit(self, leaf_ids: List[str]) -> None:
+        executor = ThreadPoolExecutor(max_workers=max(1, min(self.n_workers, len(leaf_ids))), thread_name_prefix="leaf-warmup")
+        for leaf_id in leaf_ids:
+            executor.submit(self._warm, leaf_id)
+        executor.shutdown(wait=False)
+
+    def start(self) -> "LeafWarmup":
+        """ Start building all leaf indexes in the background, returns immediately """
+        if not self._started:
+            self._started = True
+            self._submit(list(self.leaves))
+        return self
+
+    def retry_failed(self) -> List[str]:
+        """ Rebuild, in the background, the leaves whose last build failed at least `retry_after` seconds ago. Returns them """
+        now = time.monotonic()
+        with self._lock:
+            self._sync_ready()
+            due = [
+                leaf_id for leaf_id, status in self._status.items()
+                if status["status"] == FAILED and now - self._failed_at[leaf_id] >= self.retry_after
+            ]
+            for leaf_id in due:
+                self._status[leaf_id] = {"status": PENDING, "attempts": self._attempts[leaf_id]}
+        if due:
+            logger.debug(f"Retrying warm-up of failed leaves: {due}")
+            self._submit(due)
+        return due
+
+    def _sync_ready(self) -> None:
+        # leaves can also be built outside the warm-up, by a query that doesn't ask for ready_only. Call with the lock held
+        for leaf_id, leaf in self.leaves.items():
+            if self._status[leaf_id]["status"] != READY and leaf.index_ready():
+                self._status[leaf_id] = {"status": READY}
+                self._builds += 1
+
+    def status(self, leaf_id: Optional[str] = None) -> Dict:
+        """ { leaf id : {"status": pending/warming/ready/failed, ...} }, or one leaf's status """
+        with self._lock:
+            self._sync_ready()
+            if leaf_id is not None:
+                return dict(self._status[leaf_id])
+            return {leaf_id: dict(status) for leaf_id, status in self._status.items()}
+
+    def ready(self) -> bool:
+        with self._lock:
+            self._sync_ready()
+            return all(status["status"] == READY for status in self._status.values())
+
+    def index_version(self) -> str:
+        """ Changes whenever a leaf index is (re)built, so cached results of this server can be invalidated (see core/result_cache.py) """
+        with self._lock:
+            self._sync_ready()
+            return f"{self._epoch}.{self._builds}"
+
+    def warming(self) -> List[str]:
+        """ Leaves that can't serve queries yet, including failed ones (see retry_failed()) """
+        with self._lock:
+            self._sync_ready()
+            return [leaf_id for leaf_id, status in self._status.items() if status["status"] != READY]
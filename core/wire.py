@@ -0,0 +1,179 @@
+import base64
+import gzip
+import json
+import math
+from langchain.schema import Document
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import msgpack
+except ImportError:  # optional: compact json is used instead
+    msgpack = None
+
+LEGACY_JSON = "application/json"  # {"docs": [doc.to_json()], ...}, the full langchain serialization envelope
+COMPACT_JSON = "application/vnd.medirag.docs+json"  # {"docs": [[page_content, metadata]], ...}
+MSGPACK = "application/x-msgpack"  # same layout as COMPACT_JSON, as msgpack
+NDJSON = "application/x-ndjson"  # streamed: one {"docs": [[page_content, metadata]], "bound": ...} line per leaf
+COMPRESS_MIN_BYTES = 1024  # responses smaller than this are sent uncompressed, gzip doesn't pay off on them
+
+"""
+Wire format of /api/retrieve.
+Requests are sent as a POST body (msgpack if available, else json) instead of url-encoded json in a GET query string,
+and responses are content-negotiated through the Accept header: hospitals send each doc as [page_content, metadata]
+(optionally only the requested metadata keys), gzip-compressed when the client accepts it. Servers that only speak
+the legacy format answer with doc.to_json() regardless, so decode_response() handles both, and always returns docs
+in the doc.to_json() layout the root pipeline reads. Those that also only accept GET answer a POST with 405, and the
+fan-out (core/fanout.py) resends the fields as an encode_query_params() query string.
+
+With the `stream` field set, a hospital instead streams NDJSON: a line per leaf as soon as it has been searched,
+with the leaf's ranked docs and an upper bound on the score of any doc in later lines (null on the last line),
+so the root can merge as lines arrive and close the stream once later docs can't enter its top k.
+"""
+
+def response_formats() -> List[str]:
+    """ Response formats this process can decode, most preferred first """
+    return ([MSGPACK] if msgpack is not None else []) + [COMPACT_JSON, LEGACY_JSON]
+
+def accept_header() -> str:
+    return ", ".join(response_formats())
+
+def request_format() -> str:
+    return MSGPACK if msgpack is not None else LEGACY_JSON
+
+def _media_type(content_type: Optional[str]) -> str:
+    return (content_type or "").split(";")[0].strip().lower()
+
+def negotiate(accept: Optional[str]) -> str:
+    """ The response format for a request's Accept header (LEGACY_JSON if it names none we can produce) """
+    accepted = [_media_type(media_range) for media_range in (accept or "").split(",")]
+    for fmt in response_formats():
+        if fmt in accepted:
+            return fmt
+    return LEGACY_JSON
+
+
+""" Requests """
+
+def encode_request(fields: Dict[str, Any]) -> Tuple[bytes, str]:
+    """ POST body and content type for /api/retrieve fields (query, userinfo, search_kwargs, ...) """
+    if msgpack is not None:
+        if "query_vector" in fields:  # raw float32 bytes rather than base64
+            fields = fields | {"query_vector": base64.b64decode(fields["query_vector"])}
+        return msgpack.packb(fields), MSGPACK
+    return json.dumps(fields).encode("utf-8"), LEGACY_JSON
+
+def encode_query_params(fields: Dict[str, Any]) -> Dict[str, str]:
+    """ GET query string for /api/retrieve fields, nested values as json """
+    return {name: (value if isinstance(value, str) else json.dumps(value)) for name, value in fields.items()}
+
+def decode_request(args: Dict[str, str], body: bytes, content_type: Optional[str]) -> Dict[str, Any]:
+    """ /api/retrieve fields from a POST body, or from the GET query string if there is no body """
+    if not body:
+        fields = dict(args)
+        for name in ("userinfo", "search_kwargs", "metadata_keys", "stream", "ready_only"):
+            if name in fields:
+                fields[name] = json.loads(fields[name])
+        return fields
+    if _media_type(content_type) == MSGPACK:
+        if msgpack is None:
+            raise ValueError(f"{MSGPACK} request body, but msgpack is not installed")
+        return msgpack.unpackb(body)
+    return json.loads(body)
+
+
+""" Responses """
+
+def compact_doc(doc: Document, metadata_keys: Optional[List[str]] = None) -> list:
+    """ [page_content, metadata], with only `metadata_keys` (and the score) if given """
+    metadata = doc.metadata
+    if metadata_keys is not None:
+        metadata = {key: metadata[key] for key in {*metadata_keys, "score"} if key in metadata}
+    return [doc.page_content, metadata]
+
+def expand_doc(page_content: str, metadata: dict) -> dict:
+    """ A compact doc in the doc.to_json() layout """
+    return {
+        "lc": 1,
+        "type": "constructor",
+        "id": ["langchain", "schema", "document", "Document"],
+        "kwargs": {"page_content": page_content, "metadata": metadata, "type": "Document"},
+    }
+
+def encode_response(
+        docs: List[Document],
+        fmt: str,
+        accept_encoding: Optional[str] = None,
+        metadata_keys: Optional[List[str]] = None,
+        **extra,
+    ) -> Tuple[bytes, Dict[str, str]]:
+    """ Response body and headers for `docs` in format `fmt` (see negotiate()), plus json-serializable `extra` fields """
+    return _encode_payload({"docs": _wire_docs(docs, fmt, metadata_keys), **extra}, fmt, accept_encoding)
+
+def encode_batch_response(
+        doc_lists: List[List[Document]],
+        fmt: str,
+        accept_encoding: Optional[str] = None,
+        metadata_keys: Optional[List[str]] = None,
+        **extra,
+    ) -> Tuple[bytes, Dict[str, str]]:
+    """ Like encode_response, for /api/retrieve_batch: "results" holds the docs of each request, in request order """
+    return _encode_payload({"results": [_wire_docs(docs, fmt, metadata_keys) for docs in doc_lists], **extra}, fmt, accept_encoding)
+
+def _wire_docs(docs: List[Document], fmt: str, metadata_keys: Optional[List[str]]) -> list:
+    if fmt == LEGACY_JSON:
+        return [doc.to_json() for doc in docs]
+    return [compact_doc(doc, metadata_keys) for doc in docs]
+
+def _encode_payload(payload: Dict[str, Any], fmt: str, accept_encoding: Optional[str]) -> Tuple[bytes, Dict[str, str]]:
+    if fmt == MSGPACK:
+        body = msgpack.packb(payload)
+    elif fmt == COMPACT_JSON:
+        body = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    else:
+        body = json.dumps(payload).encode("utf-8")
+
+    headers = {"Content-Type": fmt, "Vary": "Accept, Accept-Encoding"}
+    if len(body) >= COMPRESS_MIN_BYTES and "gzip" in (accept_encoding or ""):
+        body = gzip.compress(body, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+    return body, headers
+
+def decode_response(body: bytes, content_type: Optional[str]) -> Dict[str, Any]:
+    """ Response fields, with "docs" (or each of the batch "results") in the doc.to_json() layout whatever the wire format.
+        `body` is already decompressed
+    """
+    fmt = _media_type(content_type)
+    if fmt == MSGPACK:
+        payload = msgpack.unpackb(body)
+    else:
+        payload = json.loads(body)
+    if fmt in (MSGPACK, COMPACT_JSON):
+        if "docs" in payload:
+            payload["docs"] = [expand_doc(page_content, metadata) for page_content, metadata in payload["docs"]]
+        if "results" in payload:
+            payload["results"] = [[expand_doc(page_content, metadata) for page_content, metadata in docs] for docs in payload["results"]]
+    return payload
+
+
+""" Streamed responses """
+
+def encode_stream(
+        results: Iterable[Tuple[List[Document], float]],
+        metadata_keys: Optional[List[str]] = None,
+        **extra,
+    ) -> Iterator[bytes]:
+    """ NDJSON lines for (ranked docs, bound) results as they are produced (see RouterRetriever.stream_relevant_documents),
+        with json-serializable `extra` fields on the first line, so they arrive even if the root closes the stream early
+    """
+    for i, (docs, bound) in enumerate(results):
+        last = bound == -math.inf
+        line = {"docs": [compact_doc(doc, metadata_keys) for doc in docs], "bound": (None if last else bound), **(extra if i == 0 else {})}
+        yield json.dumps(line, separators=(",", ":")).encode("utf-8") + b"\n"
+
+def decode_stream_line(line: bytes) -> Dict[str, Any]:
+    """ Line fields, with "docs" in the doc.to_json() layout and "bound" -inf on the last line """
+    payload = json.loads(line)
+    payload["docs"] = [expand_doc(page_content, metadata) for page_content, metadata in payload.get("docs", [])]
+    payload["bound"] = -math.inf if payload.get("bound") is None else payload["bound"]
+    return payload
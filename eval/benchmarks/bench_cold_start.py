@@ -0,0 +1,49 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(__file__), "../../")
+
+"""
+Cold start time and peak RSS of a fresh interpreter for the imports a hospital server / eval script does,
+with models loaded lazily (default) and with the loads forced up front, as every import used to do.
+Each scenario runs in its own subprocess, so nothing is shared between measurements.
+"""
+
+SCENARIOS = {
+    "import core.federated_retriever": "import core.federated_retriever",
+    "import core.llm": "import core.llm",
+    "import + load clinical_bert (eager)": "import core.federated_retriever; from core.models import get_model; get_model('clinical_bert')",
+    "import + load flan_t5/gpt2 (eager)": "import core.llm; from core.models import get_model; get_model('flan_t5_large'); get_model('gpt2_medium')",
+}
+
+PROBE = """
+import json, resource, sys, time
+sys.path.append({root!r})
+t1 = time.perf_counter()
+{code}
+print(json.dumps({{"seconds": time.perf_counter() - t1, "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}}))
+"""
+
+def measure(code: str) -> dict:
+    out = subprocess.run([sys.executable, "-c", PROBE.format(root=ROOT, code=code)], capture_output=True, text=True, cwd=ROOT)
+    if out.returncode != 0:
+        return {"error": out.stderr.strip().splitlines()[-1] if out.stderr.strip() else f"exit code {out.returncode}"}
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                    prog='Cold start benchmark',
+                    description='Startup time and peak RSS of module imports with lazy vs. eager model loading')
+    parser.add_argument('-r', '--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    for name, code in SCENARIOS.items():
+        runs = [measure(code) for _ in range(args.repeats)]
+        errors = [run["error"] for run in runs if "error" in run]
+        if errors:
+            print(f"{name}: failed ({errors[0]})")
+            continue
+        print(f"{name}: {min(run['seconds'] for run in runs):.2f} s, max RSS {max(run['max_rss_mb'] for run in runs):.0f} MB")
@@ -0,0 +1,61 @@
+import argparse
+import os
+import pandas as pd
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from langchain_community.document_loaders import DataFrameLoader
+from langchain_community.embeddings import HuggingFaceEmbeddings
+from qdrant_client import QdrantClient
+from qdrant_client.http import models as rest
+from core.embedding_pipeline import EMBED_BATCH_SIZE, EmbedExecutor, embed_and_upsert
+from core.util import chunk_df, prefix_metadata
+
+CLINICAL_BERT_MODEL = "emilyalsentzer/Bio_ClinicalBERT"  # same model as core/federated_retriever.py
+DOCS_CSV = os.path.join(os.path.dirname(__file__), "../../orgs/hospitalA/data/surgery.csv")
+WORKERS = [1, 2, 4]
+
+"""
+Index build throughput of core/embedding_pipeline.py against a single embed_documents call over the same chunks
+(torch using every core, as before the pipeline), for a few worker counts. Chunks are upserted into an in-memory
+Qdrant collection, so the numbers include the upserts the pipeline overlaps with embedding.
+"""
+
+def baseline(embedding, texts):
+    t1 = time.perf_counter()
+    embedding.embed_documents(texts)
+    return time.perf_counter() - t1
+
+def pipeline(embedding, docs, n_workers, batch_size, dim):
+    client = QdrantClient(":memory:")
+    client.create_collection(collection_name="bench", vectors_config=rest.VectorParams(size=dim, distance=rest.Distance.COSINE))
+    with EmbedExecutor(n_workers) as executor:
+        t1 = time.perf_counter()
+        embed_and_upsert(client, "bench", [(i, doc) for i, doc in enumerate(docs)], embedding, batch_size=batch_size, executor=executor)
+        return time.perf_counter() - t1, executor.torch_threads
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                    prog='Embedding pipeline benchmark',
+                    description='Compare the batched, multi-worker index build with a single embed_documents call')
+    parser.add_argument('--docs-csv', default=DOCS_CSV, help="department csv whose chunks are embedded")
+    parser.add_argument('-n', '--n-docs', type=int, default=None, help="embed only the first n chunks")
+    parser.add_argument('-b', '--batch-size', type=int, default=EMBED_BATCH_SIZE)
+    parser.add_argument('-w', '--workers', type=int, nargs="*", default=WORKERS)
+    args = parser.parse_args()
+
+    df = chunk_df(pd.read_csv(args.docs_csv), chunk_col="text")
+    prefix_metadata(df=df, chunk_col="text", metadata_cols=["name"])
+    docs = DataFrameLoader(df).load()[:args.n_docs]
+    texts = [doc.page_content for doc in docs]
+
+    embedding = HuggingFaceEmbeddings(model_name=CLINICAL_BERT_MODEL, model_kwargs={}, encode_kwargs={"normalize_embeddings": True})
+    dim = len(embedding.embed_query("dimension probe"))  # also loads the model before timing
+    print(f"{len(docs)} chunks, {os.cpu_count()} cpus")
+
+    single = baseline(embedding, texts)
+    print(f"embed_documents: {single:.1f} s, {len(docs) / single:.1f} chunks/s")
+    for n_workers in args.workers:
+        elapsed, torch_threads = pipeline(embedding, docs, n_workers, args.batch_size, dim)
+        print(f"pipeline, {n_workers} workers x {torch_threads} torch threads: {elapsed:.1f} s, "
+              f"{len(docs) / elapsed:.1f} chunks/s, speedup {single / elapsed:.2f}x")
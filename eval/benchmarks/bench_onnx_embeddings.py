@@ -0,0 +1,69 @@
+import argparse
+import numpy as np
+import os
+import pandas as pd
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from langchain_community.document_loaders import DataFrameLoader
+from langchain_community.embeddings import HuggingFaceEmbeddings
+from core.onnx_embeddings import OnnxEmbeddings
+from core.util import chunk_df, prefix_metadata
+
+CLINICAL_BERT_MODEL = "emilyalsentzer/Bio_ClinicalBERT"  # same model as core/federated_retriever.py
+QUESTIONS_CSV = os.path.join(os.path.dirname(__file__), "../clinical_trend_qa.csv")
+DOCS_CSV = os.path.join(os.path.dirname(__file__), "../../orgs/hospitalA/data/surgery.csv")
+TOP_K = 10
+
+"""
+Accuracy parity and latency/throughput of the int8 ONNX query backend against full-precision ClinicalBERT.
+Parity: cosine similarity between the two backends' vectors for every eval question, and overlap of the
+top-k chunks each question retrieves from a department (with chunks embedded by full-precision ClinicalBERT,
+as in a leaf index).
+"""
+
+def time_queries(embedding, questions, repeats):
+    latencies = []
+    for _ in range(repeats):
+        for q in questions:
+            t1 = time.perf_counter()
+            embedding.embed_query(q)
+            latencies.append(time.perf_counter() - t1)
+    return np.array(latencies) * 1000
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                    prog='ONNX embedding benchmark',
+                    description='Compare the int8 ONNX Runtime ClinicalBERT backend against the full-precision model')
+    parser.add_argument('--docs-csv', default=DOCS_CSV, help="department csv whose chunks are searched for the top-k parity check")
+    parser.add_argument('-r', '--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    questions = pd.read_csv(QUESTIONS_CSV)["question"].tolist()
+    df = chunk_df(pd.read_csv(args.docs_csv), chunk_col="text")
+    prefix_metadata(df=df, chunk_col="text", metadata_cols=["name"])
+    chunks = [doc.page_content for doc in DataFrameLoader(df).load()]
+
+    torch_emb = HuggingFaceEmbeddings(model_name=CLINICAL_BERT_MODEL, model_kwargs={}, encode_kwargs={"normalize_embeddings": True})
+    onnx_emb = OnnxEmbeddings(CLINICAL_BERT_MODEL)
+
+    # accuracy parity
+    torch_q = np.array(torch_emb.embed_documents(questions))
+    onnx_q = np.array(onnx_emb.embed_documents(questions))
+    cos = (torch_q * onnx_q).sum(axis=1)
+    chunk_vecs = np.array(torch_emb.embed_documents(chunks))
+    torch_top = np.argsort(-(torch_q @ chunk_vecs.T), axis=1)[:, :TOP_K]
+    onnx_top = np.argsort(-(onnx_q @ chunk_vecs.T), axis=1)[:, :TOP_K]
+    overlap = [len(set(t) & set(o)) / TOP_K for t, o in zip(torch_top, onnx_top)]
+    print(f"{len(questions)} questions, {len(chunks)} chunks")
+    print(f"cosine(torch, onnx): min {cos.min():.4f}, mean {cos.mean():.4f}")
+    print(f"top-{TOP_K} overlap: min {min(overlap):.2f}, mean {np.mean(overlap):.2f}")
+
+    # latency (single query, as at search time) and throughput (batched, as at index build time)
+    for name, embedding in (("torch", torch_emb), ("onnx-int8", onnx_emb)):
+        latencies = time_queries(embedding, questions, args.repeats)
+        t1 = time.perf_counter()
+        embedding.embed_documents(chunks)
+        throughput = len(chunks) / (time.perf_counter() - t1)
+        print(f"{name}: query latency p50 {np.percentile(latencies, 50):.1f} ms, p95 {np.percentile(latencies, 95):.1f} ms, "
+              f"throughput {throughput:.1f} chunks/s")
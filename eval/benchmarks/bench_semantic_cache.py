@@ -0,0 +1,126 @@
+import argparse
+import numpy as np
+import os
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from core.federated_retriever import CLINICAL_BERT, RootRetriever, embed_queries
+from core.result_cache import ResultCache, get_result_cache
+from eval.scalability.questions import QUESTIONS
+
+PARAPHRASES = [  # two rewordings of each of QUESTIONS, in the same order
+    ["What are the most common diagnoses among patients admitted here who report drinking heavily?",
+     "Which diagnoses are most frequent for admitted patients with heavy alcohol use?"],
+    ["What chief complaints are most common among general surgery patients?",
+     "Which chief complaints do patients receiving general surgery most often present with?"],
+    ["What complications do patients experience after coronary artery bypass surgery?",
+     "Which complications are seen in patients who had a coronary artery bypass?"],
+    ["Which diagnoses are common for patients who report abdominal pain?",
+     "For patients with abdominal pain, what are some of the common diagnoses?"],
+    ["Among neurology patients, what are the most significant stroke risk factors?",
+     "Which risk factors for stroke are most significant in neurology patients?"],
+    ["Do more patients at Hospital A use Medicare or Medicaid for insurance?",
+     "Among patients at Hospital A, is Medicaid or Medicare the more common insurance?"],
+    ["What surgical procedure was performed most often for patients admitted for cardiology or cardiothoracic services?",
+     "For cardiology and cardiothoracic admissions, which surgical procedure was most common?"],
+    ["For patients with a history of drug or alcohol use, what were the most severe withdrawal symptoms and how were they treated?",
+     "How were withdrawal symptoms treated in patients with a history of drug or alcohol use, and which symptoms were the most severe?"],
+    ["Do patients more often present to the emergency department for orthopedic surgery after a mechanical fall, or with pain from preexisting conditions?",
+     "Is a mechanical fall or pain from a preexisting health condition the more common reason orthopedic surgery patients come to the emergency department?"],
+]
+THRESHOLDS = [0.90, 0.93, 0.95, 0.97, 0.98, 0.99]
+USERINFO = {"name": "A.phys", "org": "A", "role": "physician", "dept": "surgery", "sub": "0"}
+
+"""
+Hit rate and latency savings of the root's result cache (core/result_cache.py) on the scalability QUESTIONS.
+The workload asks every question as written, then again with different whitespace (exact hits), then each of its
+PARAPHRASES (semantic hits). Each threshold is replayed against a fresh cache on the embeddings of the root's
+query model, counting hits that were served another question's results as false hits.
+With --uris (e.g. the servers started by eval/scalability/scalability.py), the workload is also run through a
+RootRetriever against them, with the cache off and on, to measure the latency actually saved.
+"""
+
+def workload():
+    """ [(query, index of the question it asks)] """
+    queries = [(q, i) for i, q in enumerate(QUESTIONS)]
+    queries += [("  " + q.replace(" ", "  "), i) for i, q in enumerate(QUESTIONS)]
+    queries += [(paraphrases[round], i) for round in range(2) for i, paraphrases in enumerate(PARAPHRASES)]
+    return queries
+
+def replay(queries, vectors, threshold):
+    """ (exact hits, semantic hits, false hits) of a fresh cache over `queries` """
+    cache = ResultCache()
+    cache.observe("bench", {"userinfo_attributes": [], "version": "bench"})
+    false_hits = 0
+    for (query, i), vector in zip(queries, vectors):
+        key = cache.key(query, USERINFO, {"k": 10}, ["bench"])
+        docs = cache.get(key, vector, threshold)
+        if docs is None:
+            cache.put(key, [i], {"bench": "bench"}, vector)
+        elif docs != [i]:
+            false_hits += 1
+    return cache.hits, cache.semantic_hits, false_hits
+
+def similarity_report(vectors):
+    units = np.asarray(vectors, dtype=np.float32)
+    units /= np.linalg.norm(units, axis=1, keepdims=True)
+    n = len(QUESTIONS)
+    originals, paraphrases = units[:n], units[2 * n:]
+    owners = [i for round in range(2) for i in range(n)]
+    similarities = paraphrases @ originals.T
+    own = np.array([similarities[j, i] for j, i in enumerate(owners)])
+    other = np.array([np.delete(similarities[j], i).max() for j, i in enumerate(owners)])
+    between = (originals @ originals.T)[~np.eye(n, dtype=bool)]
+    print(f"cosine similarity, paraphrase to its question: min {own.min():.3f} mean {own.mean():.3f}")
+    print(f"cosine similarity, paraphrase to the closest other question: max {other.max():.3f} mean {other.mean():.3f}")
+    print(f"cosine similarity between distinct questions: max {between.max():.3f} mean {between.mean():.3f}")
+
+def timed_run(queries, uris, cache_results, threshold):
+    retriever = RootRetriever(hospital_retrieve_uris=uris, userinfo=USERINFO, search_kwargs={"k": 10, "fetch_k": 20},
+                              timeout=None, deadline=None, cache_results=cache_results, semantic_cache_threshold=threshold)
+    times = []
+    for query, _ in queries:
+        t1 = time.perf_counter()
+        retriever.get_relevant_documents(query)
+        times.append(time.perf_counter() - t1)
+    return times
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                    prog='Semantic cache benchmark',
+                    description='Hit rate and latency savings of the exact and semantic result cache on the scalability questions')
+    parser.add_argument('--threshold', type=float, default=None, help="semantic threshold for the timed run, by default the lowest threshold without false hits")
+    parser.add_argument('--uris', nargs="*", default=[], help="hospital retrieve uris for the timed run, e.g. http://127.0.0.1:5001/api/retrieve")
+    args = parser.parse_args()
+
+    queries = workload()
+    t1 = time.perf_counter()
+    vectors = embed_queries([query for query, _ in queries])
+    print(f"{len(queries)} queries ({len(QUESTIONS)} questions), embedded in {(time.perf_counter() - t1) * 1000 / len(queries):.1f} ms/query (batched)")
+    t1 = time.perf_counter()
+    CLINICAL_BERT.embed_query(QUESTIONS[0])
+    print(f"one query embedding (added to every lookup with a semantic threshold): {(time.perf_counter() - t1) * 1000:.1f} ms")
+    similarity_report(vectors)
+
+    hits, _, _ = replay(queries, vectors, None)
+    print(f"exact only: hit rate {hits / len(queries):.0%} ({hits} hits)")
+    safe_thresholds = []
+    for threshold in THRESHOLDS:
+        hits, semantic_hits, false_hits = replay(queries, vectors, threshold)
+        print(f"threshold {threshold:.2f}: hit rate {(hits + semantic_hits) / len(queries):.0%} "
+              f"({hits} exact, {semantic_hits} semantic, {false_hits} served another question's results)")
+        if not false_hits:
+            safe_thresholds.append(threshold)
+    threshold = args.threshold if args.threshold is not None else min(safe_thresholds, default=None)
+    print(f"lowest threshold without false hits: {min(safe_thresholds, default=None)}")
+
+    if args.uris:
+        timed_run(queries[:1], args.uris, cache_results=False, threshold=None)  # warm up connections and models
+        uncached = timed_run(queries, args.uris, cache_results=False, threshold=None)
+        get_result_cache().clear()
+        cached = timed_run(queries, args.uris, cache_results=True, threshold=threshold)
+        stats = get_result_cache().stats()
+        print(f"no cache: {np.mean(uncached):.2f} s/query, total {sum(uncached):.1f} s")
+        print(f"cache (threshold {threshold}): {np.mean(cached):.2f} s/query, total {sum(cached):.1f} s, "
+              f"saved {1 - sum(cached) / sum(uncached):.0%}; hit rate {stats['hit_rate']:.0%} "
+              f"({stats['hits']} exact, {stats['semantic_hits']} semantic)")
@@ -0,0 +1,57 @@
+import argparse
+import gzip
+import os
+import pandas as pd
+import random
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from langchain.schema import Document
+from core.util import chunk_df
+from core.wire import COMPACT_JSON, MSGPACK, decode_response, encode_response, response_formats
+
+DEFAULT_CSV = os.path.join(os.path.dirname(__file__), "../../orgs/hospitalB/data/medicine.csv")
+EVAL_METADATA_KEYS = ["org", "note_id", "text_index", "row"]  # what eval/evaluation.py reads to identify a doc
+
+"""
+Response size and root-side parse time of /api/retrieve in each wire format (see core/wire.py),
+for k chunks of a department CSV with the metadata a leaf attaches to them.
+"""
+
+def sample_docs(csv: str, k: int) -> list:
+    chunked_df = chunk_df(pd.read_csv(csv), chunk_col="text")
+    rows = chunked_df.sample(n=min(k, len(chunked_df)), random_state=0)
+    docs = []
+    for i, row in rows.iterrows():
+        metadata = {col: row[col] for col in chunked_df.columns if col != "text"}
+        metadata = {key: (value.item() if hasattr(value, "item") else value) for key, value in metadata.items()}  # numpy -> python
+        docs.append(Document(page_content=row["text"], metadata=metadata | {"text_index": int(i), "org": "A", "dept_id": "medicine", "score": random.random()}))
+    return sorted(docs, key=lambda doc: doc.metadata["score"], reverse=True)
+
+def time_decode(body: bytes, content_type: str, repeats: int) -> float:
+    times = []
+    for _ in range(repeats):
+        t1 = time.perf_counter()
+        decode_response(gzip.decompress(body) if body[:2] == b"\x1f\x8b" else body, content_type)
+        times.append(time.perf_counter() - t1)
+    return min(times)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+                    prog='Wire format benchmark',
+                    description='Compare /api/retrieve response size and parse time across wire formats')
+    parser.add_argument('--csv', default=DEFAULT_CSV, help="department csv with a longform text column")
+    parser.add_argument('-k', type=int, default=10, help="docs per response (SEARCH_KWARGS k in app/pipeline.py)")
+    parser.add_argument('-r', '--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    docs = sample_docs(args.csv, args.k)
+    print(f"{args.csv}: {len(docs)} docs per response")
+    cases = [(fmt, None) for fmt in response_formats()] + [(fmt, EVAL_METADATA_KEYS) for fmt in (COMPACT_JSON, MSGPACK) if fmt in response_formats()]
+    for fmt, metadata_keys in cases:
+        raw, _ = encode_response(docs, fmt, metadata_keys=metadata_keys, query="", warming=[])
+        compressed, _ = encode_response(docs, fmt, accept_encoding="gzip", metadata_keys=metadata_keys, query="", warming=[])
+        assert decode_response(raw, fmt)["docs"][0]["kwargs"]["page_content"] == docs[0].page_content
+        name = fmt + ("" if metadata_keys is None else f" (metadata_keys={metadata_keys})")
+        print(f"{name}: {len(raw) / 1024:.1f} KB, gzip {len(compressed) / 1024:.1f} KB, "
+              f"parse {time_decode(raw, fmt, args.repeats) * 1000:.2f} ms, gunzip + parse {time_decode(compressed, fmt, args.repeats) * 1000:.2f} ms")
@@ -3,7 +3,7 @@ import os
 import pandas as pd
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), "../"))
-from app.pipeline import create_rag_chain_with_source, GPT_LLM
+from app.pipeline import create_answer_chain, create_root_retriever, GPT_LLM
 
 logger = logging.getLogger("log")
 logger.propagate = False
@@ -25,13 +25,14 @@ USERINFOS = [
 ]
 EVAL_PAIRS = [("centralized_insecure", "federated_insecure")] + [("federated_insecure", f"federated_secure_{user['name']}") for user in USERINFOS] # (ref, pred)
 
-def eval_scenario(rag_chain, scenario: str, eval_df: pd.DataFrame, user: str | None = None):
+def eval_scenario(answer_chain, scenario: str, eval_df: pd.DataFrame, documents: list, user: str | None = None):
+    # `documents`: each question's docs, retrieved beforehand in a batch
     scenario_name = scenario + '_' + user if user else scenario
     print(f"evaluating {scenario_name} scenario", end="")
     logger.debug(f"\n\n*** EVALUATING SCENARIO: {scenario_name.upper()} ***\n")
 
     for i, query in enumerate(eval_df["question"]):    
-        response = rag_chain.invoke(query)
+        response = answer_chain.invoke({"question": query, "documents": documents[i]})
         eval_df.at[i, f"{scenario_name}"] = response["answer"]
         eval_df.at[i, f"{scenario_name}_docs"] = str([doc['kwargs']['page_content'] for doc in response["documents"]])
 
@@ -40,20 +41,29 @@ def eval_scenario(rag_chain, scenario: str, eval_df: pd.DataFrame, user: str | N
 def main(llm):
     eval_df = pd.read_csv(CLINICAL_TREND_QA_PATH)
 
+    questions = eval_df["question"].tolist()
+    answer_chain = create_answer_chain(llm=llm)
+
+    # NOTE the root's result cache stays off, repeated questions must measure retrieval rather than cache hits
     # NOTE since this is insecure we can provide any userinfo to achieve same result
-    fi_chain = create_rag_chain_with_source(userinfo=USERINFOS[0], llm=llm, secure=False)
+    fi_retriever = create_root_retriever(userinfo=USERINFOS[0], secure=False, slo=None, cache_results=False)
     eval_scenario(
-        rag_chain=fi_chain, 
+        answer_chain=answer_chain, 
         scenario="federated_insecure", 
         eval_df=eval_df, 
+        documents=[result["documents"] for result in fi_retriever.retrieve_batch(questions)],
     )
 
-    for userinfo in USERINFOS:
-        fs_chain = create_rag_chain_with_source(userinfo=userinfo, llm=llm)
+    # every (question, user) pair in one /api/retrieve_batch request per hospital
+    fs_retriever = create_root_retriever(userinfo=USERINFOS[0], slo=None, cache_results=False)
+    fs_results = fs_retriever.retrieve_batch(questions * len(USERINFOS), userinfos=[userinfo for userinfo in USERINFOS for _ in questions])
+    fs_documents = [result["documents"] for result in fs_results]
+    for u, userinfo in enumerate(USERINFOS):
         eval_scenario(
-            rag_chain=fs_chain, 
+            answer_chain=answer_chain, 
             scenario=f"federated_secure", 
             eval_df=eval_df, 
+            documents=fs_documents[u * len(questions):(u + 1) * len(questions)],
             user=userinfo['name']
         )
 
@@ -10,11 +10,11 @@ from langchain.schema.output_parser import StrOutputParser
 from langchain_community.document_loaders import DataFrameLoader
 from operator import itemgetter
 
-from app.pipeline import create_rag_chain_with_source, format_docs, PROMPT, GPT_LLM, SEARCH_KWARGS
+from app.pipeline import create_answer_chain, create_root_retriever, format_docs, PROMPT, GPT_LLM, SEARCH_KWARGS
 from core.util import chunk_df, prefix_metadata
 from core.federated_retriever import BaselineRetriever
 from core.full_df_loader import AllColumnsDataFrameLoader
-from core.llm import Dummy, FlanT5, MEDITRON_LLM
+from core.llm import Dummy, FlanT5, get_meditron_llm
 from orgs.hospitalA.hosp_bp import HOSP_DATA_PATH as A_HOSP_DATA_PATH, DEPTS as A_DEPTS
 from orgs.hospitalB.hosp_bp import HOSP_DATA_PATH as B_HOSP_DATA_PATH, DEPTS as B_DEPTS
 from orgs.hospitalC.hosp_bp import HOSP_DATA_PATH as C_HOSP_DATA_PATH, DEPTS as C_DEPTS
@@ -90,7 +90,8 @@ def create_baseline_rag_chain(dfs: list[tuple[bool, pd.DataFrame]], llm=GPT_LLM)
 
     return rag_chain_with_source
 
-def eval_scenario(rag_chain, scenario: str, eval_df: pd.DataFrame, llm_eval_df: pd.DataFrame, llm_name: str, user: str | None = None):
+def eval_scenario(rag_chain, scenario: str, eval_df: pd.DataFrame, llm_eval_df: pd.DataFrame, llm_name: str, user: str | None = None, documents: list | None = None):
+    # with `documents` (each question's docs, retrieved beforehand in a batch), rag_chain is an answer chain (see create_answer_chain)
     scenario_name = scenario + '_' + user if user else scenario
     print(f"evaluating {scenario_name} scenario", end="")
     logger.debug(f"\n\n*** EVALUATING SCENARIO: {scenario_name.upper()} ***\n")
@@ -108,7 +109,7 @@ def eval_scenario(rag_chain, scenario: str, eval_df: pd.DataFrame, llm_eval_df:
         sys.stdout.flush()
         logger.debug(f"scenario: {prompt_name} idx: {prompt_idx}\nquery:{query}")
         
-        response = rag_chain.invoke(query)
+        response = rag_chain.invoke(query if documents is None else {"question": query, "documents": documents[i]})
         eval_df.at[i, f"{scenario_name}"] = response["answer"]
         logger.debug(f"answer:{response['answer']}\n")
 
@@ -163,7 +164,7 @@ def eval_meditron():
     logger.debug("\n\n *** EVALUATING SCENARIO: baseline CI with MEDITRON LLM ***")
     llm_eval_df = pd.read_csv(LLM_EVAL_PATH)
     for i, prompt in enumerate(llm_eval_df["prompt"]):
-        response = MEDITRON_LLM.invoke(prompt)
+        response = get_meditron_llm().invoke(prompt)
         logger.debug(f"\n\n ***** #{i} ***** \n {response} \n")
         llm_eval_df.at[i, "meditron-7b"] = response
     llm_eval_df.to_csv(LLM_EVAL_PATH, index=False)
@@ -191,27 +192,37 @@ def main(args, llm, llm_name):
             llm_name=llm_name
         )
 
+    # federated scenarios retrieve all questions up front, with one /api/retrieve_batch request per hospital
+    questions = eval_df["question"].tolist()
+    answer_chain = create_answer_chain(llm=llm)
+
     if args.federated_insecure:
+        # NOTE the root's result cache stays off, repeated questions must measure retrieval rather than cache hits
         # NOTE since this is insecure we can provide any userinfo to achieve same result
-        fi_chain = create_rag_chain_with_source(userinfo=USERINFOS[0], llm=llm, secure=False)
+        fi_retriever = create_root_retriever(userinfo=USERINFOS[0], secure=False, slo=None, cache_results=False)
         eval_scenario(
-            rag_chain=fi_chain, 
+            rag_chain=answer_chain, 
             scenario="federated_insecure", 
             eval_df=eval_df, 
             llm_eval_df=llm_eval_df, 
-            llm_name=llm_name
+            llm_name=llm_name,
+            documents=[result["documents"] for result in fi_retriever.retrieve_batch(questions)]
         )
 
     if args.federated_secure:
-        for userinfo in USERINFOS:
-            fs_chain = create_rag_chain_with_source(userinfo=userinfo, llm=llm)
+        # every (question, user) pair in one batch
+        fs_retriever = create_root_retriever(userinfo=USERINFOS[0], slo=None, cache_results=False)
+        fs_results = fs_retriever.retrieve_batch(questions * len(USERINFOS), userinfos=[userinfo for userinfo in USERINFOS for _ in questions])
+        fs_documents = [result["documents"] for result in fs_results]
+        for u, userinfo in enumerate(USERINFOS):
             eval_scenario(
-                rag_chain=fs_chain, 
+                rag_chain=answer_chain, 
                 scenario=f"federated_secure", 
                 eval_df=eval_df, 
                 llm_eval_df=llm_eval_df, 
                 llm_name=llm_name, 
-                user=userinfo['name']
+                user=userinfo['name'],
+                documents=fs_documents[u * len(questions):(u + 1) * len(questions)]
             )
 
     if args.eval_llm:
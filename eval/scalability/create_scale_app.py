@@ -1,27 +1,49 @@
-from flask import Flask, Blueprint, jsonify, request
-import json
+from flask import Flask, Blueprint, Response, request, stream_with_context
 import os
 import sys 
+import uuid
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
+from core.federated_retriever import decode_query_vector, tree_pdps
+from core.result_cache import cache_info
+from core.wire import NDJSON, decode_request, encode_batch_response, encode_response, encode_stream, negotiate
 
 ORG_RETRIEVER = None
+INDEX_VERSION = None  # per server process, leaves are built once
 
 hosp_bp = Blueprint('scale', __name__)
-@hosp_bp.route('/api/retrieve', methods=['GET'])
+@hosp_bp.route('/api/retrieve', methods=['GET', 'POST'])
 def retrieve():
-    if request.method == 'GET':
-        print(f"/api/retrieve GET args={request.args}")
-        query = request.args.get('query')
-        userinfo = json.loads(request.args.get('userinfo'))
-        search_kwargs = json.loads(request.args.get('search_kwargs'))
-        docs = ORG_RETRIEVER.get_relevant_documents(query=query, userinfo=userinfo, search_kwargs=search_kwargs)
-        print(f"retrieved {len(docs)} docs.")
-        return jsonify(docs=[doc.to_json() for doc in docs], query=query)
-    return jsonify()
+    fields = decode_request(request.args, request.get_data(), request.content_type)
+    print(f"/api/retrieve {request.method} query={fields.get('query')!r}")
+    query = fields['query']
+    query_vector = decode_query_vector(fields)
+    if fields.get('stream'):
+        results = ORG_RETRIEVER.stream_relevant_documents(query=query, userinfo=fields['userinfo'], search_kwargs=fields['search_kwargs'], query_vector=query_vector)
+        lines = encode_stream(results, metadata_keys=fields.get('metadata_keys'), query=query, cache=cache_info(tree_pdps(ORG_RETRIEVER), INDEX_VERSION))
+        return Response(stream_with_context(lines), mimetype=NDJSON)
+    docs = ORG_RETRIEVER.get_relevant_documents(query=query, userinfo=fields['userinfo'], search_kwargs=fields['search_kwargs'], query_vector=query_vector)
+    print(f"retrieved {len(docs)} docs.")
+    body, headers = encode_response(docs, negotiate(request.headers.get('Accept')), request.headers.get('Accept-Encoding'),
+                                    metadata_keys=fields.get('metadata_keys'), query=query, cache=cache_info(tree_pdps(ORG_RETRIEVER), INDEX_VERSION))
+    return Response(body, headers=headers)
+
+@hosp_bp.route('/api/retrieve_batch', methods=['POST'])
+def retrieve_batch():
+    fields = decode_request(request.args, request.get_data(), request.content_type)
+    batch = [
+        dict(query=req['query'], userinfo=req['userinfo'], search_kwargs=req['search_kwargs'], query_vector=decode_query_vector(req))
+        for req in fields['requests']
+    ]
+    print(f"/api/retrieve_batch POST {len(batch)} requests")
+    doc_lists = ORG_RETRIEVER.batch_relevant_documents(batch)
+    body, headers = encode_batch_response(doc_lists, negotiate(request.headers.get('Accept')), request.headers.get('Accept-Encoding'),
+                                          metadata_keys=fields.get('metadata_keys'), cache=cache_info(tree_pdps(ORG_RETRIEVER), INDEX_VERSION))
+    return Response(body, headers=headers)
 
 def create_scale_app(name, uri, org_retriever):
-    global ORG_RETRIEVER
+    global ORG_RETRIEVER, INDEX_VERSION
     ORG_RETRIEVER = org_retriever
+    INDEX_VERSION = uuid.uuid4().hex[:12]
 
     print(f"CREATING SCALE APP name={name} uri={uri}")
     app = Flask(__name__)
@@ -0,0 +1,11 @@
+QUESTIONS = [  # all general evaluation questions
+    "For patients admitted to this practice who report heavy alcohol consumption, what are some of the most common diagnoses?",
+    "For patients receiving general surgery, what are the most common chief complaints?",
+    "What are some complications experienced by patients who underwent coronary artery bypass?",
+    "What are some common diagnoses for patients reporting abdominal pain?",
+    "What are the most significant risk factors for stroke among neurology patients?",
+    "Is Medicare or Medicaid more widely used for insurance among patients at Hospital A?",
+    "For patients admitted for cardiology or cardiothoracic services, what was the most common surgical procedure performed?",
+    "What are the most severe withdrawal symptoms experienced by patients with a history of drug or alcohol use, and how were withdrawal symptoms treated?",
+    "Is it more common for patients to present to the emergency department for orthopedic surgery due to a mechanical fall, or due to pain from preexisting health conditions?",
+]
@@ -4,7 +4,7 @@ export AUTHLIB_INSECURE_TRANSPORT=1
 for n in 20 15 10 5 1; 
 do
     echo "Running Experiment (n=$n, d=1)"
-    python3 scalability.py -n $n -d 1
+    python3 scalability.py -n $n -d 1 --preload
     pkill -f 'python3'
 done
 
@@ -12,6 +12,6 @@ done
 for d in 1 2 3 4;
 do
     echo "Running Experiment (n=1, d=$d)"
-    python3 scalability.py -n 1 -d $d
+    python3 scalability.py -n 1 -d $d --preload
     pkill -f 'python3'
 done
\ No newline at end of file
@@ -6,23 +6,25 @@ import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
 from app.pipeline import create_rag_chain_with_source
 from core.federated_retriever import RootRetriever, RouterRetriever, LeafRetriever
+from core.models import preload_for_fork
 from eval.scalability.create_scale_app import create_scale_app
+from eval.scalability.questions import QUESTIONS
 
-QUESTIONS = [  # all general evaluation questions
-    "For patients admitted to this practice who report heavy alcohol consumption, what are some of the most common diagnoses?",
-    "For patients receiving general surgery, what are the most common chief complaints?",
-    "What are some complications experienced by patients who underwent coronary artery bypass?",
-    "What are some common diagnoses for patients reporting abdominal pain?",
-    "What are the most significant risk factors for stroke among neurology patients?",
-    "Is Medicare or Medicaid more widely used for insurance among patients at Hospital A?",
-    "For patients admitted for cardiology or cardiothoracic services, what was the most common surgical procedure performed?",
-    "What are the most severe withdrawal symptoms experienced by patients with a history of drug or alcohol use, and how were withdrawal symptoms treated?",
-    "Is it more common for patients to present to the emergency department for orthopedic surgery due to a mechanical fall, or due to pain from preexisting health conditions?",
-]
 DATA_DF = pd.read_csv("data.csv")
 USERINFO = {"name": "A.phys", "org": "A", "role": "physician", "dept": "surgery", "sub": "0"}  # attributes don't matter for this test
 # N_VALS = [1, 5, 10, 15, 20]
 # D_VALS = [0, 1, 2, 3, 4]
+SERVER_PIDS = []  # forked hospital servers, for the memory report
+
+def process_memory(pid):
+    # MB of resident memory; pss splits shared pages between the processes sharing them, so it sums to the real total
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        fields = {line.split(":")[0]: int(line.split()[1]) for line in f if line.split()[-1] == "kB"}
+    return {
+        "rss": fields["Rss"] / 1024,
+        "pss": fields["Pss"] / 1024,
+        "shared": (fields["Shared_Clean"] + fields["Shared_Dirty"]) / 1024,
+    }
 
 def gen_org_subtrees(df, n=1, d=0):
     # return list of len n of each hospital's subtree
@@ -53,17 +55,22 @@ def gen_org_subtrees(df, n=1, d=0):
         if pid == 0:
             org_app.run(port=5001+i)
             print("THIS SHOULD NOT PRINT OUT!")
+        SERVER_PIDS.append(pid)
         org_subtrees.append(org_root)
 
     return org_subtrees
 
 
 # measure: qdrant creation time, retrieval time (on same plot, 1 plot for each axis)
-def profile(N, D):
+def profile(N, D, preload=False):
+    if preload:
+        # load ClinicalBERT once here, so the forked hospital servers share its weights instead of each loading a copy
+        preload_for_fork(["clinical_bert"])
+
     # test width
     gen_org_subtrees(df=DATA_DF, n=N, d=D)
     org_retrieve_uris = {f"http://127.0.0.1:{5001+i}/api/retrieve" for i in range(N)}
-    chain = create_rag_chain_with_source(userinfo=USERINFO, hospital_retrieve_uris=org_retrieve_uris)
+    chain = create_rag_chain_with_source(userinfo=USERINFO, hospital_retrieve_uris=org_retrieve_uris, slo=None, cache_results=False)
     for qi, q in enumerate(QUESTIONS):
         with open("retrieval_report.txt", "a") as ret_f:
             with open("qdrant_report.txt", "a") as qdrant_f:
@@ -73,6 +80,16 @@ def profile(N, D):
                 ret_f.write("========================================\n")
                 qdrant_f.write("========================================\n")
 
+    with open("memory_report.txt", "a") as mem_f:
+        mem_f.write(f"========================================\nN={N} D={D} PRELOAD={preload}\n")
+        for pid in [os.getpid()] + SERVER_PIDS:
+            try:
+                mem = process_memory(pid)
+            except FileNotFoundError:  # server exited
+                continue
+            mem_f.write(f"PID={pid} RSS={mem['rss']:.0f}MB PSS={mem['pss']:.0f}MB SHARED={mem['shared']:.0f}MB\n")
+        mem_f.write("========================================\n")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
                     prog='Scalability Eval',
@@ -80,10 +97,11 @@ if __name__ == "__main__":
 
     parser.add_argument('-n', type=int, help="width of retrieval tree (i.e. number of hospital servers)")
     parser.add_argument('-d', type=int, help="depth of retrieval tree (i.e. number of router retriever levels in a hospital tree)")
+    parser.add_argument('--preload', action='store_true', help="load embedding model weights once before forking hospital servers (shared copy-on-write)")
 
     args = parser.parse_args()
     if args.n is not None and args.d is not None:
-        profile(N=args.n, D=args.d)   
+        profile(N=args.n, D=args.d, preload=args.preload)   
     else:
         print("Please specify a retrieval tree width (-n) and depth (-d) to profile")
     
\ No newline at end of file
@@ -3,7 +3,7 @@ import os
 import sys 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
 from orgs.auth_skeleton.setup import setup_auth
-from orgs.hospitalA.hosp_bp import hosp_bp
+from orgs.hospitalA.hosp_bp import hosp_bp, leaf_warmup
 
 app = Flask(__name__)
 app.config.update({'HOSPITAL_ID': 'hospitalA'})
@@ -19,4 +19,5 @@ app = setup_auth(app, "A.txt",
         'SQLALCHEMY_DATABASE_URI': 'sqlite:///hospitalA.db.sqlite',
     }
 )
-app.register_blueprint(hosp_bp, url_prefix='')
\ No newline at end of file
+app.register_blueprint(hosp_bp, url_prefix='')
+leaf_warmup.start()  # build leaf indexes in the background while the server starts accepting requests
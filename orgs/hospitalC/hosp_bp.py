@@ -4,7 +4,8 @@ from flask import (
     jsonify, 
     url_for, 
     Response,
-    current_app
+    current_app,
+    stream_with_context
 )
 import json
 import os
@@ -12,9 +13,13 @@ import pandas as pd
 import sys 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../"))
 
-from py_abac.storage.memory import MemoryStorage
-from py_abac import PDP, EvaluationAlgorithm, Policy
-from core.federated_retriever import LeafRetriever, RouterRetriever
+from py_abac import EvaluationAlgorithm, Policy
+from core.abac_cache import CachedPDP, VersionedMemoryStorage
+from core.federated_retriever import LeafRetriever, RouterRetriever, decode_query_vector, tree_pdps
+from core.gate_cache import GateDecisionCache
+from core.result_cache import cache_info
+from core.warmup import LeafWarmup
+from core.wire import NDJSON, decode_request, encode_batch_response, encode_response, encode_stream, negotiate
 from orgs.hospitalC.access_policy import ORG_POLICIES, DEPT_POLICIES, DEPT_GATE_POLICIES
 from orgs.auth_skeleton.models import db, User
 
@@ -32,17 +37,17 @@ for dept in DEPTS:
 
     # gate policies
     dept_gate_policies = [Policy.from_json(policy_json) for policy_json in DEPT_GATE_POLICIES[dept]]
-    storage_gate = MemoryStorage()
+    storage_gate = VersionedMemoryStorage()
     for policy in dept_gate_policies:
         storage_gate.add(policy)
-    pdp_gate = PDP(storage_gate, EvaluationAlgorithm.ALLOW_OVERRIDES)
+    pdp_gate = CachedPDP(storage_gate, EvaluationAlgorithm.ALLOW_OVERRIDES)
 
     # final policies
     dept_policies = [Policy.from_json(policy_json) for policy_json in DEPT_POLICIES[dept]]
-    storage = MemoryStorage()
+    storage = VersionedMemoryStorage()
     for policy in dept_policies:
         storage.add(policy)
-    pdp = PDP(storage, EvaluationAlgorithm.ALLOW_OVERRIDES)
+    pdp = CachedPDP(storage, EvaluationAlgorithm.ALLOW_OVERRIDES)
 
     dept_retriever = LeafRetriever(
                                     id=dept, 
@@ -57,27 +62,73 @@ for dept in DEPTS:
 
 # Set up router retriever for Hospital C with above leaf retrievers as children
 org_policies = [Policy.from_json(policy_json) for policy_json in ORG_POLICIES]
-storage = MemoryStorage()
+storage = VersionedMemoryStorage()
 for policy in org_policies:
     storage.add(policy)
-pdp = PDP(storage, EvaluationAlgorithm.ALLOW_OVERRIDES)
+pdp = CachedPDP(storage, EvaluationAlgorithm.ALLOW_OVERRIDES)
 org_retriever = RouterRetriever(id=ORG, 
                                 children=child_retrievers, 
                                 abac_gate=pdp, 
                                 metadata={'org': ORG, 'depts': DEPTS})
+leaf_warmup = LeafWarmup(child_retrievers)  # started by app.py: builds leaf indexes in the background, queries use ready leaves
+gate_cache = GateDecisionCache()  # per-user gate decisions across the retriever tree, reused for GATE_CACHE_TTL
 hosp_bp = Blueprint('hospitalC', __name__)
 
-@hosp_bp.route('/api/retrieve', methods=['GET'])
+@hosp_bp.route('/api/retrieve', methods=['GET', 'POST'])
 def retrieve():
-    if request.method == 'GET':
-        print(f"/api/retrieve GET args={request.args}")
-        query = request.args.get('query')
-        userinfo = json.loads(request.args.get('userinfo'))
-        search_kwargs = json.loads(request.args.get('search_kwargs'))
-        docs = org_retriever.get_relevant_documents(query=query, userinfo=userinfo, search_kwargs=search_kwargs)
-        print(f"{ORG} retrieved {len(docs)} docs.")
-        return jsonify(docs=[doc.to_json() for doc in docs], query=query)
-    return jsonify()
+    # POST body or GET query string, see core/wire.py
+    fields = decode_request(request.args, request.get_data(), request.content_type)
+    print(f"/api/retrieve {request.method} query={fields.get('query')!r} userinfo={fields.get('userinfo')}")
+    query = fields['query']
+    userinfo = fields['userinfo']
+    search_kwargs = fields['search_kwargs']
+    query_vector = decode_query_vector(fields)  # None unless the root embedded the query with our model
+    # with ready_only, leaves still warming up are skipped (and listed in `warming`), else the query waits for their builds
+    ready_only = bool(fields.get('ready_only'))
+    leaf_warmup.retry_failed()
+    # before searching, so results are never reported complete (or current) when they aren't
+    warming, cache = (leaf_warmup.warming() if ready_only else []), cache_info(tree_pdps(org_retriever), leaf_warmup.index_version())
+    if fields.get('stream'):  # one ndjson line per leaf as it finishes
+        results = org_retriever.stream_relevant_documents(query=query, userinfo=userinfo, search_kwargs=search_kwargs, query_vector=query_vector,
+                                                          gate_decisions=gate_cache.decisions(userinfo), ready_only=ready_only)
+        lines = encode_stream(results, metadata_keys=fields.get('metadata_keys'), query=query, warming=warming, cache=cache)
+        return Response(stream_with_context(lines), mimetype=NDJSON)
+    docs = org_retriever.get_relevant_documents(query=query, userinfo=userinfo, search_kwargs=search_kwargs, query_vector=query_vector,
+                                                gate_decisions=gate_cache.decisions(userinfo), ready_only=ready_only)
+    print(f"{ORG} retrieved {len(docs)} docs.")
+    body, headers = encode_response(docs, negotiate(request.headers.get('Accept')), request.headers.get('Accept-Encoding'),
+                                    metadata_keys=fields.get('metadata_keys'), query=query, warming=warming, cache=cache)
+    return Response(body, headers=headers)
+
+@hosp_bp.route('/api/retrieve_batch', methods=['POST'])
+def retrieve_batch():
+    # many (query, userinfo) requests at once, e.g. from evaluation: queries are embedded and each leaf searched in one batch
+    fields = decode_request(request.args, request.get_data(), request.content_type)
+    ready_only = bool(fields.get('ready_only'))
+    leaf_warmup.retry_failed()
+    warming, cache = (leaf_warmup.warming() if ready_only else []), cache_info(tree_pdps(org_retriever), leaf_warmup.index_version())
+    batch = [
+        dict(query=req['query'], userinfo=req['userinfo'], search_kwargs=req['search_kwargs'], query_vector=decode_query_vector(req),
+             gate_decisions=gate_cache.decisions(req['userinfo']), ready_only=ready_only)
+        for req in fields['requests']
+    ]
+    print(f"/api/retrieve_batch POST {len(batch)} requests")
+    doc_lists = org_retriever.batch_relevant_documents(batch)
+    print(f"{ORG} retrieved {sum(len(docs) for docs in doc_lists)} docs for {len(batch)} requests.")
+    body, headers = encode_batch_response(doc_lists, negotiate(request.headers.get('Accept')), request.headers.get('Accept-Encoding'),
+                                          metadata_keys=fields.get('metadata_keys'), warming=warming, cache=cache)
+    return Response(body, headers=headers)
+
+@hosp_bp.route('/api/health', methods=['GET'])
+def health():
+    return jsonify(ready=leaf_warmup.ready(), leaves=leaf_warmup.status())
+
+@hosp_bp.route('/api/health/<leaf_id>', methods=['GET'])
+def leaf_health(leaf_id):
+    if leaf_id not in leaf_warmup.leaves:
+        return jsonify(error=f"unknown leaf {leaf_id}"), 404
+    status = leaf_warmup.status(leaf_id)
+    return jsonify(id=leaf_id, **status), (200 if status["status"] == "ready" else 503)
 
 @hosp_bp.route('/certs', methods=['GET'])
 def jwks_keys():